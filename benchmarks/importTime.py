@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Import time benchmark
+# Each import is timed in a fresh interpreter, and the heavy modules it should not pull in are checked.
+# Exits with status 1 if any import loads a module it should not, or is slower than --maxTime
+#
+#   python benchmarks/importTime.py --repeat 5
+
+import subprocess
+import sys
+import os
+import json
+import argparse
+import numpy as np
+
+# (import statement, module prefixes that should not be imported by it)
+importCases = [
+    ("import ttgamma",
+     ["coffea", "awkward", "numba", "uproot"]),
+    #coffea.hist itself imports coffea.processor and coffea.nanoevents (and numba with them)
+    ("from ttgamma.utils.plotting import plotWithRatio, RebinHist",
+     ["ttgamma.processor", "coffea.jetmet_tools", "coffea.btag_tools", "coffea.lookup_tools"]),
+    ("from ttgamma import TTGammaProcessor",
+     ["coffea.jetmet_tools", "coffea.btag_tools", "coffea.lookup_tools.evaluator", "ttgamma.utils.correctionBundle"]),
+    #the b-tagging scale factors are read from the bundle, coffea's CSV parser is only needed to build it
+    ("from ttgamma.processor import getCorrections; getCorrections()",
+     ["coffea.btag_tools"]),
+]
+
+timingCode = """
+import sys, time, json
+start = time.perf_counter()
+exec({statement!r})
+elapsed = time.perf_counter() - start
+forbidden = {forbidden!r}
+loaded = sorted(m for m in sys.modules if any(m == f or m.startswith(f + '.') for f in forbidden))
+print(json.dumps({{'time': elapsed, 'loaded': loaded}}))
+"""
+
+def timeImport(statement, forbidden):
+    repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-W", "ignore", "-c", timingCode.format(statement=statement, forbidden=forbidden)],
+                            cwd=repoDir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"'{statement}' failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the imports of the ttgamma package, each in a fresh interpreter')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of fresh interpreters per import (median time is reported)')
+    parser.add_argument('--maxTime', type=float, default=None, help='Fail if the median time of "import ttgamma" is above this (seconds)')
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'median [s]':>10}  {'min [s]':>8}  import")
+    for statement, forbidden in importCases:
+        results = [timeImport(statement, forbidden) for _ in range(args.repeat)]
+        times = [r['time'] for r in results]
+        print(f"{np.median(times):10.3f}  {min(times):8.3f}  {statement}")
+
+        loaded = sorted(set(m for r in results for m in r['loaded']))
+        if len(loaded) > 0:
+            failed = True
+            print(f"{'':22}ERROR: imports {', '.join(loaded[:10])}{' ...' if len(loaded) > 10 else ''}")
+
+        if args.maxTime is not None and statement == "import ttgamma" and np.median(times) > args.maxTime:
+            failed = True
+            print(f"{'':22}ERROR: slower than {args.maxTime} s")
+
+    sys.exit(1 if failed else 0)
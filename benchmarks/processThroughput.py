@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# Throughput benchmark of TTGammaProcessor.process()
+# Runs the processor over synthetic NanoAOD files (see syntheticNanoAOD.py, generated once in --dataDir) for data and
+# MC, each jet systematic and several chunk sizes, and reports the events/second of process() and the peak RSS.
+# Each case runs in a fresh interpreter; the chunks are read before they are timed, and the first chunk is processed
+# once before the timing (numba compilation, loading of the corrections). The results can be saved, and compared
+# with saved results: exits with status 1 if any case is slower, or uses more memory, than allowed by --tolerance
+#
+#   python benchmarks/processThroughput.py --save before.json
+#   python benchmarks/processThroughput.py --compare before.json --samples mc --jetSyst nominal,all
+
+import subprocess
+import tempfile
+import platform
+import datetime
+import sys
+import os
+import json
+import argparse
+import numpy as np
+
+from syntheticNanoAOD import writeFile, parseMultiplicities
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# dataset names used for the synthetic files: the MC one goes through the TTbar overlap removal
+datasets = {'data': 'DataMu', 'mc': 'TTbarPowheg_Semilept'}
+
+jetSystTypes = ['nominal', 'JERUp', 'JERDown', 'JESUp', 'JESDown', 'all']
+
+caseCode = """
+import sys, time, json
+sys.path.insert(0, {repoDir!r})
+from ttgamma import TTGammaProcessor
+from ttgamma.utils.chunkRunner import getChunks, readChunk, preloadedEvents
+from ttgamma.utils.stageTimer import peakRSS
+import uproot
+
+processor_instance = TTGammaProcessor(isMC={isMC!r}, jetSyst={jetSyst!r})
+chunks = getChunks({{{dataset!r}: [{filename!r}]}}, {chunksize!r})
+with uproot.open({filename!r}) as fhandle:
+    tree = fhandle['Events']
+    arrays = [readChunk(tree, chunk, processor_instance.branches) for chunk in chunks]
+
+processor_instance.process(preloadedEvents(arrays[0], chunks[0]))
+times = []
+for _ in range({repeat!r}):
+    elapsed = 0.
+    for chunk, chunkArrays in zip(chunks, arrays):
+        events = preloadedEvents(chunkArrays, chunk)
+        start = time.perf_counter()
+        processor_instance.process(events)
+        elapsed += time.perf_counter() - start
+    times.append(elapsed)
+print(json.dumps({{'times': times, 'nEvents': sum(c.entrystop - c.entrystart for c in chunks), 'peakRSS': peakRSS()}}))
+"""
+
+
+def syntheticFile(dataDir, sample, nEvents, seed, multiplicities):
+    """Path of the synthetic file for these settings, written if it does not exist yet"""
+    tag = '_'.join(f'{k}{v:g}' for k, v in sorted(multiplicities.items()))
+    filename = os.path.join(dataDir, f"{sample}_{nEvents}_seed{seed}{'_' + tag if tag else ''}.root")
+    if not os.path.exists(filename):
+        os.makedirs(dataDir, exist_ok=True)
+        print(f"Writing {nEvents} synthetic {sample} events to {filename}")
+        writeFile(filename, nEvents, isMC=(sample == 'mc'), seed=seed, multiplicities=multiplicities)
+    return filename
+
+
+def runCase(filename, sample, jetSyst, chunksize, repeat):
+    code = caseCode.format(repoDir=repoDir, isMC=(sample == 'mc'), jetSyst=jetSyst, dataset=datasets[sample],
+                           filename=filename, chunksize=chunksize, repeat=repeat)
+    result = subprocess.run([sys.executable, "-W", "ignore", "-c", code], cwd=repoDir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{sample} {jetSyst} {chunksize} failed:\n{result.stderr}")
+    result = json.loads(result.stdout.strip().splitlines()[-1])
+    return {'sample': sample, 'jetSyst': jetSyst, 'chunksize': chunksize,
+            'rate': result['nEvents']/np.median(result['times']), 'peakRSS': result['peakRSS'], 'times': result['times']}
+
+
+def caseKey(case):
+    return (case['sample'], case['jetSyst'], case['chunksize'])
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repoDir, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    versions = {}
+    for module in ['numpy', 'awkward', 'uproot', 'coffea', 'numba']:
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return {'commit': commit, 'host': platform.node(), 'python': platform.python_version(), 'versions': versions,
+            'date': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the throughput of TTGammaProcessor.process() on synthetic NanoAOD files')
+    parser.add_argument('--samples', default='data,mc', help='Comma separated list of samples to run (data, mc)')
+    parser.add_argument('--jetSyst', default=','.join(jetSystTypes), help='Comma separated list of jet systematics to run for MC')
+    parser.add_argument('--chunksizes', default='5000,20000', help='Comma separated list of chunk sizes')
+    parser.add_argument('--nEvents', type=int, default=20000, help='Number of events in each synthetic file')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the synthetic files')
+    parser.add_argument('--multiplicity', action='append', default=[], help='Mean number of objects per event of a collection, as NAME=MEAN (see syntheticNanoAOD.py)')
+    parser.add_argument('--dataDir', default=os.path.join(tempfile.gettempdir(), 'ttgammaBenchmark'), help='Directory of the synthetic files')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of passes over the chunks in each case (median time is reported)')
+    parser.add_argument('--save', default=None, help='Save the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='Compare with the results saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative decrease of the rate, and increase of the peak RSS, with --compare')
+    args = parser.parse_args()
+
+    multiplicities = parseMultiplicities(args.multiplicity)
+    samples = args.samples.split(',')
+    chunksizes = [int(c) for c in args.chunksizes.split(',')]
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = {caseKey(case): case for case in json.load(f)['cases']}
+
+    failed = False
+    cases = []
+    print(f"{'sample':<6} {'jetSyst':<8} {'chunksize':>9} {'events/s':>10} {'peak RSS [MB]':>14}{'  vs baseline' if baseline else ''}")
+    for sample in samples:
+        filename = syntheticFile(args.dataDir, sample, args.nEvents, args.seed, multiplicities)
+        #data only has the nominal jets
+        for jetSyst in (args.jetSyst.split(',') if sample == 'mc' else ['nominal']):
+            for chunksize in chunksizes:
+                case = runCase(filename, sample, jetSyst, chunksize, args.repeat)
+                cases.append(case)
+                line = f"{sample:<6} {jetSyst:<8} {chunksize:>9} {case['rate']:>10.1f} {case['peakRSS']/1e6:>14.1f}"
+                reference = baseline.get(caseKey(case))
+                if reference is not None:
+                    rateRatio = case['rate']/reference['rate']
+                    rssRatio = case['peakRSS']/reference['peakRSS']
+                    line += f"  rate x{rateRatio:.2f}, RSS x{rssRatio:.2f}"
+                    if rateRatio < 1 - args.tolerance or rssRatio > 1 + args.tolerance:
+                        failed = True
+                        line += "  REGRESSION"
+                print(line)
+
+    if args.save is not None:
+        settings = {'nEvents': args.nEvents, 'seed': args.seed, 'multiplicities': multiplicities, 'repeat': args.repeat}
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'settings': settings, 'cases': cases}, f, indent=1)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# Synthetic NanoAOD generator
+# Writes ROOT files with every branch read by TTGammaProcessor (see ttgamma/utils/branchManifest.py), filled with
+# random values with roughly realistic distributions, so that the processor can be run and benchmarked offline.
+# MC files also have the GenPart mother chains, gen jets, LHE/PS weights, pileup, and the hEvents histogram.
+# The mean number of objects per event of each collection can be changed with --multiplicity.
+#
+#   python benchmarks/syntheticNanoAOD.py ttbar.root 100000 --mc --multiplicity Jet=8 --multiplicity GenPart=60
+
+import os
+import sys
+import argparse
+import numpy as np
+import awkward as ak
+import uproot
+
+# mean number of objects per event (Poisson distributed)
+defaultMultiplicities = {
+    'Muon': 0.8,
+    'Electron': 0.8,
+    'Photon': 1.0,
+    'Jet': 5.5,
+    'GenJet': 5.0,
+    'GenPart': 30.0,
+}
+
+compressions = {
+    'zlib': uproot.ZLIB(1),
+    'lz4': uproot.LZ4(4),
+    'lzma': uproot.LZMA(9),
+}
+
+
+def makeEvents(nEvents, isMC=True, seed=1, multiplicities=None):
+    """Dictionary of branch arrays for nEvents synthetic events, with the collections as awkward records"""
+    multiplicities = {**defaultMultiplicities, **(multiplicities or {})}
+    rng = np.random.default_rng(seed)
+    out = {}
+
+    pt = lambda lo, scale: (lambda n: (lo + rng.exponential(scale, n)).astype(np.float32))
+    eta = lambda w: (lambda n: rng.uniform(-w, w, n).astype(np.float32))
+    phi = lambda n: rng.uniform(-np.pi, np.pi, n).astype(np.float32)
+    zero = lambda n: np.zeros(n, np.float32)
+    boolean = lambda p: (lambda n: rng.random(n) < p)
+    ints = lambda lo, hi: (lambda n: rng.integers(lo, hi, n).astype(np.int32))
+    charge = lambda n: rng.choice([-1, 1], n).astype(np.int32)
+
+    def collection(name, fields, nMax=None):
+        counts = rng.poisson(multiplicities[name], nEvents)
+        if nMax is not None:
+            counts = np.minimum(counts, nMax)
+        n = int(counts.sum())
+        out[name] = ak.zip({field: ak.unflatten(f(n), counts) for field, f in fields.items()})
+        return counts
+
+    collection('Muon', {
+        'pt': pt(10, 30), 'eta': eta(2.6), 'phi': phi, 'mass': lambda n: np.full(n, 0.105, np.float32), 'charge': charge,
+        'tightId': boolean(0.8), 'pfRelIso04_all': lambda n: rng.exponential(0.1, n).astype(np.float32),
+        'isPFcand': boolean(0.95), 'isTracker': boolean(0.9), 'isGlobal': boolean(0.9),
+    })
+    collection('Electron', {
+        'pt': pt(10, 35), 'eta': eta(2.6), 'phi': phi, 'mass': zero, 'charge': charge,
+        'dxy': lambda n: rng.normal(0, 0.03, n).astype(np.float32),
+        'dz': lambda n: rng.normal(0, 0.06, n).astype(np.float32),
+        'cutBased': ints(0, 5),
+    })
+    jetFields = {
+        'pt': pt(20, 40), 'eta': eta(3.0), 'phi': phi, 'mass': lambda n: rng.uniform(2, 20, n).astype(np.float32),
+        'jetId': lambda n: rng.choice([0, 2, 6], n, p=[0.05, 0.15, 0.8]).astype(np.int32),
+        'btagDeepB': lambda n: rng.random(n).astype(np.float32),
+    }
+    photonFields = {
+        'pt': pt(15, 30), 'eta': eta(1.6), 'phi': phi, 'mass': zero,
+        'pfRelIso03_chg': lambda n: rng.exponential(0.05, n).astype(np.float32),
+        'isScEtaEE': boolean(0.1), 'isScEtaEB': boolean(0.9),
+        'electronVeto': boolean(0.9), 'pixelSeed': boolean(0.1),
+        'cutBased': ints(0, 4),
+        'vidNestedWPBitmap': lambda n: rng.choice([0x3fff, 0x2aaa, 0x2a2a, 0x1555], n).astype(np.int32),
+    }
+
+    out['fixedGridRhoFastjetAll'] = rng.uniform(5, 30, nEvents).astype(np.float32)
+    out['HLT_IsoMu24'] = rng.random(nEvents) < 0.5
+    out['HLT_IsoTkMu24'] = rng.random(nEvents) < 0.3
+    out['HLT_Ele27_WPTight_Gsf'] = rng.random(nEvents) < 0.5
+
+    if not isMC:
+        collection('Jet', jetFields, nMax=14)
+        collection('Photon', photonFields)
+        return out
+
+    # GenPart history: every mother comes before its daughters, the first two particles (and a few others) have no mother
+    nGen = rng.poisson(multiplicities['GenPart'], nEvents) + 4
+    offsets = np.concatenate([[0], np.cumsum(nGen)])
+    total = int(offsets[-1])
+    local = np.arange(total) - np.repeat(offsets[:-1], nGen)
+    mother = np.where(local < 2, -1, (rng.random(total) * np.maximum(local, 1)).astype(np.int32))
+    mother[(local >= 2) & (rng.random(total) < 0.1)] = -1
+    pdgId = rng.choice([22, 11, -11, 13, 211, -211, 111, 21, 1, 2, 5, 6, 24, 12, 2212], total,
+                       p=[0.25, 0.03, 0.03, 0.02, 0.15, 0.1, 0.1, 0.1, 0.05, 0.05, 0.04, 0.03, 0.02, 0.02, 0.01])
+    out['GenPart'] = ak.zip({
+        'pt': ak.unflatten((rng.exponential(30, total) + 0.005).astype(np.float32), nGen),
+        'eta': ak.unflatten(rng.uniform(-4, 4, total).astype(np.float32), nGen),
+        'phi': ak.unflatten(rng.uniform(-np.pi, np.pi, total).astype(np.float32), nGen),
+        'mass': ak.unflatten(np.zeros(total, np.float32), nGen),
+        'pdgId': ak.unflatten(pdgId.astype(np.int32), nGen),
+        'status': ak.unflatten(rng.choice([1, 2, 23, 62, 71], total).astype(np.int32), nGen),
+        'genPartIdxMother': ak.unflatten(mother.astype(np.int32), nGen),
+    })
+    nGenJet = collection('GenJet', {'pt': pt(15, 40), 'eta': eta(3.0), 'phi': phi, 'mass': zero})
+
+    # indices of the matched gen objects, -1 (no match) or a valid index in the same event
+    def matchIndex(counts, nTarget):
+        n = int(counts.sum())
+        return (np.floor(rng.random(n) * (np.repeat(nTarget, counts) + 1)).astype(np.int32) - 1)
+
+    jetFields.update({
+        'rawFactor': lambda n: rng.uniform(0, 0.2, n).astype(np.float32),
+        'area': lambda n: rng.normal(0.5, 0.03, n).astype(np.float32),
+        'hadronFlavour': lambda n: rng.choice([0, 4, 5], n, p=[0.6, 0.1, 0.3]).astype(np.int32),
+    })
+    nJet = collection('Jet', jetFields, nMax=14)
+    out['Jet'] = ak.with_field(out['Jet'], ak.unflatten(matchIndex(nJet, nGenJet), nJet), 'genJetIdx')
+    nPhoton = collection('Photon', photonFields)
+    out['Photon'] = ak.with_field(out['Photon'], ak.unflatten(matchIndex(nPhoton, nGen), nPhoton), 'genPartIdx')
+
+    out['Pileup_nTrueInt'] = rng.uniform(0, 60, nEvents).astype(np.float32)
+    generatorWeight = rng.choice([1.0, -1.0], nEvents, p=[0.9, 0.1]).astype(np.float32)
+    out['Generator_weight'] = generatorWeight
+    out['LHEWeight_originalXWGTUP'] = generatorWeight
+    out['PSWeight'] = ak.unflatten(rng.normal(1, 0.1, 4*nEvents).astype(np.float32), np.full(nEvents, 4))
+    out['LHEPdfWeight'] = ak.unflatten(rng.normal(1, 0.05, 101*nEvents).astype(np.float32), np.full(nEvents, 101))
+    out['LHEScaleWeight'] = ak.unflatten(rng.normal(1, 0.1, 9*nEvents).astype(np.float32), np.full(nEvents, 9))
+    return out
+
+
+def writeFile(path, nEvents, isMC=True, seed=1, multiplicities=None, compression='zlib', blockSize=100000):
+    """Write nEvents synthetic events to path, generated and written in blocks of blockSize events
+
+    MC files also get an hEvents histogram (all events counted with a positive weight)
+    """
+    tmpName = f'{path}.tmp{os.getpid()}'
+    with uproot.recreate(tmpName, compression=compressions[compression]) as f:
+        for block, start in enumerate(range(0, nEvents, blockSize)):
+            arrays = makeEvents(min(blockSize, nEvents - start), isMC, seed=(seed, block), multiplicities=multiplicities)
+            if block == 0:
+                f['Events'] = arrays
+            else:
+                f['Events'].extend(arrays)
+        if isMC:
+            f['hEvents'] = (np.array([0., 0., float(nEvents)]), np.array([-1.5, -0.5, 0.5, 1.5]))
+    os.replace(tmpName, path)
+
+
+def missingBranches(path, isMC):
+    """Branches of the processor's branch manifest which are not in the file"""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from ttgamma.utils.branchManifest import getBranchManifest
+    with uproot.open(path) as f:
+        return [b for b in getBranchManifest(isMC) if b not in f['Events']]
+
+
+def parseMultiplicities(values):
+    multiplicities = {}
+    for value in values:
+        name, mean = value.split('=')
+        if name not in defaultMultiplicities:
+            raise ValueError(f"Unknown collection {name}, should be one of {', '.join(defaultMultiplicities)}")
+        multiplicities[name] = float(mean)
+    return multiplicities
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic NanoAOD file with all the branches read by TTGammaProcessor')
+    parser.add_argument('output', help='Output ROOT file')
+    parser.add_argument('nEvents', type=int, help='Number of events')
+    parser.add_argument('--mc', action='store_true', help='Write MC (gen particles, weights, jet correction inputs) instead of data')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--multiplicity', action='append', default=[],
+                        help=f"Mean number of objects per event of a collection, as NAME=MEAN (defaults: {', '.join(f'{k}={v}' for k, v in defaultMultiplicities.items())})")
+    parser.add_argument('--compression', choices=list(compressions), default='zlib', help='Compression of the baskets')
+    args = parser.parse_args()
+
+    writeFile(args.output, args.nEvents, args.mc, args.seed, parseMultiplicities(args.multiplicity), args.compression)
+    missing = missingBranches(args.output, args.mc)
+    if len(missing) > 0:
+        print(f"ERROR: branches missing from {args.output}: {', '.join(missing)}")
+        sys.exit(1)
+    print(f"Wrote {args.nEvents} {'MC' if args.mc else 'data'} events to {args.output}")
@@ -7,42 +7,267 @@ from ttgamma import TTGammaProcessor
 #from ttgamma.utils.fileSet_2016_LZ4 import fileSet_Data_2016
 from ttgamma.utils.fileset2021 import fileset
 from ttgamma.utils.crossSections import *
+from ttgamma.utils.chunkRunner import getChunks, runChunks, runChunksPipelined, clearCheckpoints
+from ttgamma.utils.indexedOutput import saveIndexed
+from ttgamma.utils.mergeOutputs import saveAtomic
+from ttgamma.utils.inputEventCounts import inputEventCounts
+from ttgamma.utils.fileCache import FileCache
+from ttgamma.utils.skimWriter import skimFileset
+from ttgamma.utils.chunkSizing import chooseChunkSizes, loadModels, processorConfig
+from ttgamma.utils.jobPlanner import datasetGroups, loadPlan, unitGroups, pieceChunks, outputName, datasetEventTimes, longestFirst, splitByGroup
+from ttgamma.utils.datasetMetadata import filesetFiles, filesetMetadata, withMetadata
+from ttgamma.utils.localExecutor import LocalExecutor, executorNames
 
+import os
 import time
+import atexit
 import sys
+import json
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 
 import argparse
 parser = argparse.ArgumentParser(description="Batch processing script for ttgamma analysis")
-parser.add_argument("mcGroup", type=str, help="Name of process to run (Data, MCTTGamma, MCTTbar1l, MCTTbar2l, MCSingleTop, MCZJets, MCWJets, MCOther)")
+parser.add_argument("mcGroup", type=str, nargs="?", default=None, help="Name of process to run (Data, MCTTGamma, MCTTbar1l, MCTTbar2l, MCSingleTop, MCZJets, MCWJets, MCOther), or All to run every group in one pass (one output per group), not needed with --workUnit")
+parser.add_argument("--workUnit", type=int, default=None, help="Run this work unit of the plan in --workUnits (made with python -m ttgamma.utils.jobPlanner plan), instead of a whole group")
+parser.add_argument("--workUnits", type=str, default="workUnits.json", help="Work unit plan used with --workUnit")
 parser.add_argument("--chunksize", type=int, default=100000, help="Chunk size")
+parser.add_argument("--memoryBudget", type=float, default=None, help="Memory budget (GB) of each worker: the chunk size of each dataset is chosen as the largest one predicted to fit in it, from probes of the processor on the dataset (replaces --chunksize; the MC jet smearing is seeded per chunk, so MC histograms differ from a run with other chunks within the smearing fluctuations)")
+parser.add_argument("--maxChunksize", type=int, default=1000000, help="Largest chunk size chosen with --memoryBudget")
+parser.add_argument("--chunkModels", type=str, default="chunkSizes.json", help="JSON file where the memory and time models of each dataset measured with --memoryBudget are saved and reused, use '' to disable")
 parser.add_argument("--maxchunks", type=int, default=None, help="Max chunks")
 parser.add_argument("--workers", type=int, default=1, help="Number of workers")
+parser.add_argument("--executor", type=str, choices=executorNames, default="futures", help="How the chunks are run: iterative (in this process, for profiling), futures (pool of --workers processes) or dask (local dask cluster of --workers processes, with work stealing)")
+parser.add_argument("--workerMemory", type=float, default=None, help="Memory limit (GB) of each dask worker with --executor dask, above which it is paused, then restarted")
 parser.add_argument("--condor", action="store_true", help="Flag for running on condor (disables progress bar)")
+parser.add_argument("--jetSyst", type=str, default="nominal", help="Jet systematic to run (nominal, JERUp, JERDown, JESUp, JESDown), a comma separated list of them, or 'all' to run every jet systematic in one pass")
+parser.add_argument("--prefetch", action="store_true", help="Read only the branches in the processor's branch manifest, in one bulk read per chunk")
+parser.add_argument("--pipeline", action="store_true", help="Read the manifest branches of the next chunks on I/O threads while the current chunk is processed (in each of the --workers processes)")
+parser.add_argument("--ioThreads", type=int, default=2, help="Number of I/O threads per worker with --pipeline")
+parser.add_argument("--prefetchDepth", type=int, default=2, help="Number of chunks read ahead per worker with --pipeline")
+parser.add_argument("--prefetchMemory", type=float, default=None, help="Limit (GB) on the arrays of the chunks read ahead by all workers with --pipeline")
+parser.add_argument("--checkManifest", action="store_true", help="Read branches lazily and report any branch used by the processor that is missing from its manifest")
+parser.add_argument("--timeStages", action="store_true", help="Record the wall time, CPU time and peak memory increase of each stage of the processor, and print a summary table at the end")
+parser.add_argument("--noPreSelection", action="store_true", help="Disable the pre-selection of events before the expensive processing stages")
+parser.add_argument("--checkpoint", type=str, default=None, help="Directory where the output of every chunk is saved when it is done; when rerun with the same directory, only the chunks missing from it are processed")
+parser.add_argument("--cacheDir", type=str, default=None, help="Local directory where the remote input files are copied (in parallel, before processing) and read from")
+parser.add_argument("--cacheSize", type=float, default=None, help="Size limit of the input file cache (GB), the least recently used files are removed above it")
+parser.add_argument("--skim", type=str, default=None, help="Instead of processing, write the events passing the pre-selection (manifest branches only) to skim files in this directory; its fileset.json can then be used with --fileset")
+parser.add_argument("--fileset", type=str, default=None, help="JSON file with the fileset to run on (e.g. the fileset.json of a skim), instead of ttgamma/utils/fileset2021.py")
+parser.add_argument("--countCache", type=str, default="inputEventCounts.json", help="JSON file caching the number of generated events of each input file (by file UUID), use '' to disable")
+parser.add_argument("--indexed", action="store_true", help="Also write the output in the indexed format (.hists), where single histograms can be read without loading the whole file")
 args = parser.parse_args()
+if args.mcGroup is None and args.workUnit is None:
+    parser.error("either a group name or --workUnit is needed")
+
+jetSyst = args.jetSyst if args.jetSyst == "all" else args.jetSyst.split(",")
+
+if args.fileset:
+    with open(args.fileset) as f:
+        fileset = json.load(f)
+
+# the metadata of every dataset (see ttgamma/utils/datasetMetadata.py), taken from the fileset entries if they have
+# some, and attached to the chunks so that process() does not derive it from the dataset name
+datasetMeta = filesetMetadata(fileset)
+fileset = filesetFiles(fileset)
+
+def jobChunksize(job_fileset, processor_instance):
+    # with --memoryBudget, the chunk size of each dataset is chosen from probes of the processor (see ttgamma/utils/chunkSizing.py)
+    if args.memoryBudget is None:
+        return args.chunksize
+    return chooseChunkSizes(job_fileset, processor_instance, args.memoryBudget*1e9, cachePath=args.chunkModels if args.chunkModels else None,
+                            maxChunksize=args.maxChunksize)
+
+executor = None
+def jobExecutor():
+    # the workers (see ttgamma/utils/localExecutor.py) are started once, and shared by the jobs of the run
+    global executor
+    if executor is None:
+        executor = LocalExecutor(args.executor, args.workers, memoryLimit=args.workerMemory*1e9 if args.workerMemory is not None else None)
+        atexit.register(executor.close)
+    return executor
+
+def runJob(job_fileset, processor_instance, chunks=None):
+    # chunks can be given instead of the chunks of the whole files of job_fileset (e.g. the entry ranges of a work unit)
+    if args.pipeline and not args.checkManifest:
+        if chunks is None:
+            chunks = getChunks(withMetadata(job_fileset, datasetMeta), jobChunksize(job_fileset, processor_instance), args.maxchunks)
+        return runChunksPipelined(chunks, processor_instance, ioThreads=args.ioThreads, depth=args.prefetchDepth,
+                                  maxBytes=args.prefetchMemory*1e9 if args.prefetchMemory is not None else None,
+                                  status=not args.condor, checkpointDir=args.checkpoint, executor=jobExecutor())
+
+    # per-dataset chunk sizes and entry ranges are only supported by the chunk runner
+    if chunks is not None or args.prefetch or args.checkManifest or args.checkpoint or args.memoryBudget:
+        if chunks is None:
+            chunks = getChunks(withMetadata(job_fileset, datasetMeta), jobChunksize(job_fileset, processor_instance), args.maxchunks)
+        output, unlisted = runChunks(chunks, processor_instance, checkManifest=args.checkManifest, status=not args.condor,
+                                     checkpointDir=args.checkpoint, executor=jobExecutor())
+        if args.checkManifest:
+            print("Branches read outside of the branch manifest: {}".format(unlisted if unlisted else "none"))
+        return output
+
+    coffeaExecutor, executor_args = jobExecutor().coffeaExecutor(status=not args.condor)
+    return processor.run_uproot_job(withMetadata(job_fileset, datasetMeta),
+                                    treename           = 'Events',
+                                    processor_instance = processor_instance,
+                                    executor           = coffeaExecutor,
+                                    executor_args      = {'schema': NanoAODSchema, **executor_args},#{'workers': 4, 'flatten': True},
+                                    chunksize          = args.chunksize,
+                                    maxchunks          = args.maxchunks
+                                )
+
+def saveOutput(output, filename):
+    # written to a temporary file then renamed, so a job evicted while saving does not leave a truncated output
+    # (which --workUnit reruns would take as done)
+    saveAtomic(output, f"{filename}.coffea")
+    if args.indexed:
+        saveIndexed(output, f"{filename}.hists")
+
+def clearRunCheckpoints():
+    # the chunk outputs are not needed any more once every output of the run is saved (not after the first one:
+    # with All or a work unit, the checkpoints of the groups saved later would be lost)
+    if args.checkpoint:
+        clearCheckpoints(args.checkpoint)
+
+def cachedFileset(job_fileset):
+    # with --cacheDir, the remote files are fetched to the local cache and the local copies are processed
+    if args.cacheDir is None:
+        return job_fileset
+    cache = FileCache(args.cacheDir, maxBytes=args.cacheSize*1e9 if args.cacheSize is not None else None)
+    return cache.localFileset(job_fileset, workers=max(args.workers, 4))
+
+def normalizeMC(output, inputEventCount):
+    # Scale the MC histograms to the luminosity, using the original number of events of each dataset
+    lumi_sfs = {}
+    for dataset_name in inputEventCount:
+        # Calculate luminosity scale factor
+        lumi_sfs[dataset_name] = crossSections[dataset_name] * lumis[2016] / inputEventCount[dataset_name]
+
+    for key, obj in output.items():
+        if isinstance(obj, hist.Hist):
+            obj.scale(lumi_sfs, axis="dataset")
+
+def runWorkUnit(unitID):
+    # Process the entry ranges of one work unit of the plan (see ttgamma/utils/jobPlanner.py), and save the output of
+    # each dataset group in it separately, to be summed with the outputs of the other units by the plan's merge step
+    plan = loadPlan(args.workUnits)
+    unit = plan['units'][unitID]
+    for group, pieces in unitGroups(unit).items():
+        name = outputName(group, unitID)
+        # the groups already saved by an earlier attempt of the job are not processed again
+        if os.path.exists(f"{name}.coffea"):
+            print(f"{name}.coffea already exists, skipping {group}")
+            continue
+        groupStart = time.time()
+        isMC = group != "Data"
+        group_fileset = {}
+        for piece in pieces:
+            if piece['filename'] not in group_fileset.setdefault(piece['dataset'], []):
+                group_fileset[piece['dataset']].append(piece['filename'])
+        local_fileset = cachedFileset(group_fileset)
+        localPaths = {f: localFile for dataset in group_fileset for f, localFile in zip(group_fileset[dataset], local_fileset[dataset])}
+
+        if isMC:
+            # the datasets can be split between units, so the normalization uses all the files of each dataset
+            countPool = ThreadPoolExecutor(max_workers=1)
+            inputEventCountFuture = countPool.submit(inputEventCounts, {dataset: plan['datasets'][dataset]['files'] for dataset in group_fileset},
+                                                     cachePath=args.countCache if args.countCache else None)
+
+        processor_instance = TTGammaProcessor(isMC=isMC, jetSyst=jetSyst if isMC else "nominal", preSelection=not args.noPreSelection, timeStages=args.timeStages)
+        # the metadata of the datasets is the one of the fileset the plan was made from (plans written before it was kept have none)
+        unitMeta = {dataset: plan['datasets'][dataset].get('metadata') or datasetMeta.get(dataset) for dataset in group_fileset}
+        # the chunk sizes are those the plan cut the pieces at (never probed here), or --chunksize for plans cut anywhere
+        chunksize = plan.get('chunksize') or args.chunksize
+        chunks = pieceChunks(pieces, chunksize, localPaths, unitMeta)
+        print("Running {} of work unit {}: {} chunks".format(group, unitID, len(chunks)))
+        output = runJob(local_fileset, processor_instance, chunks)
+
+        elapsed = time.time() - groupStart
+        print("Total time: %.1f seconds"%elapsed)
+        print("Total rate: %.1f events / second"%(output['EventCount'].value/elapsed))
+        if args.timeStages:
+            print(output['StageTimes'].table())
+
+        if isMC:
+            counts = inputEventCountFuture.result()
+            countPool.shutdown()
+            normalizeMC(output, counts)
+            # only one unit adds the count of each dataset to its output, so that the summed outputs count it once
+            output['InputEventCount'] = processor.defaultdict_accumulator(int)
+            for dataset in unit['countDatasets']:
+                if dataset in counts:
+                    output['InputEventCount'][dataset] = counts[dataset]
+        saveOutput(output, name)
+
+def skimJob(job_fileset, isMC):
+    # with --skim, the events passing the pre-selection are written to skim files instead of being processed
+    skimFileset(job_fileset, TTGammaProcessor(isMC=isMC), args.skim, chunksize=args.chunksize, workers=args.workers, status=not args.condor)
+    print("Skim written to {}, total time: {:.1f} seconds".format(args.skim, time.time() - tstart))
+    sys.exit(0)
 
 tstart = time.time()
 
+if args.workUnit is not None:
+    runWorkUnit(args.workUnit)
+    clearRunCheckpoints()
+    sys.exit(0)
+
 print("Running {}".format(args.mcGroup))
 
 #job_fileset = {args.mcGroup: fileset[args.mcGroup]} #{key: fileset[key] for key in fileset if "Data" in key}
 
-if args.mcGroup == "Data":
-    job_fileset = {key: fileset[key] for key in fileset if "Data" in key}
-    output = processor.run_uproot_job(job_fileset,
-                                      treename           = 'Events',
-                                      processor_instance = TTGammaProcessor(isMC=False),
-                                      executor           = processor.futures_executor,
-                                      executor_args      = {'schema': NanoAODSchema, 'workers': args.workers, 'status': not args.condor},#{'workers': 4, 'flatten': True},
-                                      chunksize          = args.chunksize,
-                                      maxchunks          = args.maxchunks
-                                  )
+if args.mcGroup == "All":
+    # Data and every MC group in one pass: a single processor (isMC from the metadata of each chunk) and a single pool
+    # of workers over all the chunks, the longest ones first, so that no worker idles between groups or at the end
+    if args.skim:
+        parser.error("--skim is run by group (Data, or an MC group)")
+    groups = datasetGroups(fileset)
+    job_fileset = cachedFileset({key: fileset[key] for datasets in groups.values() for key in datasets})
+    mc_fileset = {key: files for key, files in job_fileset.items() if datasetMeta[key]['isMC']}
+    data_fileset = {key: files for key, files in job_fileset.items() if not datasetMeta[key]['isMC']}
+
+    countPool = ThreadPoolExecutor(max_workers=1)
+    inputEventCountFuture = countPool.submit(inputEventCounts, mc_fileset, cachePath=args.countCache if args.countCache else None)
+
+    # the chunk sizes and the times per event are those of the data and MC processors, as in the runs by group
+    dataProcessor = TTGammaProcessor(isMC=False, preSelection=not args.noPreSelection)
+    mcProcessor = TTGammaProcessor(isMC=True, jetSyst=jetSyst, preSelection=not args.noPreSelection)
+    chunksize = args.chunksize
+    if args.memoryBudget is not None:
+        chunksize = {**jobChunksize(data_fileset, dataProcessor), **jobChunksize(mc_fileset, mcProcessor)}
+    eventTimes = datasetEventTimes(job_fileset, loadModels(args.chunkModels if args.chunkModels else None),
+                                   {'data': processorConfig(dataProcessor), 'mc': processorConfig(mcProcessor)})
+    chunks = longestFirst(getChunks(withMetadata(job_fileset, datasetMeta), chunksize, args.maxchunks), eventTimes)
+    print("Running {} datasets: {} chunks".format(len(job_fileset), len(chunks)))
+
+    output = runJob(job_fileset, TTGammaProcessor(isMC=None, jetSyst=jetSyst, preSelection=not args.noPreSelection, timeStages=args.timeStages), chunks)
+
+    elapsed = time.time() - tstart
+    print("Total time: %.1f seconds"%elapsed)
+    print("Total rate: %.1f events / second"%(output['EventCount'].value/elapsed))
+    if args.timeStages:
+        print(output['StageTimes'].table())
+
+    output['InputEventCount'] = inputEventCountFuture.result()
+    countPool.shutdown()
+    normalizeMC(output, output['InputEventCount'])
+    # one output per group, as written by the runs by group
+    for group, groupOutput in splitByGroup(output, groups, chunks).items():
+        saveOutput(groupOutput, outputName(group))
+
+elif args.mcGroup == "Data":
+    job_fileset = cachedFileset({key: fileset[key] for key in fileset if "Data" in key})
+    if args.skim:
+        skimJob(job_fileset, isMC=False)
+    output = runJob(job_fileset, TTGammaProcessor(isMC=False, preSelection=not args.noPreSelection, timeStages=args.timeStages))
     
     elapsed = time.time() - tstart
     print("Total time: %.1f seconds"%elapsed)
     print("Total rate: %.1f events / second"%(output['EventCount'].value/elapsed))
+    if args.timeStages:
+        print(output['StageTimes'].table())
     
-    util.save(output, 'outputData_ttgamma_condorFull_4jet.coffea')
+    saveOutput(output, outputName("Data"))
 
 else:
     '''
@@ -55,53 +280,33 @@ else:
     #    job_fileset = {key: fileset[key] for key in fileset if not "Data" in key}
     #    mcType = "MC"
 
-    # Define mapping for running on condor
-    mc_group_mapping = {
-        "MCTTGamma": [key for key in fileset if "TTGamma" in key], 
-        "MCTTbar1l": ["TTbarPowheg_Semilept", "TTbarPowheg_Hadronic"],
-        "MCTTbar2l": ["TTbarPowheg_Dilepton"],
-        "MCSingleTop": [key for key in fileset if "ST" in key],
-        "MCZJets": [key for key in fileset if "DY" in key],
-        "MCWJets": [key for key in fileset if "W1" in key or "W2" in key or "W3" in key or "W4" in key],
-    }
-    mc_nonother = []
-    for mcType, sampleList in mc_group_mapping.items():
-        mc_nonother.extend(sampleList)
-    mc_group_mapping["MCOther"] = [key for key in fileset if (not key in mc_nonother) and (not "Data" in key)]
-    job_fileset = {key: fileset[key] for key in mc_group_mapping[args.mcGroup]}
+    # Define mapping for running on condor (see ttgamma/utils/jobPlanner.py)
+    mc_group_mapping = datasetGroups(fileset)
+    job_fileset = cachedFileset({key: fileset[key] for key in mc_group_mapping[args.mcGroup]})
+    if args.skim:
+        skimJob(job_fileset, isMC=True)
 
     pprint(job_fileset)
 
-    output = processor.run_uproot_job(job_fileset,
-                                      treename           = 'Events',
-                                      processor_instance = TTGammaProcessor(isMC=True),
-                                      executor           = processor.futures_executor, #processor.futures_executor,
-                                      executor_args      = {'schema': NanoAODSchema, 'workers': args.workers, 'status': not args.condor},#{'workers': 4, 'flatten': True},
-                                      chunksize          = args.chunksize,
-                                      maxchunks          = args.maxchunks
-                                  )
+    # The original number of events of each file (for the normalization) is read in a background thread pool,
+    # while the files are processed
+    countPool = ThreadPoolExecutor(max_workers=1)
+    inputEventCountFuture = countPool.submit(inputEventCounts, job_fileset, cachePath=args.countCache if args.countCache else None)
+
+    output = runJob(job_fileset, TTGammaProcessor(isMC=True, jetSyst=jetSyst, preSelection=not args.noPreSelection, timeStages=args.timeStages))
 
     elapsed = time.time() - tstart
     print("Total time: %.1f seconds"%elapsed)
     print("Total rate: %.1f events / second"%(output['EventCount'].value/elapsed))
+    if args.timeStages:
+        print(output['StageTimes'].table())
 
     #util.save(output, f"output{args.mcGroup}_ttgamma_condorFull_4jet.coffea")
 
-    # Compute original number of events for normalization
-    output['InputEventCount'] = processor.defaultdict_accumulator(int)
-    lumi_sfs = {}
-    for dataset_name, dataset_files in job_fileset.items():
-        for filename in dataset_files:
-            with uproot.open(filename) as fhandle:
-                output['InputEventCount'][dataset_name] +=fhandle["hEvents"].values()[2] - fhandle["hEvents"].values()[0]
-
-        # Calculate luminosity scale factor
-        lumi_sfs[dataset_name] = crossSections[dataset_name] * lumis[2016] / output["InputEventCount"][dataset_name]
-
-    for key, obj in output.items():
-        if isinstance(obj, hist.Hist):
-            obj.scale(lumi_sfs, axis="dataset")
-    util.save(output, f"output{args.mcGroup}_ttgamma_condorFull_4jet.coffea")
-
-
+    # Original number of events for normalization
+    output['InputEventCount'] = inputEventCountFuture.result()
+    countPool.shutdown()
+    normalizeMC(output, output['InputEventCount'])
+    saveOutput(output, outputName(args.mcGroup))
 
+clearRunCheckpoints()
@@ -5,7 +5,11 @@ source ttgenv/bin/activate
 tar -zxf ttgamma.tar.gz
 
 head runFullDataset.py
-python runFullDataset.py $1 --condor --chunksize 100000 --workers 2
+# chunk outputs are checkpointed in the job directory, which condor keeps when the job is evicted
+# the chunk sizes are fixed: those of workUnits.json with --workUnit (to keep each of the 2 workers under 3.5 GB,
+# request_memory is 8000 MB, make the plan with --memoryBudget 3.5), --chunksize otherwise, so the MC jet smearing
+# (seeded per chunk) does not depend on the node that runs the job
+python runFullDataset.py "$@" --condor --workers 2 --checkpoint .
 
 pwd
 ls -lrth
@@ -27,6 +27,10 @@ ele_reco_file = uproot.open(f'ele2016/egammaEffi.txt_EGM2D_runBCDEF_passingRECO.
 ele_reco_sf = dense_lookup.dense_lookup(ele_reco_file["EGamma_SF2D"].values, ele_reco_file["EGamma_SF2D"].edges)
 ele_reco_err = dense_lookup.dense_lookup(ele_reco_file["EGamma_SF2D"].variances**.5, ele_reco_file["EGamma_SF2D"].edges)
 
+pho_id_file = uproot.open(f'pho2016/Fall17V2_2016_Tight_photons.root')
+pho_id_sf = dense_lookup.dense_lookup(pho_id_file["EGamma_SF2D"].values, pho_id_file["EGamma_SF2D"].edges)
+pho_id_err = dense_lookup.dense_lookup(pho_id_file["EGamma_SF2D"].variances**0.5, pho_id_file["EGamma_SF2D"].edges)
+
 
 mu_id_vals = 0
 mu_id_err = 0
@@ -64,6 +68,9 @@ util.save(ele_id_err, 'ele_id_err.coffea')
 util.save(ele_reco_sf, 'ele_reco_sf.coffea')
 util.save(ele_reco_err, 'ele_reco_err.coffea')
 
+util.save(pho_id_sf, 'pho_id_sf.coffea')
+util.save(pho_id_err, 'pho_id_err.coffea')
+
 
 util.save(mu_id_sf, 'mu_id_sf.coffea')
 util.save(mu_id_err, 'mu_id_err.coffea')
@@ -1,7 +1,15 @@
 from .version import __version__
-from .processor import TTGammaProcessor
 
 __all__ = [
     '__version__',
     'TTGammaProcessor',
 ]
+
+
+def __getattr__(name):
+    #the processor (and coffea with it) is only imported when it is used,
+    #so that e.g. importing ttgamma.utils.plotting does not pay for it
+    if name == 'TTGammaProcessor':
+        from .processor import TTGammaProcessor
+        return TTGammaProcessor
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
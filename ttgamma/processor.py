@@ -1,79 +1,129 @@
-import time
-
-from coffea import hist, util
+from coffea import hist
 import coffea.processor as processor
 from coffea.nanoevents.methods import nanoaod
-from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
-from coffea.lookup_tools import extractor, dense_lookup
-from coffea.btag_tools import BTagScaleFactor
 from coffea.analysis_tools import PackedSelection
-from coffea.jetmet_tools import CorrectedJetsFactory, JECStack
 
 import awkward as ak
 import numpy as np
-import pickle
-import re
+import functools
 
 from .utils.crossSections import *
 from .utils.genParentage import maxHistoryPDGID
+from .utils.deltaRCleaning import deltaRCleaningMask
+from .utils.triJetMass import bestTriJetMass
+from .utils.btagWeights import btagEventWeights
+from .utils.scaleFactorLookup import MultiLookup, sfUpDown
+from .utils.histFilling import fillSystematics
+from .utils.branchManifest import getBranchManifest
+from .utils.stageTimer import StageTimes, StageTimer, NullStageTimer
+from .utils.datasetMetadata import datasetMetadata
 
 import os.path
 cwd = os.path.dirname(__file__)
 
-taggingEffLookup = util.load(f'{cwd}/utils/taggingEfficienciesDenseLookup.coffea')
+@functools.lru_cache(maxsize=None)
+def getCorrections():
+    """Corrections shared by all TTGammaProcessor instances of this process, loaded on first use
+
+    The JEC/JER inputs, b-tagging scale factors, pileup and b-tagging efficiency lookups and lepton scale factors
+    are read from the precompiled correction bundle (memory-mapped, see utils/correctionBundle.py). coffea's jetmet
+    tools are only imported here, so importing the processor does not pay for them.
+    """
+    from coffea.lookup_tools.evaluator import evaluator
+    from coffea.jetmet_tools import CorrectedJetsFactory, JECStack
+    from .utils.correctionBundle import loadCorrections
+    from .utils.btagScaleFactor import CompiledBTagScaleFactor
+
+    bundle = loadCorrections()
+
+    corrections = {}
+    corrections['taggingEffLookup'] = bundle['taggingEff']
+
+    #DeepCSV medium working point scale factors, the central, up and down values are evaluated together
+    corrections['bJetScales'] = CompiledBTagScaleFactor(**bundle['btagSF'])
+
+    corrections['puLookup'] = bundle['puLookup']
+    corrections['puLookup_Down'] = bundle['puLookup_Down']
+    corrections['puLookup_Up'] = bundle['puLookup_Up']
 
-bJetScales = BTagScaleFactor(f"{cwd}/ScaleFactors/Btag/DeepCSV_2016LegacySF_V1.btag.csv","MEDIUM")
+    Jetevaluator = evaluator(*bundle['jec'])
 
-puLookup = util.load(f'{cwd}/ScaleFactors/puLookup.coffea')
-puLookup_Down = util.load(f'{cwd}/ScaleFactors/puLookup_Down.coffea')
-puLookup_Up = util.load(f'{cwd}/ScaleFactors/puLookup_Up.coffea')
+    jec_names = ['Summer16_07Aug2017_V11_MC_L1FastJet_AK4PFchs','Summer16_07Aug2017_V11_MC_L2Relative_AK4PFchs', 'Summer16_07Aug2017_V11_MC_Uncertainty_AK4PFchs', 'Summer16_25nsV1_MC_PtResolution_AK4PFchs', 'Summer16_25nsV1_MC_SF_AK4PFchs']
 
-Jetext = extractor()
-Jetext.add_weight_sets([
-        f"* * {cwd}/ScaleFactors/JEC/Summer16_07Aug2017_V11_MC_L1FastJet_AK4PFchs.jec.txt",
-        f"* * {cwd}/ScaleFactors/JEC/Summer16_07Aug2017_V11_MC_L2Relative_AK4PFchs.jec.txt",
-        f"* * {cwd}/ScaleFactors/JEC/Summer16_07Aug2017_V11_MC_Uncertainty_AK4PFchs.junc.txt",
-        f"* * {cwd}/ScaleFactors/JEC/Summer16_25nsV1_MC_PtResolution_AK4PFchs.jr.txt",
-        f"* * {cwd}/ScaleFactors/JEC/Summer16_25nsV1_MC_SF_AK4PFchs.jersf.txt",
-        ])
-Jetext.finalize()
-Jetevaluator = Jetext.make_evaluator()
+    jec_inputs = {name: Jetevaluator[name] for name in jec_names}
+    jec_stack = JECStack(jec_inputs)
 
-jec_names = ['Summer16_07Aug2017_V11_MC_L1FastJet_AK4PFchs','Summer16_07Aug2017_V11_MC_L2Relative_AK4PFchs', 'Summer16_07Aug2017_V11_MC_Uncertainty_AK4PFchs', 'Summer16_25nsV1_MC_PtResolution_AK4PFchs', 'Summer16_25nsV1_MC_SF_AK4PFchs']
+    name_map = jec_stack.blank_name_map
+    name_map['JetPt'] = 'pt'
+    name_map['JetMass'] = 'mass'
+    name_map['JetEta'] = 'eta'
+    name_map['JetA'] = 'area'
 
-jec_inputs = {name: Jetevaluator[name] for name in jec_names}
-jec_stack = JECStack(jec_inputs)
+    name_map['ptGenJet'] = 'pt_gen'
+    name_map['ptRaw'] = 'pt_raw'
+    name_map['massRaw'] = 'mass_raw'
+    name_map['Rho'] = 'rho'
 
-name_map = jec_stack.blank_name_map
-name_map['JetPt'] = 'pt'
-name_map['JetMass'] = 'mass'
-name_map['JetEta'] = 'eta'
-name_map['JetA'] = 'area'
+    corrections['jet_factory'] = CorrectedJetsFactory(name_map, jec_stack)
 
-name_map['ptGenJet'] = 'pt_gen'
-name_map['ptRaw'] = 'pt_raw'
-name_map['massRaw'] = 'mass_raw'
-name_map['Rho'] = 'rho'
+    #the scale factors and their errors are stacked into one lookup per binning,
+    #so that all of them are found with a single bin search per lepton
+    corrections['ele_id'] = MultiLookup.fromDenseLookups(sf=bundle['ele_id_sf'], err=bundle['ele_id_err'])
 
-jet_factory = CorrectedJetsFactory(name_map, jec_stack)
+    corrections['ele_reco'] = MultiLookup.fromDenseLookups(sf=bundle['ele_reco_sf'], err=bundle['ele_reco_err'])
+
+    #muon ID and isolation scale factors use the same (eta, pt) binning
+    corrections['mu_id_iso'] = MultiLookup.fromDenseLookups(id_sf=bundle['mu_id_sf'], id_err=bundle['mu_id_err'],
+                                                            iso_sf=bundle['mu_iso_sf'], iso_err=bundle['mu_iso_err'])
+
+    return corrections
 
 
 # Look at ProcessorABC to see the expected methods and what they are supposed to do
 class TTGammaProcessor(processor.ProcessorABC):
 #     def __init__(self, runNum = -1, eventNum = -1):
-    def __init__(self, isMC=False, runNum=-1, eventNum=-1, mcEventYields=None, jetSyst='nominal'):
+    def __init__(self, isMC=False, runNum=-1, eventNum=-1, mcEventYields=None, jetSyst='nominal', preSelection=True, timeStages=False):
         ################################
         # INITIALIZE COFFEA PROCESSOR
         ################################
         ak.behavior.update(nanoaod.behavior)
 
         #self.mcEventYields = mcEventYields
+        #with isMC=None, data or MC is taken from the metadata of each chunk (see utils/datasetMetadata.py),
+        #so that data and MC datasets can be processed together
         self.isMC = isMC
 
-        if not jetSyst in ['nominal','JERUp','JERDown','JESUp','JESDown']:
-            raise Exception(f'{jetSyst} is not in acceptable jet systematic types [nominal, JERUp, JERDown, JESUp, JESDown]')
+        #NanoAOD branches read by process(), see utils/branchManifest.py
+        #with isMC=None, the MC branches (which include all data branches) are read, the branches missing from data files are skipped
+        self.branches = getBranchManifest(True if isMC is None else isMC)
+
+        #jetSyst can be a single jet systematic, a list of them, or 'all' to run every jet systematic in a single pass
+        jetSystTypes = ['nominal','JERUp','JERDown','JESUp','JESDown']
+        if jetSyst == 'all':
+            jetSyst = jetSystTypes
+        jetSystList = [jetSyst] if isinstance(jetSyst, str) else list(jetSyst)
+        for syst in jetSystList:
+            if not syst in jetSystTypes:
+                raise Exception(f'{syst} is not in acceptable jet systematic types [nominal, JERUp, JERDown, JESUp, JESDown]')
 
         self.jetSyst = jetSyst
+        #data has no jet energy corrections applied, so there is only the nominal jet collection
+        #(with isMC=None, this is applied in process() to the data chunks)
+        self.jetSystList = ['nominal'] if isMC is False else jetSystList
+
+        #preSelection can be True (apply all pre-selection stages), False, or a list of the stages to apply
+        preSelectionStages = ['trigger','lepton','photon','jet']
+        if preSelection is True:
+            preSelection = preSelectionStages
+        elif not preSelection:
+            preSelection = []
+        for stage in preSelection:
+            if not stage in preSelectionStages:
+                raise Exception(f'{stage} is not in acceptable pre-selection stages [trigger, lepton, photon, jet]')
+        self.preSelection = list(preSelection)
+
+        #with timeStages, the time spent in each stage of process() is added to output['StageTimes'], see utils/stageTimer.py
+        self.timeStages = timeStages
 
         dataset_axis = hist.Cat("dataset", "Dataset")
         lep_axis = hist.Cat("lepFlavor", "Lepton Flavor")
@@ -112,33 +162,78 @@ class TTGammaProcessor(processor.ProcessorABC):
 
             'EventCount'             : processor.value_accumulator(int),
         })
-
-        self.ele_id_sf = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/ele_id_sf.coffea')
-        self.ele_id_err = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/ele_id_err.coffea')
-
-        self.ele_reco_sf = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/ele_reco_sf.coffea')
-        self.ele_reco_err = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/ele_reco_err.coffea')
-
-
-        self.mu_id_sf = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/mu_id_sf.coffea')
-        self.mu_id_err = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/mu_id_err.coffea')
-
-        self.mu_iso_sf = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/mu_iso_sf.coffea')
-        self.mu_iso_err = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/mu_iso_err.coffea')
-
-        self.mu_trig_sf = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/mu_trig_sf.coffea')
-        self.mu_trig_err = util.load(f'{cwd}/ScaleFactors/MuEGammaScaleFactors/mu_trig_err.coffea')
+        if timeStages:
+            self._accumulator['StageTimes'] = StageTimes()
 
         
     @property
     def accumulator(self):
         return self._accumulator
 
+    def preSelectionMask(self, events):
+        # Cheap pre-selection, using only the raw NanoAOD columns
+        # Every cut is looser than (or identical to) the full selection in process(), so no event that
+        # could enter a histogram is removed, regardless of the jet systematic being processed
+        mask = np.ones(len(events), dtype=bool)
+
+        # events have to pass either the muon or the electron trigger
+        muTrigger  = events.HLT.IsoMu24 | events.HLT.IsoTkMu24
+        eleTrigger = events.HLT.Ele27_WPTight_Gsf
+        if 'trigger' in self.preSelection:
+            mask = mask & ak.to_numpy(muTrigger | eleTrigger)
+
+        # muon events need exactly one tight muon, electron events need no tight muons and at least one
+        # electron passing the pt, eta and ID requirements of the tight electrons
+        if 'lepton' in self.preSelection:
+            nTightMuon = ak.num(events.Muon[(events.Muon.pt>=30) & (abs(events.Muon.eta)<2.4) &
+                                            events.Muon.tightId & (events.Muon.pfRelIso04_all < 0.15)])
+            nEleCandidate = ak.num(events.Electron[(events.Electron.pt>=35) & (abs(events.Electron.eta)<2.1) &
+                                                   (events.Electron.cutBased>=4)])
+            mask = mask & ak.to_numpy((muTrigger & (nTightMuon==1)) | (eleTrigger & (nTightMuon==0) & (nEleCandidate>=1)))
+
+        # every histogram needs a tight or loose photon, both of which have to pass these cuts
+        if 'photon' in self.preSelection:
+            nPhoCandidate = ak.num(events.Photon[(events.Photon.pt>20) & (abs(events.Photon.eta) < 1.4442) &
+                                                 events.Photon.electronVeto & np.invert(events.Photon.pixelSeed)])
+            mask = mask & ak.to_numpy(nPhoCandidate>=1)
+
+        # at least 3 jets passing the eta and ID cuts; no pt cut, since the jet energy corrections change the jet pt
+        if 'jet' in self.preSelection:
+            nJetCandidate = ak.num(events.Jet[(abs(events.Jet.eta)<2.4) & ((events.Jet.jetId >> 1 & 1)==1)])
+            mask = mask & ak.to_numpy(nJetCandidate>=3)
+
+        return mask
+
     def process(self, events):
         output = self.accumulator.identity()
-        output['EventCount'] = len(events)
+        output['EventCount'] += len(events)
 
         dataset = events.metadata['dataset']
+        #the dataset properties are taken from the fileset metadata if it has them, otherwise from the dataset name
+        metadata = events.metadata if 'isMC' in events.metadata else datasetMetadata(dataset)
+        isMC = self.isMC if self.isMC is not None else metadata['isMC']
+        jetSystList = self.jetSystList if isMC else ['nominal']
+
+        stages = StageTimer(output['StageTimes']) if self.timeStages else NullStageTimer()
+        stages.start('corrections')
+
+        #the corrections are only needed (and only loaded, the first time) for MC
+        corrections = getCorrections() if isMC else None
+
+        #################
+        # PRE-SELECTION
+        #################
+        # Drop events that cannot pass the event selection before the gen parentage, overlap removal,
+        # jet energy corrections and scale factors are computed
+        stages.start('preSelection')
+        chunkEvents = events
+        preSelectionMask = np.ones(len(events), dtype=bool)
+        if len(self.preSelection) > 0:
+            preSelectionMask = self.preSelectionMask(events)
+            events = events[preSelectionMask]
+            if len(events)==0:
+                stages.stop()
+                return output
         
         rho = events.fixedGridRhoFastjetAll
 
@@ -147,8 +242,9 @@ class TTGammaProcessor(processor.ProcessorABC):
         #Calculate charged hadron isolation for photons
         events["Photon","chIso"] = (events.Photon.pfRelIso03_chg)*(events.Photon.pt)
 
+        stages.start('genParentage')
         #Calculate the maximum pdgID of any of the particles in the GenPart history
-        if self.isMC:
+        if isMC:
             idx = ak.to_numpy(ak.flatten(abs(events.GenPart.pdgId)))
             par = ak.to_numpy(ak.flatten(events.GenPart.genPartIdxMother))
             num = ak.to_numpy(ak.num(events.GenPart.pdgId))        
@@ -165,25 +261,15 @@ class TTGammaProcessor(processor.ProcessorABC):
         # ZGamma and ZJets
         # We need to remove events from TTbar which are already counted in the phase space in which the TTGamma sample is produced
         # photon with pT> 10 GeV, eta<5, and at least dR>0.1 from other gen objects 
-        doOverlapRemoval = False
-        if 'TTbar' in dataset:
-            doOverlapRemoval = True
-            overlapPt = 10.
-            overlapEta = 5.
-            overlapDR = 0.1
-        if re.search("^W[1234]jets$", dataset):
-            doOverlapRemoval = True
-            overlapPt = 10.
-            overlapEta = 2.5
-            overlapDR = 0.05
-        if 'DYjetsM' in dataset:
-            doOverlapRemoval = True
-            overlapPt = 15.
-            overlapEta = 2.6
-            overlapDR = 0.05
-
+        # (the parameters of each sample are in the dataset metadata, see utils/datasetMetadata.py)
+        stages.start('overlapRemoval')
+        doOverlapRemoval = metadata['overlapRemoval'] is not None
             
         if doOverlapRemoval:
+            overlapPt = metadata['overlapRemoval']['pt']
+            overlapEta = metadata['overlapRemoval']['eta']
+            overlapDR = metadata['overlapRemoval']['dR']
+
             genmotherIdx = events.GenPart.genPartIdxMother
             genpdgid = events.GenPart.pdgId
 
@@ -203,9 +289,8 @@ class TTGammaProcessor(processor.ProcessorABC):
                                       ~((abs(events.GenPart.pdgId)==12) | (abs(events.GenPart.pdgId)==14) | (abs(events.GenPart.pdgId)==16)) &
                                       ~overlapPhoSelect]
 
-            #calculate dR between overlap photons and nearest gen particle
-            phoGen, phoGenDR = overlapPhotons.nearest(finalGen, return_metric = True)
-            phoGenMask = ak.fill_none(phoGenDR > overlapDR, True)
+            #require the overlap photons to be farther than overlapDR from every other final state gen particle
+            phoGenMask = deltaRCleaningMask(overlapPhotons, [finalGen], [overlapDR])
 
             #the event is overlapping with the separate sample if there is an overlap photon passing the dR cut, kinematic cuts, and not coming from hadronic activity
             isOverlap = ak.any(phoGenMask, axis=-1)
@@ -218,6 +303,7 @@ class TTGammaProcessor(processor.ProcessorABC):
         ##################
         # OBJECT SELECTION
         ##################
+        stages.start('objectSelection')
          # PART 1A Uncomment to add in object selection
          
         # 1. ADD SELECTION
@@ -284,13 +370,9 @@ class TTGammaProcessor(processor.ProcessorABC):
 
         #### Calculate deltaR between photon and nearest lepton 
         # Remove photons that are within 0.4 of a lepton
-        # phoMuDR is the delta R value to the nearest muon 
-        # ak.fill_none is used to set the mask value to True when there are no muons in the event
-        phoMu, phoMuDR  = events.Photon.nearest(tightMuon,return_metric=True)
-        phoMuMask = ak.fill_none(phoMuDR > 0.4, True)
-        
-        phoEle, phoEleDR = events.Photon.nearest(tightElectron, return_metric=True)
-        phoEleMask = ak.fill_none(phoEleDR > 0.4, True)
+        # phoLepMask is True for photons farther than 0.4 from every tight muon and every tight electron,
+        # both lepton collections are checked in a single pass (and the mask is True when there are no leptons in the event)
+        phoLepMask = deltaRCleaningMask(events.Photon, [tightMuon, tightElectron], [0.4, 0.4])
 
         #photon selection (no ID requirement used here)
         photonSelect = ((events.Photon.pt>20) & 
@@ -298,7 +380,7 @@ class TTGammaProcessor(processor.ProcessorABC):
                         (events.Photon.isScEtaEE | events.Photon.isScEtaEB) &
                         (events.Photon.electronVeto) & 
                         np.invert(events.Photon.pixelSeed) & 
-                        phoMuMask & phoEleMask
+                        phoLepMask
                        )
         
         #split out the ID requirement, enabling Iso to be inverted for control regions
@@ -328,70 +410,10 @@ class TTGammaProcessor(processor.ProcessorABC):
         #select loosePhoton, the subset of photons passing the photonSelect cut and all photonID cuts without the charged hadron isolation cut applied (photonID_NoChIso)
         loosePhoton = events.Photon[photonSelect & photonID_NoChIso]
         
-
-        ####
-        #update jet kinematics based on jet energy corrections
-        jets = events.Jet
-        if self.isMC:
-            events["Jet","pt_raw"]=(1 - events.Jet.rawFactor)*events.Jet.pt
-            events["Jet","mass_raw"]=(1 - events.Jet.rawFactor)*events.Jet.mass
-            events["Jet","pt_gen"]=ak.values_astype(ak.fill_none(events.Jet.matched_gen.pt, 0), np.float32)
-            events["Jet","rho"]= ak.broadcast_arrays(events.fixedGridRhoFastjetAll, events.Jet.pt)[0]
-
-            events_cache = events.caches[0]
-            corrected_jets = jet_factory.build(events.Jet, lazy_cache=events_cache)
-
-            # 4. ADD SYSTEMATICS
-            #   If processing a jet systematic (based on value of self.jetSyst variable) update the jets to reflect the jet systematic uncertainty variations
-            jets = corrected_jets
-            if(self.jetSyst == 'JERUp'):
-                jets = corrected_jets.JER.up
-            elif(self.jetSyst == 'JERDown'):
-                jets = corrected_jets.JER.down
-            elif(self.jetSyst == 'JESUp'):
-                jets = corrected_jets.JES_jes.up
-            elif(self.jetSyst == 'JESDown'):
-                jets = corrected_jets.JES_jes.down
-        
-
-        ##check dR jet,lepton & jet,photon
-        jetMu, jetMuDR = jets.nearest(tightMuon, return_metric=True)
-        jetMuMask = ak.fill_none(jetMuDR > 0.4, True)
-
-        jetEle, jetEleDR = jets.nearest(tightElectron, return_metric=True)
-        jetEleMask = ak.fill_none(jetEleDR > 0.4, True)
-
-        jetPho, jetPhoDR = jets.nearest(tightPhoton, return_metric=True)
-        jetPhoMask = ak.fill_none(jetPhoDR > 0.4, True)
-
-        # 1. ADD SELECTION
-        #select good jets
-        # jets should have a pt of at least 30 GeV, |eta| < 2.4, pass the medium jet id (bit-wise selected from the jetID variable), and pass the delta R cuts defined above
-        ##medium jet ID cut
-        jetIDbit = 1
-
-        jetSelectNoPt = ((abs(jets.eta)<2.4) &
-                         ((jets.jetId >> jetIDbit & 1)==1) &
-                         jetMuMask  & jetEleMask & jetPhoMask )
-                          
-        
-        #Add 30 GeV pt cut
-        jetSelect = jetSelectNoPt & (jets.pt >= 30) 
-
-        # 1. ADD SELECTION
-        #select the subset of jets passing the jetSelect cuts
-        tightJet = jets[jetSelect]
-
-        # 1. ADD SELECTION
-        # select the subset of tightJet which pass the Deep CSV tagger
-        bTagWP = 0.6321   #2016 DeepCSV working point
-        btagged = tightJet.btagDeepB>bTagWP  
-        bTaggedJet= tightJet[btagged]
-     
-
         #####################
         # EVENT SELECTION
         #####################
+        stages.start('eventSelection')
         ### PART 1B: Uncomment to add event selection
        
         # 1. ADD SELECTION
@@ -447,50 +469,14 @@ class TTGammaProcessor(processor.ProcessorABC):
                                    oneEle & muVeto & 
                                    looseMuonVeto & looseElectronVeto)
 
-        # 1. ADD SELECTION
-        #add selection 'eleSel', for events passing the electron event selection, and muSel for those passing the muon event selection
-        #  ex: selection.add('testSelection', event_mask)
-    
-        #create a selection object
-        selection = PackedSelection()
-
-        selection.add('eleSel', electron_eventSelection)
-        selection.add('muSel', muon_eventSelection)
-
-        #add two jet selection criteria
-        #   First, 'jetSel' which selects events with at least 4 tightJet and at least one bTaggedJet
-        nJets = 4
-        selection.add('jetSel',    (ak.num(tightJet) >= nJets) & (ak.num(bTaggedJet) >= 1)) 
-        #   Second, 'jetSel_3j0t' which selects events with at least 3 tightJet and exactly zero bTaggedJet
-        selection.add('jetSel_3j0t', (ak.num(tightJet) >= 3)     & (ak.num(bTaggedJet) == 0)) 
-
-        # add selection for events with exactly 0 tight photons
-        selection.add('zeroPho', (ak.num(tightPhoton) == 0))
-
-        # add selection for events with exactly 1 tight photon
-        selection.add('onePho',  (ak.num(tightPhoton) == 1))
-
-        # add selection for events with exactly 1 loose photon
-        selection.add('loosePho',(ak.num(loosePhoton) == 1))
-       
-
         ##################
         # EVENT VARIABLES
         ##################
+        stages.start('eventVariables')
 
         # PART 2A: Uncomment to begin implementing event variables
         
         # 2. DEFINE VARIABLES
-        ## Define M3, mass of 3-jet pair with highest pT
-        # find all possible combinations of 3 tight jets in the events 
-        #hint: using the ak.combinations(array,n) method chooses n unique items from array. Use the "fields" option to define keys you can use to access the items
-        triJet= ak.combinations(tightJet,3,fields=["first","second","third"])
-        #Sum together jets from the triJet object and find its pt and mass
-        triJetPt = (triJet.first + triJet.second + triJet.third).pt
-        triJetMass = (triJet.first + triJet.second + triJet.third).mass
-        # define the M3 variable, the triJetMass of the combination with the highest triJetPt value (using the .argmax() method with axis=-1,keepdims=True)
-        M3 = triJetMass[ak.argmax(triJetPt,axis=-1,keepdims=True)]
-
         leadingMuon = tightMuon[:,:1]
         leadingElectron = tightElectron[:,:1]
 
@@ -519,6 +505,7 @@ class TTGammaProcessor(processor.ProcessorABC):
         ###################
         # PHOTON CATEGORIES
         ###################
+        stages.start('photonCategories')
                       
         # Define photon category for each event
         phoCategory = np.ones(len(events))
@@ -526,14 +513,19 @@ class TTGammaProcessor(processor.ProcessorABC):
 
         # PART 2B: Uncomment to begin implementing photon categorization
                
-        if self.isMC:
+        if isMC:
+            #the matched gen particles are taken from events.GenPart by their index, rather than with .matched_gen,
+            #so that they carry the maxParent field also when events has been reduced by the pre-selection
+            leadingPhotonGen = events.GenPart[ak.mask(leadingPhoton.genPartIdx, leadingPhoton.genPartIdx>=0)]
+            leadingPhotonLooseGen = events.GenPart[ak.mask(leadingPhotonLoose.genPartIdx, leadingPhotonLoose.genPartIdx>=0)]
+
             #### Photon categories, using pdgID of the matched gen particle for the leading photon in the event
             # reco photons matched to a generated photon
-            matchedPho = ak.any(leadingPhoton.matched_gen.pdgId==22, axis=-1)
+            matchedPho = ak.any(leadingPhotonGen.pdgId==22, axis=-1)
             # reco photons really generated as electrons
-            matchedEle =  ak.any(abs(leadingPhoton.matched_gen.pdgId)==11, axis=-1)
+            matchedEle =  ak.any(abs(leadingPhotonGen.pdgId)==11, axis=-1)
             # if the gen photon has a PDG ID > 25 in it's history, it has a hadronic parent
-            hadronicParent = ak.any(leadingPhoton.matched_gen.maxParent>25, axis=-1)
+            hadronicParent = ak.any(leadingPhotonGen.maxParent>25, axis=-1)
             
             #####
             # 2. DEFINE VARIABLES
@@ -552,11 +544,11 @@ class TTGammaProcessor(processor.ProcessorABC):
         
             # do photon matching for loose photons as well
             # reco photons matched to a generated photon 
-            matchedPhoLoose = ak.any(leadingPhotonLoose.matched_gen.pdgId==22, axis=-1)
+            matchedPhoLoose = ak.any(leadingPhotonLooseGen.pdgId==22, axis=-1)
             # reco photons really generated as electrons 
-            matchedEleLoose =  ak.any(abs(leadingPhotonLoose.matched_gen.pdgId)==11, axis=-1)
+            matchedEleLoose =  ak.any(abs(leadingPhotonLooseGen.pdgId)==11, axis=-1)
             # if the gen photon has a PDG ID > 25 in it's history, it has a hadronic parent
-            hadronicParentLoose = ak.any(leadingPhotonLoose.matched_gen.maxParent>25, axis=-1)
+            hadronicParentLoose = ak.any(leadingPhotonLooseGen.maxParent>25, axis=-1)
 
             #####
             # 2. DEFINE VARIABLES
@@ -576,11 +568,12 @@ class TTGammaProcessor(processor.ProcessorABC):
         ################
         # EVENT WEIGHTS
         ################
+        stages.start('eventWeights')
 
         #create a processor Weights object, with the same length as the number of events in the chunk
         weights = processor.Weights(len(events))
 
-        if self.isMC:
+        if isMC:
             ## Lumi weighting is done in postprocessing in our workflow
             # lumiWeight = np.ones(len(events))
             # nMCevents = self.mcEventYields[datasetFull]
@@ -596,79 +589,42 @@ class TTGammaProcessor(processor.ProcessorABC):
             # calculate pileup weights and variations
             # use the puLookup, puLookup_Up, and puLookup_Down lookup functions to find the nominal and up/down systematic weights
             # the puLookup dictionary is called with the full dataset name (datasetFull) and the number of true interactions (Pileup.nTrueInt)
-            datasetFull = dataset+'_2016' # Name for pileup lookup includes the year
-            if not datasetFull in puLookup:
+            datasetFull = metadata['puKey'] # Name for pileup lookup includes the year
+            if not datasetFull in corrections['puLookup']:
                 print("WARNING : Using TTGamma_SingleLept_2016 pileup distribution instead of {}".format(datasetFull))
                 datasetFull = "TTGamma_SingleLept_2016"
 
-            puWeight = puLookup[datasetFull](events.Pileup.nTrueInt)
-            puWeight_Up = puLookup_Up[datasetFull](events.Pileup.nTrueInt)
-            puWeight_Down = puLookup_Down[datasetFull](events.Pileup.nTrueInt)
+            puWeight = corrections['puLookup'][datasetFull](events.Pileup.nTrueInt)
+            puWeight_Up = corrections['puLookup_Up'][datasetFull](events.Pileup.nTrueInt)
+            puWeight_Down = corrections['puLookup_Down'][datasetFull](events.Pileup.nTrueInt)
 
             # add the puWeight and it's uncertainties to the weights container
             weights.add('puWeight',weight=puWeight, weightUp=puWeight_Up, weightDown=puWeight_Down)
 
-            #btag key name
-            #name / working Point / type / systematic / jetType
-            #  ... / 0-loose 1-medium 2-tight / comb,mujets,iterativefit / central,up,down / 0-b 1-c 2-udcsg 
-
-            bJetSF = bJetScales('central',tightJet.hadronFlavour, abs(tightJet.eta), tightJet.pt)
-            bJetSF_up = bJetScales('up',tightJet.hadronFlavour, abs(tightJet.eta), tightJet.pt)
-            bJetSF_down = bJetScales('down',tightJet.hadronFlavour, abs(tightJet.eta), tightJet.pt)
-
-            ## mc efficiency lookup, data efficiency is eff* scale factor
-            taggingName = "TTGamma_SingleLept_2016"
-            if datasetFull in taggingEffLookup:
-                taggingName = datasetFull
-            btagEfficiencies = taggingEffLookup[taggingName](tightJet.hadronFlavour,tightJet.pt,abs(tightJet.eta))
-            btagEfficienciesData = btagEfficiencies*bJetSF
-            btagEfficienciesData_up   = btagEfficiencies*bJetSF_up
-            btagEfficienciesData_down = btagEfficiencies*bJetSF_down
-
-            ##probability is the product of all efficiencies of tagged jets, times product of 1-eff for all untagged jets
-            ## https://twiki.cern.ch/twiki/bin/view/CMS/BTagSFMethods#1a_Event_reweighting_using_scale
-            pMC          = ak.prod(btagEfficiencies[btagged], axis=-1)           * ak.prod((1.-btagEfficiencies[np.invert(btagged)]), axis=-1) 
-            pData        = ak.prod(btagEfficienciesData[btagged], axis=-1)       * ak.prod((1.-btagEfficienciesData[np.invert(btagged)]),axis=-1)
-            pData_up   = ak.prod(btagEfficienciesData_up[btagged], axis=-1)  * ak.prod((1.-btagEfficienciesData_up[np.invert(btagged)]),axis=-1)
-            pData_down = ak.prod(btagEfficienciesData_down[btagged],axis=-1) * ak.prod((1.-btagEfficienciesData_down[np.invert(btagged)]),axis=-1)
-
-            pMC = ak.where(pMC==0,1,pMC)
-            btagWeight = pData/pMC
-            btagWeight_up = pData_up/pMC
-            btagWeight_down = pData_down/pMC
-  
-            weights.add('btagWeight',weight=btagWeight, weightUp=btagWeight_up, weightDown=btagWeight_down)
-
-            eleID = self.ele_id_sf(tightElectron.eta, tightElectron.pt)
-            eleIDerr = self.ele_id_err(tightElectron.eta, tightElectron.pt)
-            eleRECO = self.ele_reco_sf(tightElectron.eta, tightElectron.pt)
-            eleRECOerr = self.ele_reco_err(tightElectron.eta, tightElectron.pt)
+            eleID = corrections['ele_id'](tightElectron.eta, tightElectron.pt)
+            eleRECO = corrections['ele_reco'](tightElectron.eta, tightElectron.pt)
             
-            eleSF = ak.prod((eleID*eleRECO), axis=-1)
-            eleSF_up   = ak.prod(((eleID + eleIDerr) * (eleRECO + eleRECOerr)), axis=-1)
-            eleSF_down = ak.prod(((eleID - eleIDerr) * (eleRECO - eleRECOerr)), axis=-1)
+            eleSF, eleSF_up, eleSF_down = sfUpDown((eleID['sf'], eleID['err']), (eleRECO['sf'], eleRECO['err']))
 
             # 4. SYSTEMATICS
             # add electron efficiency weights to the weight container
             weights.add('eleEffWeight',weight=eleSF,weightUp=eleSF_up,weightDown=eleSF_down)
 
         
-            muID = self.mu_id_sf(tightMuon.eta, tightMuon.pt)
-            muIDerr = self.mu_id_err(tightMuon.eta, tightMuon.pt)
-            muIso = self.mu_iso_sf(tightMuon.eta, tightMuon.pt)
-            muIsoerr = self.mu_iso_err(tightMuon.eta, tightMuon.pt)
-            muTrig = self.mu_iso_sf(abs(tightMuon.eta), tightMuon.pt)
-            muTrigerr = self.mu_iso_err(abs(tightMuon.eta), tightMuon.pt)
+            muIDIso = corrections['mu_id_iso'](tightMuon.eta, tightMuon.pt)
+            #note: the trigger term has always been taken from the isolation table evaluated at |eta|, this is kept as is here
+            muTrig = corrections['mu_id_iso'](abs(tightMuon.eta), tightMuon.pt)
             
-            muSF = ak.prod((muID*muIso*muTrig), axis=-1)
-            muSF_up   = ak.prod(((muID + muIDerr) * (muIso + muIsoerr) * (muTrig + muTrigerr)), axis=-1)
-            muSF_down = ak.prod(((muID - muIDerr) * (muIso - muIsoerr) * (muTrig - muTrigerr)), axis=-1)
+            muSF, muSF_up, muSF_down = sfUpDown((muIDIso['id_sf'], muIDIso['id_err']),
+                                                (muIDIso['iso_sf'], muIDIso['iso_err']),
+                                                (muTrig['iso_sf'], muTrig['iso_err']))
 
             # 4. SYSTEMATICS
             # add muon efficiency weights to the weight container
             weights.add('muEffWeight',weight= muSF,weightUp=muSF_up, weightDown=muSF_down)
 
 
+            stages.start('generatorWeights')
             #in some samples, generator systematics are not available, in those case the systematic weights of 1. are used
             if ak.mean(ak.num(events.PSWeight))==1:
                 weights.add('ISR',    weight=np.ones(len(events)),weightUp=np.ones(len(events)),weightDown=np.ones(len(events)))
@@ -708,47 +664,180 @@ class TTGammaProcessor(processor.ProcessorABC):
                 weights.add('FSR',weight=np.ones(len(events)), weightUp=psWeights[:,3], weightDown=psWeights[:,1])
             
 
-        ###################
-        # FILL HISTOGRAMS
-        ###################
-        # PART 3: Uncomment to add histograms
+        ####
+        stages.start('jetCorrections')
+        #update jet kinematics based on jet energy corrections
+        #the corrected jets are only built once per chunk, every jet systematic in jetSystList is taken from them
+        #the JER smearing draws its random numbers for all jets in the chunk, with a seed taken from the jets themselves,
+        #so the jets of the full chunk are passed to the (lazy) jet factory and the pre-selection is applied afterwards
+        #to keep the smeared jets identical to running without the pre-selection
+        if isMC:
+            chunkEvents["Jet","pt_raw"]=(1 - chunkEvents.Jet.rawFactor)*chunkEvents.Jet.pt
+            chunkEvents["Jet","mass_raw"]=(1 - chunkEvents.Jet.rawFactor)*chunkEvents.Jet.mass
+            chunkEvents["Jet","pt_gen"]=ak.values_astype(ak.fill_none(chunkEvents.Jet.matched_gen.pt, 0), np.float32)
+            chunkEvents["Jet","rho"]= ak.broadcast_arrays(chunkEvents.fixedGridRhoFastjetAll, chunkEvents.Jet.pt)[0]
+
+            events_cache = chunkEvents.caches[0]
+            corrected_jets = corrections['jet_factory'].build(chunkEvents.Jet, lazy_cache=events_cache)[preSelectionMask]
 
+        ##check dR jet,lepton & jet,photon
+        stages.start('jetCleaning')
+        #jetCleanMask is True for jets farther than 0.4 from every tight muon, tight electron and tight photon
+        #the jet energy corrections and systematics only change the jet pt and mass, not eta and phi,
+        #so the mask is computed once and used for every jet systematic
+        jetCleanMask = deltaRCleaningMask(events.Jet, [tightMuon, tightElectron, tightPhoton], [0.4, 0.4, 0.4])
+
+        #jet selection, b-tag weights, M3 and the histogram fills are repeated for each jet systematic
+        for jetSyst in jetSystList:
+            stages.start('jetSelection')
+            jets = events.Jet
+            if isMC:
+                # 4. ADD SYSTEMATICS
+                #   If processing a jet systematic (based on value of jetSyst variable) update the jets to reflect the jet systematic uncertainty variations
+                jets = corrected_jets
+                if(jetSyst == 'JERUp'):
+                    jets = corrected_jets.JER.up
+                elif(jetSyst == 'JERDown'):
+                    jets = corrected_jets.JER.down
+                elif(jetSyst == 'JESUp'):
+                    jets = corrected_jets.JES_jes.up
+                elif(jetSyst == 'JESDown'):
+                    jets = corrected_jets.JES_jes.down
+
+            # 1. ADD SELECTION
+            #select good jets
+            # jets should have a pt of at least 30 GeV, |eta| < 2.4, pass the medium jet id (bit-wise selected from the jetID variable), and pass the delta R cuts defined above
+            ##medium jet ID cut
+            jetIDbit = 1
+
+            jetSelectNoPt = ((abs(jets.eta)<2.4) &
+                             ((jets.jetId >> jetIDbit & 1)==1) &
+                             jetCleanMask )
+                          
         
-        systList = ['noweight','nominal']
-
-        # PART 4: SYSTEMATICS
-        # uncomment the full list after systematics have been implemented        
-        #systList = ['noweight','nominal','puWeightUp','puWeightDown','muEffWeightUp','muEffWeightDown','eleEffWeightUp','eleEffWeightDown','btagWeightUp','btagWeightDown','ISRUp', 'ISRDown', 'FSRUp', 'FSRDown', 'PDFUp', 'PDFDown', 'Q2ScaleUp', 'Q2ScaleDown']
-        systList = []
-        if self.isMC:
-            if self.jetSyst == 'nominal':
-                systList = ['nominal','muEffWeightUp','muEffWeightDown','eleEffWeightUp','eleEffWeightDown','ISRUp', 'ISRDown', 'FSRUp', 'FSRDown', 'PDFUp', 'PDFDown', 'Q2ScaleUp', 'Q2ScaleDown','puWeightUp','puWeightDown','btagWeightUp','btagWeightDown']
-                #systList = ["nominal"]
-            else:
-                systList=[self.jetSyst]
-        else:
-            systList = ["noweight"]
+            #Add 30 GeV pt cut
+            jetSelect = jetSelectNoPt & (jets.pt >= 30) 
+
+            # 1. ADD SELECTION
+            #select the subset of jets passing the jetSelect cuts
+            tightJet = jets[jetSelect]
+
+            # 1. ADD SELECTION
+            # select the subset of tightJet which pass the Deep CSV tagger
+            bTagWP = 0.6321   #2016 DeepCSV working point
+            btagged = tightJet.btagDeepB>bTagWP  
+            bTaggedJet= tightJet[btagged]
+     
 
-        #Fill temp hist for testing purposes
-#        output['all_photon_pt'].fill(dataset=dataset,
-#                                     pt=ak.flatten(tightPhoton.pt[:,:1]))
+            # 1. ADD SELECTION
+            #add selection 'eleSel', for events passing the electron event selection, and muSel for those passing the muon event selection
+            #  ex: selection.add('testSelection', event_mask)
+    
+            #create a selection object
+            selection = PackedSelection()
 
-        
-        for syst in systList:
+            selection.add('eleSel', electron_eventSelection)
+            selection.add('muSel', muon_eventSelection)
 
-            #find the event weight to be used when filling the histograms    
-            weightSyst = syst
+            #add two jet selection criteria
+            #   First, 'jetSel' which selects events with at least 4 tightJet and at least one bTaggedJet
+            nJets = 4
+            selection.add('jetSel',    (ak.num(tightJet) >= nJets) & (ak.num(bTaggedJet) >= 1)) 
+            #   Second, 'jetSel_3j0t' which selects events with at least 3 tightJet and exactly zero bTaggedJet
+            selection.add('jetSel_3j0t', (ak.num(tightJet) >= 3)     & (ak.num(bTaggedJet) == 0)) 
 
-            #in the case of 'nominal', or the jet energy systematics, no weight systematic variation is used (weightSyst=None)
-            if syst in ['nominal','JERUp','JERDown','JESUp','JESDown']:
-                weightSyst=None
-                
-            if syst=='noweight':
-                evtWeight = np.ones(len(events))
+            # add selection for events with exactly 0 tight photons
+            selection.add('zeroPho', (ak.num(tightPhoton) == 0))
+
+            # add selection for events with exactly 1 tight photon
+            selection.add('onePho',  (ak.num(tightPhoton) == 1))
+
+            # add selection for events with exactly 1 loose photon
+            selection.add('loosePho',(ak.num(loosePhoton) == 1))
+       
+
+            stages.start('btagWeights')
+            #the b-tag weights depend on the jets, so they are kept in their own container for each jet systematic,
+            #and multiplied with the weights shared by all jet systematics when the event weights are computed
+            jetWeights = processor.Weights(len(events))
+
+            if isMC:
+                #btag key name
+                #name / working Point / type / systematic / jetType
+                #  ... / 0-loose 1-medium 2-tight / comb,mujets,iterativefit / central,up,down / 0-b 1-c 2-udcsg 
+
+                #bJetSF has the fields central, up and down, all evaluated with a single bin search per jet
+                bJetSF = corrections['bJetScales'](tightJet.hadronFlavour, abs(tightJet.eta), tightJet.pt)
+
+                ## mc efficiency lookup, data efficiency is eff* scale factor
+                taggingName = "TTGamma_SingleLept_2016"
+                if metadata['btagEffKey'] in corrections['taggingEffLookup']:
+                    taggingName = metadata['btagEffKey']
+                btagEfficiencies = corrections['taggingEffLookup'][taggingName](tightJet.hadronFlavour,tightJet.pt,abs(tightJet.eta))
+
+                ##probability is the product of all efficiencies of tagged jets, times product of 1-eff for all untagged jets
+                ## https://twiki.cern.ch/twiki/bin/view/CMS/BTagSFMethods#1a_Event_reweighting_using_scale
+                ## the weights pData/pMC for the nominal SF and all SF variations are computed together, in a single pass over the jets
+                btagWeights = btagEventWeights(tightJet, btagged, btagEfficiencies, bJetSF.central, bJetSF.up, bJetSF.down)
+                btagWeight = btagWeights[:,0]
+
+                #'btagWeight' varies the SF of all jets together
+                jetWeights.add('btagWeight',weight=btagWeight, weightUp=btagWeights[:,1], weightDown=btagWeights[:,2])
+
+                #the heavy (b and c jet) and light jet SF variations are added as separate systematics
+                #their nominal value is already included in 'btagWeight', so only the ratio to the nominal weight is added here
+                #(events with a nominal weight of 0 have a total weight of 0 anyway)
+                btagWeightNonZero = np.where(btagWeight!=0, btagWeight, 1.)
+                jetWeights.add('btagWeight_heavy',weight=np.ones(len(events)), weightUp=btagWeights[:,3]/btagWeightNonZero, weightDown=btagWeights[:,4]/btagWeightNonZero)
+                jetWeights.add('btagWeight_light',weight=np.ones(len(events)), weightUp=btagWeights[:,5]/btagWeightNonZero, weightDown=btagWeights[:,6]/btagWeightNonZero)
+
+            ###################
+            # FILL HISTOGRAMS
+            ###################
+            stages.start('histogramFilling')
+            # PART 3: Uncomment to add histograms
+
+        
+            systList = ['noweight','nominal']
+
+            # PART 4: SYSTEMATICS
+            # uncomment the full list after systematics have been implemented        
+            #systList = ['noweight','nominal','puWeightUp','puWeightDown','muEffWeightUp','muEffWeightDown','eleEffWeightUp','eleEffWeightDown','btagWeightUp','btagWeightDown','ISRUp', 'ISRDown', 'FSRUp', 'FSRDown', 'PDFUp', 'PDFDown', 'Q2ScaleUp', 'Q2ScaleDown']
+            systList = []
+            if isMC:
+                if jetSyst == 'nominal':
+                    systList = ['nominal','muEffWeightUp','muEffWeightDown','eleEffWeightUp','eleEffWeightDown','ISRUp', 'ISRDown', 'FSRUp', 'FSRDown', 'PDFUp', 'PDFDown', 'Q2ScaleUp', 'Q2ScaleDown','puWeightUp','puWeightDown','btagWeightUp','btagWeightDown',
+                                'btagWeight_heavyUp','btagWeight_heavyDown','btagWeight_lightUp','btagWeight_lightDown']
+                    #systList = ["nominal"]
+                else:
+                    systList=[jetSyst]
             else:
-                # call weights.weight() with the name of the systematic to be varied
-                evtWeight = weights.weight(weightSyst)
+                systList = ["noweight"]
+
+            #Fill temp hist for testing purposes
+#            output['all_photon_pt'].fill(dataset=dataset,
+#                                         pt=ak.flatten(tightPhoton.pt[:,:1]))
 
+        
+            #find the event weight to be used when filling the histograms, for all systematics at once
+            #weightMatrix has one row per event and one column per entry in systList
+            weightMatrix = np.ones((len(events), len(systList)))
+            for i, syst in enumerate(systList):
+                weightSyst = syst
+
+                #in the case of 'nominal', or the jet energy systematics, no weight systematic variation is used (weightSyst=None)
+                if syst in ['nominal','JERUp','JERDown','JESUp','JESDown']:
+                    weightSyst=None
+                
+                if syst!='noweight':
+                    # call weights.weight() with the name of the systematic to be varied
+                    # (the b-tag systematics vary jetWeights, the others the shared weights)
+                    jetWeightSyst = weightSyst if weightSyst is not None and weightSyst.startswith('btagWeight') else None
+                    eventWeightSyst = weightSyst if jetWeightSyst is None else None
+                    weightMatrix[:,i] = weights.weight(eventWeightSyst) * jetWeights.weight(jetWeightSyst)
+
+            #the event selections and the variables that are filled do not depend on the weight systematic,
+            #so they are only computed once, and every histogram is filled for all of systList with fillSystematics
             #loop over both electron and muon selections
             for lepton in ['electron','muon']:
                 if lepton=='electron':
@@ -765,38 +854,38 @@ class TTGammaProcessor(processor.ProcessorABC):
 
                 # 3. FILL HISTOGRAMS
                 #    fill photon_pt and photon_eta, using the tightPhotons array, from events passing the phosel selection
-        
-                output['photon_pt'].fill(dataset=dataset,
-                                         pt=ak.flatten(tightPhoton[phosel].pt,-1),
-                                         category=phoCategory[phosel],
-                                         lepFlavor=lepton,
-                                         systematic=syst,
-                                         weight=evtWeight[phosel])           
-    
-                output['photon_eta'].fill(dataset=dataset,
-                                          eta=ak.flatten(tightPhoton[phosel].eta,-1),
-                                          category=phoCategory[phosel],
-                                          lepFlavor=lepton,
-                                          systematic=syst,
-                                          weight=evtWeight[phosel])
-                
+                selPhoton = tightPhoton[phosel]
+                fillSystematics(output['photon_pt'], systList, weightMatrix[phosel],
+                                dataset=dataset,
+                                pt=ak.flatten(selPhoton.pt,-1),
+                                category=phoCategory[phosel],
+                                lepFlavor=lepton)
+
+                fillSystematics(output['photon_eta'], systList, weightMatrix[phosel],
+                                dataset=dataset,
+                                eta=ak.flatten(selPhoton.eta,-1),
+                                category=phoCategory[phosel],
+                                lepFlavor=lepton)
+
                 #    fill photon_chIso histogram, using the loosePhotons array (photons passing all cuts, except the charged hadron isolation cuts)
-                output['photon_chIso'].fill(dataset=dataset,
-                                            chIso=ak.flatten(loosePhoton[phoselLoose].chIso),
-                                            category=phoCategoryLoose[phoselLoose],
-                                            lepFlavor=lepton,
-                                            systematic=syst,
-                                            weight=evtWeight[phoselLoose])
-                
+                fillSystematics(output['photon_chIso'], systList, weightMatrix[phoselLoose],
+                                dataset=dataset,
+                                chIso=ak.flatten(loosePhoton[phoselLoose].chIso),
+                                category=phoCategoryLoose[phoselLoose],
+                                lepFlavor=lepton)
+
+                ## Define M3, mass of 3-jet pair with highest pT
+                # loops over all combinations of 3 tight jets and keeps the triJetMass of the combination with the highest triJetPt
+                # M3 is only computed for the events passing the phosel selection, and is -1 for events with fewer than 3 jets
+                M3 = bestTriJetMass(tightJet[phosel], default=-1)
+
                 #    fill M3 histogram, for events passing the phosel selection
-                # Note that for M3, ak.fill_none() is also needed so there is at least one entry per event
-                output['M3'].fill(dataset=dataset,
-                                  M3=ak.flatten(ak.fill_none(M3[phosel],-1)),
-                                  category=phoCategory[phosel],
-                                  lepFlavor=lepton,
-                                  systematic=syst,
-                                  weight=evtWeight[phosel])
-                                    
+                fillSystematics(output['M3'], systList, weightMatrix[phosel],
+                                dataset=dataset,
+                                M3=M3,
+                                category=phoCategory[phosel],
+                                lepFlavor=lepton)
+
             # 3. GET HISTOGRAM EVENT SELECTION
             #  use the selection.all() method to select events passing the eleSel or muSel selection, 
             # and the 3-jet 0-btag selection, and have exactly one photon
@@ -805,22 +894,18 @@ class TTGammaProcessor(processor.ProcessorABC):
             phosel_3j0t_mu = selection.all(*('muSel', "jetSel_3j0t", 'onePho') )
             
             #Fill the photon_lepton_mass histogram for events passing phosel_3j0t_e and phosel_3j0t_mu
-            output['photon_lepton_mass_3j0t'].fill(dataset=dataset,
-                                                   mass=ak.flatten(egammaMass[phosel_3j0t_e]),
-                                                   category=phoCategory[phosel_3j0t_e],
-                                                   lepFlavor='electron',
-                                                   systematic=syst,
-                                                   weight=evtWeight[phosel_3j0t_e])
-            output['photon_lepton_mass_3j0t'].fill(dataset=dataset,
-                                                   mass=ak.flatten(mugammaMass[phosel_3j0t_mu]),
-                                                   category=phoCategory[phosel_3j0t_mu],
-                                                   lepFlavor='muon',
-                                                   systematic=syst,
-                                                   weight=evtWeight[phosel_3j0t_mu])
-        
-
-
-
+            fillSystematics(output['photon_lepton_mass_3j0t'], systList, weightMatrix[phosel_3j0t_e],
+                            dataset=dataset,
+                            mass=ak.flatten(egammaMass[phosel_3j0t_e]),
+                            category=phoCategory[phosel_3j0t_e],
+                            lepFlavor='electron')
+            fillSystematics(output['photon_lepton_mass_3j0t'], systList, weightMatrix[phosel_3j0t_mu],
+                            dataset=dataset,
+                            mass=ak.flatten(mugammaMass[phosel_3j0t_mu]),
+                            category=phoCategory[phosel_3j0t_mu],
+                            lepFlavor='muon')
+
+        stages.stop()
         return output
 
     def postprocess(self, accumulator):
@@ -0,0 +1,56 @@
+#NanoAOD branches read by TTGammaProcessor
+#The counter branches (nMuon, nJet, ...) are needed by NanoAODSchema to build the collections
+
+#branches used for both data and MC
+dataBranches = [
+    'fixedGridRhoFastjetAll',
+    'HLT_IsoMu24', 'HLT_IsoTkMu24', 'HLT_Ele27_WPTight_Gsf',
+
+    'nMuon',
+    'Muon_pt', 'Muon_eta', 'Muon_phi', 'Muon_mass', 'Muon_charge',
+    'Muon_tightId', 'Muon_pfRelIso04_all', 'Muon_isPFcand', 'Muon_isTracker', 'Muon_isGlobal',
+
+    'nElectron',
+    'Electron_pt', 'Electron_eta', 'Electron_phi', 'Electron_mass', 'Electron_charge',
+    'Electron_cutBased', 'Electron_dxy', 'Electron_dz',
+
+    'nPhoton',
+    'Photon_pt', 'Photon_eta', 'Photon_phi', 'Photon_mass',
+    'Photon_pfRelIso03_chg', 'Photon_isScEtaEE', 'Photon_isScEtaEB', 'Photon_electronVeto', 'Photon_pixelSeed',
+    'Photon_cutBased', 'Photon_vidNestedWPBitmap',
+
+    'nJet',
+    'Jet_pt', 'Jet_eta', 'Jet_phi', 'Jet_mass', 'Jet_jetId', 'Jet_btagDeepB',
+]
+
+#additional branches only used for MC: jet energy corrections, gen matching, and event weights
+mcOnlyBranches = [
+    'Jet_rawFactor', 'Jet_area', 'Jet_hadronFlavour', 'Jet_genJetIdx',
+    'Photon_genPartIdx',
+
+    'nGenJet',
+    'GenJet_pt', 'GenJet_eta', 'GenJet_phi', 'GenJet_mass',
+
+    'nGenPart',
+    'GenPart_pt', 'GenPart_eta', 'GenPart_phi', 'GenPart_mass',
+    'GenPart_pdgId', 'GenPart_status', 'GenPart_genPartIdxMother',
+
+    'Pileup_nTrueInt',
+    'Generator_weight', 'LHEWeight_originalXWGTUP',
+    'nPSWeight', 'PSWeight',
+    'nLHEPdfWeight', 'LHEPdfWeight',
+    'nLHEScaleWeight', 'LHEScaleWeight',
+]
+
+mcBranches = dataBranches + mcOnlyBranches
+
+
+def getBranchManifest(isMC):
+    if isMC:
+        return list(mcBranches)
+    return list(dataBranches)
+
+
+def unlistedBranches(accessed, branches):
+    #branches that were read but are missing from the manifest
+    return sorted(set(accessed) - set(branches))
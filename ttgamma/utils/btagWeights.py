@@ -0,0 +1,90 @@
+import numpy as np
+import numba
+import awkward as ak
+
+#columns of the weight array returned by btagEventWeights
+btagVariations = ['nominal', 'up', 'down', 'heavyUp', 'heavyDown', 'lightUp', 'lightDown']
+
+@numba.njit(parallel=True)
+def btagWeightKernel(eff, sf, sfUp, sfDown, flavour, tagged, offsets):
+    nEvents = len(offsets)-1
+    nVar = 7
+    weights = np.ones((nEvents, nVar))
+
+    #the products of the per-jet probabilities are accumulated as a sum of logs and a sign,
+    #(1-eff*SF) is negative when eff*SF>1, and a probability of exactly 0 is tracked separately
+    logData = np.zeros((nEvents, nVar))
+    signData = np.ones((nEvents, nVar))
+    zeroData = np.zeros((nEvents, nVar), np.bool_)
+
+    #i is the event number
+    for i in numba.prange(nEvents):
+        logMC = 0.
+        signMC = 1.
+        zeroMC = False
+        for j in range(offsets[i], offsets[i+1]):
+            #b and c jets (hadronFlavour 5 and 4) are varied in the heavy systematics, udsg jets (hadronFlavour 0) in the light ones
+            heavy = flavour[j] != 0
+            for v in range(nVar):
+                jetSF = sf[j]
+                if v == 1 or (v == 3 and heavy) or (v == 5 and not heavy):
+                    jetSF = sfUp[j]
+                elif v == 2 or (v == 4 and heavy) or (v == 6 and not heavy):
+                    jetSF = sfDown[j]
+
+                #probability is the product of all efficiencies of tagged jets, times product of 1-eff for all untagged jets
+                p = eff[j]*jetSF
+                if not tagged[j]:
+                    p = 1. - p
+                if p == 0:
+                    zeroData[i,v] = True
+                else:
+                    logData[i,v] += np.log(np.abs(p))
+                    if p < 0:
+                        signData[i,v] = -signData[i,v]
+
+            p = eff[j]
+            if not tagged[j]:
+                p = 1. - p
+            if p == 0:
+                zeroMC = True
+            else:
+                logMC += np.log(np.abs(p))
+                if p < 0:
+                    signMC = -signMC
+
+        #events with a MC probability of 0 get the data probability as weight (pMC is set to 1)
+        if zeroMC:
+            logMC = 0.
+            signMC = 1.
+        for v in range(nVar):
+            if zeroData[i,v]:
+                weights[i,v] = 0.
+            else:
+                weights[i,v] = signData[i,v]*signMC*np.exp(logData[i,v] - logMC)
+
+    return weights
+
+
+def btagEventWeights(jets, tagged, efficiencies, sf, sfUp, sfDown):
+    """b-tagging event weights pData/pMC, for all b-tag scale factor variations in a single pass
+
+    https://twiki.cern.ch/twiki/bin/view/CMS/BTagSFMethods#1a_Event_reweighting_using_scale
+    Returns an array of shape (n_events, 7), with the columns listed in btagVariations.
+    'up'/'down' vary the scale factors of all jets together, 'heavy' only those of b and c jets,
+    and 'light' only those of light jets.
+    """
+    counts = ak.to_numpy(ak.num(jets))
+    offsets = np.zeros(len(counts)+1, np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    def flat(array, dtype):
+        return np.asarray(ak.to_numpy(ak.flatten(array, axis=None)), dtype=dtype)
+
+    return btagWeightKernel(flat(efficiencies, np.float64),
+                            flat(sf, np.float64),
+                            flat(sfUp, np.float64),
+                            flat(sfDown, np.float64),
+                            flat(jets.hadronFlavour, np.int64),
+                            flat(tagged, np.bool_),
+                            offsets)
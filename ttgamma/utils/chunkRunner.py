@@ -0,0 +1,291 @@
+import os
+import glob
+import math
+import functools
+import uproot
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
+from coffea.nanoevents.mapping import SimplePreloadedColumnSource
+
+from coffea import util
+
+from .branchManifest import getBranchManifest, unlistedBranches
+from .mergeOutputs import saveAtomic
+
+#one entry range of one file, the unit of work of the runner
+#usermeta is the metadata of the dataset from the fileset (see datasetMetadata.py), added to events.metadata
+Chunk = namedtuple('Chunk', ['dataset', 'filename', 'treename', 'fileuuid', 'entrystart', 'entrystop', 'usermeta'], defaults=[None])
+
+
+def fileChunkRanges(nEntries, chunksize):
+    """Entry ranges of the chunks of a file of nEntries entries, split as by coffea's run_uproot_job
+
+    The file is cut into max(round(nEntries/chunksize), 1) chunks of equal size (up to one entry). The jet energy
+    smearing of MC is seeded per chunk, so the same chunks are needed to get the same output as coffea's executors
+    """
+    if nEntries == 0:
+        return []
+    n = max(round(nEntries/chunksize), 1)
+    actualChunksize = math.ceil(nEntries/n)
+    return [(start, min(start + actualChunksize, nEntries)) for start in range(0, nEntries, actualChunksize)]
+
+
+def _fileInfo(filename, treename):
+    with uproot.open(filename) as fhandle:
+        return fhandle[treename].num_entries, str(fhandle.file.uuid)
+
+
+def fileInfos(filenames, treename='Events', workers=16):
+    """Number of entries and UUID of every file, read in a pool of threads"""
+    filenames = sorted(set(filenames))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(filenames, pool.map(functools.partial(_fileInfo, treename=treename), filenames)))
+
+
+def getChunks(fileset, chunksize, maxchunks=None, treename='Events'):
+    """Split every file of the fileset into chunks of about chunksize entries, as coffea's run_uproot_job does
+
+    chunksize can also be a dict with the chunk size of each dataset (see chunkSizing.py).
+    maxchunks limits the number of chunks per dataset, as in coffea's run_uproot_job.
+    The entries of the fileset can also be in coffea's format with metadata, {'files': [...], 'metadata': {...}}
+    """
+    fileset = {dataset: files if isinstance(files, dict) else {'files': files} for dataset, files in fileset.items()}
+    infos = fileInfos([f for entry in fileset.values() for f in entry['files']], treename)
+    chunks = []
+    for dataset, entry in fileset.items():
+        if len(entry['files']) == 0:
+            continue
+        usermeta = entry.get('metadata')
+        datasetChunksize = chunksize[dataset] if isinstance(chunksize, dict) else chunksize
+        nChunks = 0
+        for filename in entry['files']:
+            nEntries, fileuuid = infos[filename]
+            for entrystart, entrystop in fileChunkRanges(nEntries, datasetChunksize):
+                if maxchunks is not None and nChunks >= maxchunks:
+                    break
+                chunks.append(Chunk(dataset, filename, treename, fileuuid, entrystart, entrystop, usermeta))
+                nChunks += 1
+    return chunks
+
+
+def readChunk(tree, chunk, branches):
+    """Read all manifest branches of a chunk with a single tree.arrays() call
+
+    uproot collects the baskets of all requested branches into one vectorized request,
+    instead of one request per branch when the columns are read lazily
+    """
+    branches = [b for b in branches if b in tree]
+    return tree.arrays(branches, entry_start=chunk.entrystart, entry_stop=chunk.entrystop, how=dict)
+
+
+def chunkMetadata(chunk):
+    return {
+        **(chunk.usermeta or {}),
+        'dataset': chunk.dataset,
+        'filename': chunk.filename,
+        'treename': chunk.treename,
+        'entrystart': chunk.entrystart,
+        'entrystop': chunk.entrystop,
+        'fileuuid': chunk.fileuuid,
+    }
+
+
+def chunkBranches(processor_instance, chunk):
+    """Branches to read for a chunk: the processor's manifest, without the MC branches for data chunks of a processor for both"""
+    if processor_instance.isMC is None and chunk.usermeta is not None and chunk.usermeta.get('isMC') is False:
+        dataBranches = set(getBranchManifest(False))
+        return [b for b in processor_instance.branches if b in dataBranches]
+    return processor_instance.branches
+
+
+def preloadedEvents(arrays, chunk):
+    """Build NanoEvents from arrays that were already read with readChunk"""
+    source = SimplePreloadedColumnSource(arrays, chunk.fileuuid, chunk.entrystop - chunk.entrystart, chunk.treename)
+    factory = NanoEventsFactory.from_preloaded(source, schemaclass=NanoAODSchema, metadata=chunkMetadata(chunk))
+    return factory.events()
+
+
+def processChunk(processor_instance, chunk, checkManifest=False):
+    """Run the processor over a single chunk
+
+    By default only the branches in processor_instance.branches are read, in bulk.
+    With checkManifest, the events are read lazily instead, and the branches that were accessed
+    but are not in the manifest are returned, to find branches missing from the manifest.
+    """
+    with uproot.open(chunk.filename) as fhandle:
+        tree = fhandle[chunk.treename]
+        if checkManifest:
+            accessed = []
+            events = NanoEventsFactory.from_root(fhandle, chunk.treename,
+                                                 entry_start=chunk.entrystart, entry_stop=chunk.entrystop,
+                                                 schemaclass=NanoAODSchema, metadata=chunkMetadata(chunk),
+                                                 access_log=accessed).events()
+            output = processor_instance.process(events)
+            return output, unlistedBranches(accessed, processor_instance.branches)
+
+        events = preloadedEvents(readChunk(tree, chunk, chunkBranches(processor_instance, chunk)), chunk)
+        return processor_instance.process(events), []
+
+
+def checkpointName(checkpointDir, chunk):
+    #a chunk is identified by its file UUID and entry range, independently of the file path
+    return os.path.join(checkpointDir, f"checkpoint_{chunk.fileuuid}_{chunk.entrystart}_{chunk.entrystop}.coffea")
+
+
+def clearCheckpoints(checkpointDir):
+    """Remove the chunk checkpoints in checkpointDir (once the final output is saved)"""
+    for filename in glob.glob(os.path.join(checkpointDir, "checkpoint_*.coffea")):
+        os.remove(filename)
+
+
+def loadCheckpoints(chunks, output, checkpointDir, status=True):
+    """Add the outputs of the chunks already saved in checkpointDir to output, and return the chunks left to process"""
+    if checkpointDir is None:
+        return chunks
+    os.makedirs(checkpointDir, exist_ok=True)
+    done = set(checkpointName(checkpointDir, chunk) for chunk in chunks if os.path.exists(checkpointName(checkpointDir, chunk)))
+    for filename in done:
+        output.add(util.load(filename))
+    if status and len(done) > 0:
+        print(f"Loaded {len(done)}/{len(chunks)} chunks from the checkpoints in {checkpointDir}")
+    return [chunk for chunk in chunks if checkpointName(checkpointDir, chunk) not in done]
+
+
+def _processChunk(args):
+    processor_instance, chunk, checkManifest, checkpointDir = args
+    output, unlisted = processChunk(processor_instance, chunk, checkManifest)
+    #saved by the worker as soon as the chunk is done, so that it is not lost if the job stops before it is summed
+    if checkpointDir is not None:
+        saveAtomic(output, checkpointName(checkpointDir, chunk))
+    return output, unlisted
+
+
+def runChunks(chunks, processor_instance, workers=1, checkManifest=False, status=True, checkpointDir=None, executor=None):
+    """Process a list of chunks, in a pool of worker processes if workers > 1, or on the workers of executor (see localExecutor.py)
+
+    With checkpointDir, the output of every chunk is saved in that directory when it is done, and the chunks
+    already saved there (by a previous run that did not finish) are loaded instead of being processed again.
+
+    Returns the summed accumulator and the sorted list of branches read outside the manifest
+    (always empty unless checkManifest is set)
+    """
+    output = processor_instance.accumulator.identity()
+    unlisted = set()
+    chunks = loadCheckpoints(chunks, output, checkpointDir, status)
+
+    args = [(processor_instance, chunk, checkManifest, checkpointDir) for chunk in chunks]
+    pool = None
+    if executor is not None:
+        results = executor.map(_processChunk, args)
+    elif workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = pool.map(_processChunk, args)
+    else:
+        results = (_processChunk(a) for a in args)
+
+    for i, (chunkOutput, chunkUnlisted) in enumerate(results):
+        output.add(chunkOutput)
+        unlisted.update(chunkUnlisted)
+        if status:
+            print(f"Processed chunk {i+1}/{len(chunks)}")
+
+    if pool is not None:
+        pool.shutdown()
+
+    return processor_instance.postprocess(output), sorted(unlisted)
+
+
+def _readChunkArrays(chunk, branches):
+    with uproot.open(chunk.filename) as fhandle:
+        return readChunk(fhandle[chunk.treename], chunk, branches)
+
+
+def prefetchedChunks(chunks, branches, ioThreads=2, depth=2, maxBytes=None):
+    """Iterate over (chunk, arrays) in order, while the next chunks are read ahead in a pool of I/O threads
+
+    branches is the list of branches to read, or a function returning it for a chunk.
+
+    While a chunk is being used, the reads (and decompression) of up to depth following chunks are running
+    or done. With maxBytes, no read is started while the arrays of the chunks read ahead (the reads still
+    running counted with the average size of a chunk so far) take more than maxBytes.
+    """
+    pool = ThreadPoolExecutor(max_workers=ioThreads)
+    pending = deque()
+    todo = iter(chunks)
+    sizes = []
+
+    def aheadBytes():
+        average = sum(sizes)/len(sizes) if sizes else 0
+        return sum(sum(a.nbytes for a in f.result().values()) if f.done() and f.exception() is None else average
+                   for _, f in pending)
+
+    def refill():
+        while len(pending) < depth and (maxBytes is None or len(pending) == 0 or aheadBytes() < maxBytes):
+            chunk = next(todo, None)
+            if chunk is None:
+                return
+            pending.append((chunk, pool.submit(_readChunkArrays, chunk, branches(chunk) if callable(branches) else branches)))
+
+    try:
+        refill()
+        while pending:
+            chunk, future = pending.popleft()
+            arrays = future.result()
+            sizes.append(sum(a.nbytes for a in arrays.values()))
+            #the next reads are started before this chunk is handed over
+            refill()
+            yield chunk, arrays
+            del arrays
+    finally:
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def _runPipeline(args):
+    processor_instance, chunks, ioThreads, depth, maxBytes, checkpointDir, status = args
+    output = processor_instance.accumulator.identity()
+    branches = functools.partial(chunkBranches, processor_instance)
+    for i, (chunk, arrays) in enumerate(prefetchedChunks(chunks, branches, ioThreads, depth, maxBytes)):
+        chunkOutput = processor_instance.process(preloadedEvents(arrays, chunk))
+        del arrays
+        if checkpointDir is not None:
+            saveAtomic(chunkOutput, checkpointName(checkpointDir, chunk))
+        output.add(chunkOutput)
+        if status:
+            print(f"Processed chunk {i+1}/{len(chunks)} (pid {os.getpid()})")
+    return output
+
+
+def runChunksPipelined(chunks, processor_instance, workers=1, ioThreads=2, depth=2, maxBytes=None, status=True, checkpointDir=None,
+                       executor=None):
+    """Process a list of chunks, reading the next chunks on I/O threads while the current one is processed
+
+    Each of the workers processes runs its own pipeline (see prefetchedChunks) over every workers-th chunk,
+    with ioThreads I/O threads, a queue of depth chunks read ahead, and at most maxBytes/workers of arrays
+    read ahead. Checkpoints are handled as in runChunks. With executor, the pipelines run on its workers
+    (the chunks are still split between them in advance).
+
+    Returns the summed accumulator
+    """
+    output = processor_instance.accumulator.identity()
+    chunks = loadCheckpoints(chunks, output, checkpointDir, status)
+
+    if executor is not None:
+        workers = executor.workers
+    maxWorkerBytes = maxBytes/workers if maxBytes is not None else None
+    args = [(processor_instance, chunks[i::workers], ioThreads, depth, maxWorkerBytes, checkpointDir, status) for i in range(workers)]
+    if executor is not None:
+        results = executor.map(_runPipeline, args)
+    elif workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_runPipeline, args))
+    else:
+        results = [_runPipeline(args[0])]
+
+    for workerOutput in results:
+        output.add(workerOutput)
+
+    return processor_instance.postprocess(output)
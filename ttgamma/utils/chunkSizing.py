@@ -0,0 +1,134 @@
+#Chunk size of each dataset, chosen from the measured memory and time of the processor
+#
+#The first file of each dataset is probed in a fresh worker process: after a small warm-up chunk (numba
+#compilation, corrections), a chunk of probeEvents/4 and a chunk of probeEvents events are read and processed,
+#and the peak RSS and time after each give a linear model of the worker, rss = rssBase + rssPerEvent*chunksize and
+#time = chunkTime + eventTime*chunksize. Since the rate chunksize/time grows with the chunk size, the chosen size
+#is the largest one whose predicted peak RSS stays under the memory budget of a worker (with a safety margin),
+#up to maxChunksize.
+#
+#The models are saved in a JSON file, by dataset and processor configuration, so the probes are only run once,
+#and a later run with the same budget gets the same chunk sizes, and so the same chunks (and checkpoint names).
+
+import os
+import json
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import uproot
+
+from .chunkRunner import Chunk, readChunk, preloadedEvents
+from .stageTimer import peakRSS
+
+
+def processorConfig(processor_instance):
+    #the settings of the processor which change its memory and time per event
+    return f"isMC={processor_instance.isMC},jetSyst={processor_instance.jetSystList},preSelection={processor_instance.preSelection}"
+
+
+def _probe(processor_instance, dataset, filename, probeEvents, treename='Events'):
+    with uproot.open(filename) as fhandle:
+        tree = fhandle[treename]
+        fileuuid = str(fhandle.file.uuid)
+        #warm-up chunk, then the two probes
+        sizes = [min(max(size, 1), tree.num_entries) for size in [probeEvents//20, probeEvents//4, probeEvents]]
+
+        points = []
+        for size in sizes:
+            chunk = Chunk(dataset, filename, treename, fileuuid, 0, size)
+            start = time.perf_counter()
+            processor_instance.process(preloadedEvents(readChunk(tree, chunk, processor_instance.branches), chunk))
+            points.append((size, time.perf_counter() - start, peakRSS()))
+    #the first chunk is only a warm-up
+    return points[1:]
+
+
+def fitModel(points):
+    """Linear model of the peak RSS and time of a worker from two probes (size, time, peak RSS)"""
+    (n1, t1, rss1), (n2, t2, rss2) = points
+    if n2 <= n1:
+        raise ValueError(f"The probes need two different chunk sizes, got {n1} and {n2}")
+    rssPerEvent = max((rss2 - rss1)/(n2 - n1), 0.)
+    eventTime = (t2 - t1)/(n2 - n1)
+    if eventTime <= 0:
+        #timing noise, the time is taken as proportional to the chunk size instead
+        eventTime = t2/n2
+    return {
+        'rssBase': rss2 - rssPerEvent*n2,
+        'rssPerEvent': rssPerEvent,
+        'chunkTime': max(t2 - eventTime*n2, 0.),
+        'eventTime': eventTime,
+    }
+
+
+def chunkSizeFromModel(model, memoryBudget, maxChunksize=1000000, minChunksize=1000, safety=0.8):
+    """Largest chunk size (rounded down to minChunksize) with a predicted peak RSS under safety*memoryBudget bytes"""
+    available = safety*memoryBudget - model['rssBase']
+    if model['rssPerEvent'] <= 0:
+        return maxChunksize
+    chunksize = int(available/model['rssPerEvent'])//minChunksize*minChunksize
+    if chunksize < minChunksize:
+        warnings.warn(f"A worker needs {(model['rssBase'] + minChunksize*model['rssPerEvent'])/1e9:.2f} GB for chunks of {minChunksize} events, "
+                      f"more than the budget of {memoryBudget/1e9:.2f} GB")
+        return minChunksize
+    return min(chunksize, maxChunksize)
+
+
+def loadModels(cachePath):
+    if cachePath is None or not os.path.exists(cachePath):
+        return {}
+    with open(cachePath) as f:
+        return json.load(f)
+
+
+def saveModels(models, cachePath):
+    #merged with the current content of the file, then written atomically
+    current = loadModels(cachePath)
+    current.update(models)
+    tmpName = f'{cachePath}.tmp{os.getpid()}'
+    with open(tmpName, 'w') as f:
+        json.dump(current, f, indent=1, sort_keys=True)
+    os.replace(tmpName, cachePath)
+
+
+def chooseChunkSizes(fileset, processor_instance, memoryBudget, cachePath=None, probeEvents=20000,
+                     maxChunksize=1000000, minChunksize=1000, safety=0.8, status=True):
+    """Chunk size of each dataset of the fileset, for workers with memoryBudget bytes of memory each
+
+    The datasets without a model in cachePath are probed (one after the other, each in a fresh process) and
+    their models are saved there. Returns a dict from dataset to chunk size, to be used with getChunks, with an
+    entry for every dataset (maxChunksize for those without files, which are not probed).
+    """
+    config = processorConfig(processor_instance)
+    models = loadModels(cachePath)
+    probed = {}
+    for dataset, files in fileset.items():
+        key = f"{dataset}|{config}"
+        if key in models or len(files) == 0:
+            continue
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            points = pool.submit(_probe, processor_instance, dataset, files[0], probeEvents).result()
+        try:
+            probed[key] = {'dataset': dataset, 'config': config, 'probeFile': files[0], **fitModel(points)}
+        except ValueError:
+            #the file is too small to be probed with two chunk sizes, its dataset gets the largest chunks
+            probed[key] = {'dataset': dataset, 'config': config, 'probeFile': files[0],
+                           'rssBase': points[-1][2], 'rssPerEvent': 0., 'chunkTime': points[-1][1], 'eventTime': 0.}
+        models[key] = probed[key]
+    if cachePath is not None and len(probed) > 0:
+        saveModels(probed, cachePath)
+
+    chunksizes = {}
+    for dataset, files in fileset.items():
+        model = models.get(f"{dataset}|{config}")
+        if model is None:
+            chunksizes[dataset] = maxChunksize
+            continue
+        chunksizes[dataset] = chunkSizeFromModel(model, memoryBudget, maxChunksize, minChunksize, safety)
+        if status:
+            predictedTime = model['chunkTime'] + model['eventTime']*chunksizes[dataset]
+            print(f"{dataset}: chunks of {chunksizes[dataset]} events, predicted peak RSS "
+                  f"{(model['rssBase'] + model['rssPerEvent']*chunksizes[dataset])/1e9:.2f} GB, "
+                  f"{chunksizes[dataset]/max(predictedTime, 1e-9):.0f} events/s{' (probed)' if f'{dataset}|{config}' in probed else ''}")
+    return chunksizes
@@ -0,0 +1,233 @@
+#Precompiled bundle of the corrections used by TTGammaProcessor
+#
+#All corrections (JEC/JER text files, DeepCSV scale factors, pileup and b-tagging efficiency lookups, lepton scale factors)
+#are converted once into a single binary file of flat arrays, plus a JSON header describing how to
+#rebuild the lookup objects from them. The bundle is memory-mapped read-only when loaded, so loading
+#it does not parse any text file or unpickle anything, and every worker process on a node shares the
+#same physical pages of the file.
+#
+#Build (or rebuild, after changing any of the source files) the bundle with
+#    python -m ttgamma.utils.correctionBundle
+
+import os
+import json
+import hashlib
+import warnings
+
+import numpy as np
+import awkward as ak
+
+from coffea import util
+from coffea.lookup_tools import extractor, dense_lookup
+
+from .btagScaleFactor import compileBTagCSV
+
+cwd = os.path.dirname(__file__)
+packageDir = os.path.dirname(cwd)
+
+#increase when the file layout or the content of the bundle changes
+BUNDLE_VERSION = 2
+BUNDLE_MAGIC = b'TTGCORR\0'
+ALIGNMENT = 64
+
+bundlePath = f'{packageDir}/ScaleFactors/corrections.bundle'
+
+jecFiles = [
+    'ScaleFactors/JEC/Summer16_07Aug2017_V11_MC_L1FastJet_AK4PFchs.jec.txt',
+    'ScaleFactors/JEC/Summer16_07Aug2017_V11_MC_L2Relative_AK4PFchs.jec.txt',
+    'ScaleFactors/JEC/Summer16_07Aug2017_V11_MC_Uncertainty_AK4PFchs.junc.txt',
+    'ScaleFactors/JEC/Summer16_25nsV1_MC_PtResolution_AK4PFchs.jr.txt',
+    'ScaleFactors/JEC/Summer16_25nsV1_MC_SF_AK4PFchs.jersf.txt',
+]
+
+btagFile = 'ScaleFactors/Btag/DeepCSV_2016LegacySF_V1.btag.csv'
+
+#corrections stored with coffea.util.save, by name in the bundle
+lookupFiles = {
+    'taggingEff': 'utils/taggingEfficienciesDenseLookup.coffea',
+    'puLookup': 'ScaleFactors/puLookup.coffea',
+    'puLookup_Up': 'ScaleFactors/puLookup_Up.coffea',
+    'puLookup_Down': 'ScaleFactors/puLookup_Down.coffea',
+}
+for name in ['ele_id', 'ele_reco', 'mu_id', 'mu_iso', 'mu_trig', 'pho_id']:
+    for output in ['sf', 'err']:
+        lookupFiles[f'{name}_{output}'] = f'ScaleFactors/MuEGammaScaleFactors/{name}_{output}.coffea'
+
+
+def sourceHashes():
+    #sha1 of every source file, a bundle built from different files is out of date
+    hashes = {}
+    for f in jecFiles + [btagFile] + sorted(lookupFiles.values()):
+        with open(f'{packageDir}/{f}', 'rb') as source:
+            hashes[f] = hashlib.sha1(source.read()).hexdigest()
+    return hashes
+
+
+def buildCorrections():
+    """Load all corrections from their source files
+
+    Returns a dict with the extractor inputs of the JEC/JER files under 'jec' (the arguments of
+    coffea.lookup_tools.evaluator), the medium working point DeepCSV scale factors under 'btagSF' (the
+    arguments of CompiledBTagScaleFactor), and the objects stored in the .coffea files under their names in lookupFiles
+    """
+    jetExtractor = extractor()
+    jetExtractor.add_weight_sets([f"* * {packageDir}/{f}" for f in jecFiles])
+    jetExtractor.finalize()
+
+    corrections = {'jec': (jetExtractor._names, jetExtractor._types, jetExtractor._weights)}
+    corrections['btagSF'] = compileBTagCSV(f'{packageDir}/{btagFile}', 'MEDIUM')
+    for name, f in lookupFiles.items():
+        corrections[name] = util.load(f'{packageDir}/{f}')
+    return corrections
+
+
+def _encode(obj, buffers):
+    #describe obj as JSON, appending its arrays to buffers
+    if isinstance(obj, np.ndarray):
+        buffers.append(np.ascontiguousarray(obj))
+        return {'t': 'ndarray', 'buffer': len(buffers)-1, 'dtype': obj.dtype.str, 'shape': list(obj.shape)}
+    if isinstance(obj, ak.Array):
+        form, length, container = ak.to_buffers(obj)
+        return {'t': 'awkward', 'form': form.tojson(), 'length': length,
+                'buffers': {key: _encode(array, buffers) for key, array in container.items()}}
+    if isinstance(obj, dense_lookup.dense_lookup):
+        return {'t': 'dense_lookup', 'values': _encode(obj._values, buffers), 'axes': _encode(obj._axes, buffers)}
+    if isinstance(obj, (tuple, list)):
+        return {'t': type(obj).__name__, 'items': [_encode(item, buffers) for item in obj]}
+    if isinstance(obj, dict):
+        return {'t': 'dict', 'items': [[_encode(k, buffers), _encode(v, buffers)] for k, v in obj.items()]}
+    if isinstance(obj, bytes):
+        return {'t': 'bytes', 'value': obj.decode('latin-1')}
+    if isinstance(obj, np.generic):
+        return {'t': 'value', 'value': obj.item()}
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return {'t': 'value', 'value': obj}
+    raise TypeError(f"Cannot store objects of type {type(obj)} in the correction bundle")
+
+
+def _decode(desc, buffers):
+    t = desc['t']
+    if t == 'ndarray':
+        return buffers[desc['buffer']]
+    if t == 'awkward':
+        container = {key: _decode(array, buffers) for key, array in desc['buffers'].items()}
+        return ak.from_buffers(ak.forms.Form.fromjson(desc['form']), desc['length'], container)
+    if t == 'dense_lookup':
+        values = _decode(desc['values'], buffers)
+        axes = _decode(desc['axes'], buffers)
+        lookup = dense_lookup.dense_lookup(values, axes)
+        #dense_lookup makes a copy of its inputs, point it back to the memory-mapped arrays
+        lookup._values = values
+        lookup._axes = axes
+        return lookup
+    if t == 'tuple':
+        return tuple(_decode(item, buffers) for item in desc['items'])
+    if t == 'list':
+        return [_decode(item, buffers) for item in desc['items']]
+    if t == 'dict':
+        return {_decode(k, buffers): _decode(v, buffers) for k, v in desc['items']}
+    if t == 'bytes':
+        return desc['value'].encode('latin-1')
+    if t == 'value':
+        return desc['value']
+    raise ValueError(f"Unknown entry type {t} in the correction bundle")
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+
+def writeBundle(path=bundlePath, corrections=None):
+    """Compile the corrections into a bundle file (written to a temporary file and then moved in place)"""
+    if corrections is None:
+        corrections = buildCorrections()
+
+    buffers = []
+    entries = _encode(corrections, buffers)
+
+    #offsets of the arrays, relative to the start of the data block
+    layout = []
+    offset = 0
+    for b in buffers:
+        layout.append([offset, b.nbytes])
+        offset = _aligned(offset + b.nbytes)
+
+    header = json.dumps({
+        'version': BUNDLE_VERSION,
+        'awkward': ak.__version__.split('.')[0],
+        'sources': sourceHashes(),
+        'layout': layout,
+        'entries': entries,
+    }).encode()
+    dataStart = _aligned(len(BUNDLE_MAGIC) + 8 + len(header))
+
+    tmpPath = f'{path}.tmp{os.getpid()}'
+    with open(tmpPath, 'wb') as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for b, (offset, nbytes) in zip(buffers, layout):
+            f.seek(dataStart + offset)
+            f.write(b.tobytes())
+    os.replace(tmpPath, path)
+
+
+def readBundle(path=bundlePath, checkSources=True):
+    """Memory-map a bundle file and rebuild the corrections from it
+
+    Returns None if the file does not exist, or if it was built by a different version of this
+    module or of awkward, or (if checkSources) from source files that have changed since
+    """
+    if not os.path.exists(path):
+        return None
+
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(data[:len(BUNDLE_MAGIC)]) != BUNDLE_MAGIC:
+        raise ValueError(f"{path} is not a correction bundle")
+    headerLength = int(data[len(BUNDLE_MAGIC):len(BUNDLE_MAGIC)+8].view(np.uint64)[0])
+    headerStart = len(BUNDLE_MAGIC) + 8
+    header = json.loads(bytes(data[headerStart:headerStart+headerLength]))
+
+    if header['version'] != BUNDLE_VERSION or header['awkward'] != ak.__version__.split('.')[0]:
+        return None
+    if checkSources and header['sources'] != sourceHashes():
+        return None
+
+    dataStart = _aligned(headerStart + headerLength)
+    buffers = []
+    for (offset, nbytes), desc in zip(header['layout'], _arrayDescriptions(header['entries'])):
+        start = dataStart + offset
+        buffers.append(np.asarray(data[start:start+nbytes]).view(np.dtype(desc['dtype'])).reshape(desc['shape']))
+
+    return _decode(header['entries'], buffers)
+
+
+def _arrayDescriptions(desc):
+    #the ndarray entries, in the order of their buffer index
+    arrays = []
+    def collect(d):
+        if isinstance(d, dict):
+            if d.get('t') == 'ndarray':
+                arrays.append(d)
+            for v in d.values():
+                collect(v)
+        elif isinstance(d, list):
+            for v in d:
+                collect(v)
+    collect(desc)
+    return sorted(arrays, key=lambda d: d['buffer'])
+
+
+def loadCorrections(path=bundlePath):
+    """Corrections from the bundle if it is up to date, otherwise built from the source files"""
+    corrections = readBundle(path)
+    if corrections is None:
+        warnings.warn(f"Correction bundle {path} is missing or out of date, loading the corrections from the source files. "
+                      "Run 'python -m ttgamma.utils.correctionBundle' to rebuild it.")
+        corrections = buildCorrections()
+    return corrections
+
+
+if __name__ == '__main__':
+    writeBundle()
+    print(f"Wrote {bundlePath} ({os.path.getsize(bundlePath)} bytes)")
@@ -0,0 +1,58 @@
+#Metadata of the datasets of a fileset
+#
+#The properties of a dataset used by TTGammaProcessor (data or MC, year, overlap removal parameters, and the keys
+#of its pileup and b-tagging efficiency lookups) are derived from the dataset name once, and attached to its entry
+#of the fileset in coffea's format, {dataset: {'files': [...], 'metadata': {...}}}. coffea's run_uproot_job and
+#the chunk runner both pass them to process() in events.metadata, so one processor instance (and one pool of
+#workers) can process data and MC datasets together, and the dataset names are not parsed for every chunk.
+
+import re
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def datasetMetadata(dataset, year=2016):
+    """Metadata of a dataset, derived from its name
+
+    Do not modify the returned dict, it is shared by all calls with the same dataset
+    """
+    # Overlap removal between related samples
+    # TTGamma and TTbar
+    # WGamma and WJets
+    # ZGamma and ZJets
+    # the events of the inclusive sample with a photon with pT > pt, |eta| < eta, farther than dR from other gen
+    # particles, are already counted in the phase space of the photon sample
+    overlapRemoval = None
+    if 'TTbar' in dataset:
+        overlapRemoval = {'pt': 10., 'eta': 5., 'dR': 0.1}
+    if re.search("^W[1234]jets$", dataset):
+        overlapRemoval = {'pt': 10., 'eta': 2.5, 'dR': 0.05}
+    if 'DYjetsM' in dataset:
+        overlapRemoval = {'pt': 15., 'eta': 2.6, 'dR': 0.05}
+
+    return {
+        'isMC': not 'Data' in dataset,
+        'year': year,
+        'overlapRemoval': overlapRemoval,
+        # the names of the pileup and b-tagging efficiency lookups include the year
+        'puKey': f'{dataset}_{year}',
+        'btagEffKey': f'{dataset}_{year}',
+    }
+
+
+def filesetFiles(fileset):
+    """The files of each dataset, {dataset: [files]}, for a fileset with or without metadata"""
+    return {dataset: entry['files'] if isinstance(entry, dict) else entry for dataset, entry in fileset.items()}
+
+
+def filesetMetadata(fileset):
+    """Metadata of each dataset: the metadata of its fileset entry, if any, completed by the one derived from its name"""
+    return {dataset: {**datasetMetadata(dataset), **(entry.get('metadata', {}) if isinstance(entry, dict) else {})}
+            for dataset, entry in fileset.items()}
+
+
+def withMetadata(fileset, metadata=None):
+    """The fileset in coffea's format with metadata, taken from metadata[dataset] or derived from the dataset name"""
+    metadata = metadata or {}
+    return {dataset: {'files': files, 'metadata': dict(metadata.get(dataset) or datasetMetadata(dataset))}
+            for dataset, files in filesetFiles(fileset).items()}
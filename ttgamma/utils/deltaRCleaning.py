@@ -0,0 +1,58 @@
+import numpy as np
+import numba
+import awkward as ak
+
+@numba.njit(parallel=True)
+def deltaRCleaningKernel(etaA, phiA, offsetsA, etaB, phiB, offsetsB, drCuts):
+    mask = np.ones(len(etaA), np.bool_)
+
+    #i is the event number
+    for i in numba.prange(len(offsetsA)-1):
+        #a is an object of the collection being cleaned
+        for a in range(offsetsA[i], offsetsA[i+1]):
+            #t is the target collection, offsetsB[t] indexes into the concatenated target arrays
+            for t in range(len(drCuts)):
+                for b in range(offsetsB[t,i], offsetsB[t,i+1]):
+                    #same delta eta, delta phi and delta R definition as coffea's delta_r, in float32
+                    deta = np.float32(etaA[a] - etaB[b])
+                    dphi = np.float32((phiA[a] - phiB[b] + np.pi) % (2*np.pi) - np.pi)
+                    if np.float32(np.hypot(deta, dphi)) <= drCuts[t]:
+                        mask[a] = False
+                        break
+                if not mask[a]:
+                    break
+
+    return mask
+
+
+def deltaRCleaningMask(objects, targets, drCuts):
+    """Mask of the objects which are farther than drCuts[t] in delta R from every object in targets[t]
+
+    Equivalent to ak.fill_none(objects.nearest(target, return_metric=True)[1] > drCut, True) for
+    every target, combined with &, but computed in a single pass over the flat eta/phi arrays
+    without building the cartesian product of objects and targets.
+    """
+    counts = ak.to_numpy(ak.num(objects))
+    offsetsA = np.zeros(len(counts)+1, np.int64)
+    offsetsA[1:] = np.cumsum(counts)
+
+    etaB = []
+    phiB = []
+    offsetsB = np.zeros((len(targets), len(counts)+1), np.int64)
+    base = 0
+    for t, target in enumerate(targets):
+        offsetsB[t,1:] = np.cumsum(ak.to_numpy(ak.num(target)))
+        offsetsB[t] += base
+        base = offsetsB[t,-1]
+        etaB.append(ak.to_numpy(ak.flatten(target.eta)).astype(np.float32))
+        phiB.append(ak.to_numpy(ak.flatten(target.phi)).astype(np.float32))
+
+    mask = deltaRCleaningKernel(ak.to_numpy(ak.flatten(objects.eta)).astype(np.float32),
+                                ak.to_numpy(ak.flatten(objects.phi)).astype(np.float32),
+                                offsetsA,
+                                np.concatenate(etaB) if len(etaB) > 0 else np.zeros(0, np.float32),
+                                np.concatenate(phiB) if len(phiB) > 0 else np.zeros(0, np.float32),
+                                offsetsB,
+                                np.array(drCuts, np.float32))
+
+    return ak.unflatten(mask, counts)
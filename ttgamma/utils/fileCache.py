@@ -0,0 +1,211 @@
+#Local read-through disk cache for remote input files
+#
+#Remote files (root://, or file:// as a stand-in for tests) are copied whole into a local cache directory
+#before they are processed, and the runner reads the local copies. The copies are content-addressed:
+#they are stored under the sha256 of their content, and an index maps every URL to the hash of its
+#content. A copy is only used if its size matches the index (and, with verify, its hash). When the
+#cache is larger than its size limit, the least recently used copies are removed.
+#
+#    cache = FileCache('/tmp/ttgCache', maxBytes=200e9)
+#    localFileset = cache.localFileset(fileset, workers=8)
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import warnings
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+cachedSchemes = ('root://', 'file://')
+
+
+def isRemote(url):
+    return url.startswith(cachedSchemes)
+
+
+def _localBlocks(path, blockSize):
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                return
+            yield block
+
+
+def _xrootdBlocks(url, blockSize):
+    from XRootD import client
+
+    f = client.File()
+    status, _ = f.open(url)
+    if not status.ok:
+        raise IOError(f"Could not open {url}: {status.message}")
+    try:
+        status, info = f.stat()
+        if not status.ok:
+            raise IOError(f"Could not stat {url}: {status.message}")
+        for offset in range(0, info.size, blockSize):
+            status, block = f.read(offset, min(blockSize, info.size - offset))
+            if not status.ok:
+                raise IOError(f"Could not read {url}: {status.message}")
+            yield block
+    finally:
+        f.close()
+
+
+def remoteBlocks(url, blockSize=1 << 24):
+    """Content of a remote file, as a sequence of blocks"""
+    if url.startswith('file://'):
+        return _localBlocks(url[len('file://'):], blockSize)
+    if url.startswith('root://'):
+        return _xrootdBlocks(url, blockSize)
+    raise ValueError(f"Unsupported URL {url}")
+
+
+def fileHash(path, blockSize=1 << 24):
+    sha = hashlib.sha256()
+    for block in _localBlocks(path, blockSize):
+        sha.update(block)
+    return sha.hexdigest()
+
+
+class FileCache:
+    """Content-addressed cache of remote files in a local directory, with at most maxBytes of files
+
+    verify recomputes the hash of a cached copy every time it is used, instead of only checking its size.
+    The index is locked while it is updated, so several jobs on the same node can share a cache directory.
+    """
+    def __init__(self, cacheDir, maxBytes=None, verify=False):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.verify = verify
+        os.makedirs(os.path.join(cacheDir, 'objects'), exist_ok=True)
+        self._indexPath = os.path.join(cacheDir, 'index.json')
+
+    def objectPath(self, contentHash):
+        return os.path.join(self.cacheDir, 'objects', contentHash[:2], f'{contentHash}.root')
+
+    @contextmanager
+    def _index(self):
+        #the index, locked for the duration of the block and written back at the end
+        with open(os.path.join(self.cacheDir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = {'urls': {}, 'objects': {}}
+            if os.path.exists(self._indexPath):
+                with open(self._indexPath) as f:
+                    index = json.load(f)
+            yield index
+            tmpName = f'{self._indexPath}.tmp{os.getpid()}'
+            with open(tmpName, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmpName, self._indexPath)
+
+    def _cached(self, index, url):
+        #the local copy of url if it is in the cache and intact, otherwise None
+        entry = index['urls'].get(url)
+        if entry is None:
+            return None
+        path = self.objectPath(entry['hash'])
+        if not os.path.exists(path) or os.path.getsize(path) != entry['size'] or (self.verify and fileHash(path) != entry['hash']):
+            warnings.warn(f"Cached copy of {url} is missing or corrupted, fetching it again")
+            #the copy is also the one of any other URL with the same content
+            if os.path.exists(path):
+                os.remove(path)
+            index['objects'].pop(entry['hash'], None)
+            index['urls'] = {other: e for other, e in index['urls'].items() if e['hash'] != entry['hash']}
+            return None
+        return path
+
+    def _fetch(self, url):
+        #copy url to a temporary file in the cache, hashing it on the way
+        tmpDir = os.path.join(self.cacheDir, 'tmp')
+        os.makedirs(tmpDir, exist_ok=True)
+        tmpName = os.path.join(tmpDir, f'{os.getpid()}_{hashlib.sha1(url.encode()).hexdigest()}')
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmpName, 'wb') as f:
+                for block in remoteBlocks(url):
+                    sha.update(block)
+                    f.write(block)
+                    size += len(block)
+        except BaseException:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+        return tmpName, sha.hexdigest(), size
+
+    def _add(self, index, url, tmpName, contentHash, size):
+        path = self.objectPath(contentHash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            #same content already cached under another URL
+            os.remove(tmpName)
+        else:
+            os.replace(tmpName, path)
+        index['urls'][url] = {'hash': contentHash, 'size': size}
+        index['objects'][contentHash] = {'size': size, 'lastUsed': time.time()}
+        return path
+
+    def _evict(self, index, keep):
+        #remove the least recently used copies until the cache fits in maxBytes, never removing those in keep
+        if self.maxBytes is None:
+            return
+        total = sum(o['size'] for o in index['objects'].values())
+        for contentHash, obj in sorted(index['objects'].items(), key=lambda item: item[1]['lastUsed']):
+            if total <= self.maxBytes:
+                break
+            if contentHash in keep:
+                continue
+            if os.path.exists(self.objectPath(contentHash)):
+                os.remove(self.objectPath(contentHash))
+            del index['objects'][contentHash]
+            index['urls'] = {url: entry for url, entry in index['urls'].items() if entry['hash'] != contentHash}
+            total -= obj['size']
+        if total > self.maxBytes:
+            warnings.warn(f"The files in use ({total/1e9:.1f} GB) do not fit in the cache size limit ({self.maxBytes/1e9:.1f} GB)")
+
+    def localPaths(self, urls, workers=8):
+        """Local copies of the given URLs (local paths are returned as they are), fetching the missing ones in parallel
+
+        Returns a dict from URL to local path
+        """
+        remote = sorted(set(url for url in urls if isRemote(url)))
+        paths = {url: url for url in urls if not isRemote(url)}
+
+        fetched = []
+        while True:
+            with self._index() as index:
+                for url, (tmpName, contentHash, size) in fetched:
+                    paths[url] = self._add(index, url, tmpName, contentHash, size)
+                #the copies found in the cache are checked again under this lock: another job sharing the cache
+                #may have evicted them while the others were fetched
+                added = set(url for url, _ in fetched)
+                missing = []
+                for url in remote:
+                    if url in added:
+                        continue
+                    path = self._cached(index, url)
+                    if path is None:
+                        missing.append(url)
+                    else:
+                        paths[url] = path
+                if len(missing) == 0:
+                    now = time.time()
+                    inUse = set()
+                    for url in remote:
+                        contentHash = index['urls'][url]['hash']
+                        index['objects'][contentHash]['lastUsed'] = now
+                        inUse.add(contentHash)
+                    self._evict(index, inUse)
+                    return paths
+
+            #whole files are fetched in a pool of threads, outside of the index lock
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                fetched = list(zip(missing, pool.map(self._fetch, missing)))
+
+    def localFileset(self, fileset, workers=8):
+        """The fileset, with remote files replaced by their local copies"""
+        paths = self.localPaths([f for files in fileset.values() for f in files], workers)
+        return {dataset: [paths[f] for f in files] for dataset, files in fileset.items()}
@@ -1,21 +1,29 @@
 import numpy as np
 import numba
 
-@numba.njit
+@numba.njit(parallel=True)
 def maxHistoryPDGID(id_array, mom_array, counts):
-    maxPDGID_array = np.ones(len(id_array),np.int32)*-9  
+    maxPDGID_array = np.ones(len(id_array),np.int32)*-9
 
-    #offset is the starting index for this event
-    offset = 0
+    #offsets[i] is the starting index for event i
+    offsets = np.zeros(len(counts)+1, np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    #events are independent, so they are processed in parallel
     #i is the event number
-    for i in range(len(counts)):
+    for i in numba.prange(len(counts)):
+        offset = offsets[i]
         #j is the gen particle within event i
+        #the answer for a particle is max(own id, answer for its mother), so as long as the mother
+        #comes earlier in the event its answer is already known and the chain does not need to be walked again
         for j in range(counts[i]):
             maxPDGID_array[offset+j] = id_array[offset+j]
-            idx = mom_array[offset+j] 
+            idx = mom_array[offset+j]
             while idx != -1:
+                if idx < j:
+                    maxPDGID_array[offset+j] = max(maxPDGID_array[offset+idx], maxPDGID_array[offset+j])
+                    break
                 maxPDGID_array[offset+j] = max(id_array[offset+idx], maxPDGID_array[offset+j])
                 idx = mom_array[offset+idx]
-        offset += counts[i]
-        
+
     return maxPDGID_array
@@ -0,0 +1,60 @@
+import numpy as np
+from coffea import hist
+
+
+def _hasFillState():
+    #fillSystematics writes into the private state of coffea.hist.Hist (checked with coffea 0.7), which
+    #other versions may not have: check it once on a small histogram, and fall back to Hist.fill without it
+    h = hist.Hist('Events', hist.Cat('systematic', 'systematic'), hist.Bin('x', 'x', 1, 0, 1))
+    try:
+        h._init_sumw2()
+        return isinstance(h._sumw, dict) and isinstance(h._sumw2, dict) and len(h._dense_shape) == 1 and h._dtype is not None
+    except AttributeError:
+        return False
+
+
+fastFill = _hasFillState()
+
+
+def fillSystematics(h, systematics, weights, systAxis='systematic', **values):
+    """Fill a coffea histogram for several systematics in a single pass
+
+    Works like h.fill(), except that instead of a single systematic name and weight column,
+    a list of systematic names is given together with a weight matrix of shape
+    (n_entries, len(systematics)), one column per systematic. The dense bin indices are
+    only computed once, and all systematics are accumulated with a single bincount.
+    Without the expected internals of coffea.hist.Hist (see fastFill), each systematic is filled with h.fill().
+    """
+    weights = np.asarray(weights, dtype=np.float64).reshape(-1, len(systematics))
+
+    if not fastFill:
+        for i, syst in enumerate(systematics):
+            h.fill(**{**values, systAxis: syst}, weight=weights[:, i])
+        return
+
+    if h._sumw2 is None:
+        h._init_sumw2()
+
+    denseShape = h._dense_shape
+    nBins = int(np.prod(denseShape))
+
+    denseIndices = tuple(d.index(np.asarray(values[d.name])) for d in h.dense_axes())
+    xy = np.atleast_1d(np.ravel_multi_index(denseIndices, denseShape))
+    if len(xy) != len(weights):
+        raise ValueError(f"Got {len(xy)} entries to fill, but {len(weights)} rows of weights")
+
+    # offset the bin index of each systematic, so that all of them are filled with a single bincount
+    systIdx = (xy[:, None] + nBins * np.arange(len(systematics))).ravel()
+    sumw = np.bincount(systIdx, weights=weights.ravel(), minlength=nBins * len(systematics))
+    sumw2 = np.bincount(systIdx, weights=weights.ravel() ** 2, minlength=nBins * len(systematics))
+    sumw = sumw.reshape((len(systematics),) + tuple(denseShape))
+    sumw2 = sumw2.reshape((len(systematics),) + tuple(denseShape))
+
+    for i, syst in enumerate(systematics):
+        values[systAxis] = syst
+        sparseKey = tuple(d.index(values[d.name]) for d in h.sparse_axes())
+        if not sparseKey in h._sumw:
+            h._sumw[sparseKey] = np.zeros(shape=denseShape, dtype=h._dtype)
+            h._sumw2[sparseKey] = np.zeros(shape=denseShape, dtype=h._dtype)
+        h._sumw[sparseKey][:] += sumw[i]
+        h._sumw2[sparseKey][:] += sumw2[i]
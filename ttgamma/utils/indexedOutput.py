@@ -0,0 +1,252 @@
+#Indexed output format for processor results
+#
+#A .coffea file is a single compressed pickle, so reading one histogram from it means decompressing
+#and unpickling all of them. An indexed output file (suffix .hists) instead starts with a JSON table of
+#contents, followed by the sumw and sumw2 arrays of every sparse bin (dataset, category, systematic, ...)
+#of every histogram, each stored separately and uncompressed. The file is memory-mapped, and only the
+#arrays of the histograms and sparse bins that are asked for are ever read from disk.
+#
+#    outputMC = IndexedOutput([f'outputMC{group}_ttgamma_condorFull_4jet.hists' for group in groups], systematic=['nominal'])
+#    h = outputMC['M3']   #reads (and sums over the files) only the nominal M3 arrays
+#
+#Convert existing .coffea outputs with
+#    python -m ttgamma.utils.indexedOutput output1.coffea output2.coffea ...
+#When a .hists file does not exist, the .coffea file with the same name is read instead (whole, when it is opened).
+
+import os
+import json
+import pickle
+from collections.abc import Mapping
+
+import numpy as np
+
+from coffea import hist, processor, util
+
+INDEXED_VERSION = 1
+INDEXED_MAGIC = b'TTGHIST\0'
+ALIGNMENT = 64
+
+indexedSuffix = '.hists'
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+
+def _pickled(obj, buffers):
+    buffers.append(np.frombuffer(pickle.dumps(obj), dtype=np.uint8))
+    return len(buffers)-1
+
+
+def _array(a, buffers):
+    buffers.append(np.ascontiguousarray(a))
+    return len(buffers)-1
+
+
+def _histEntry(h, buffers):
+    #the histogram without content, with empty category axes: the identifiers are stored in the table of contents,
+    #and only the selected ones are added back when loading
+    axes = [hist.Cat(ax.name, ax.label, sorting=ax._sorting) if isinstance(ax, hist.Cat) else ax for ax in h.axes()]
+    skeleton = hist.Hist(h.label, *axes, dtype=h._dtype)
+
+    sparseAxes = h.sparse_axes()
+    identifiers = {ax.name: [[i.name, i.label] for i in ax.identifiers()] for ax in sparseAxes}
+    position = {ax.name: {name: n for n, (name, _) in enumerate(identifiers[ax.name])} for ax in sparseAxes}
+
+    bins = []
+    for key, sumw in h._sumw.items():
+        sumw2 = h._sumw2[key] if h._sumw2 is not None else None
+        bins.append([[position[ax.name][i.name] for ax, i in zip(sparseAxes, key)],
+                     _array(sumw, buffers),
+                     _array(sumw2, buffers) if sumw2 is not None else None])
+
+    return {'t': 'hist', 'skeleton': _pickled(skeleton, buffers), 'sparse': [ax.name for ax in sparseAxes],
+            'identifiers': identifiers, 'sumw2': h._sumw2 is not None, 'bins': bins}
+
+
+def saveIndexed(output, filename):
+    """Save a dict_accumulator of histograms (and other accumulators) in the indexed format
+
+    The file is written to a temporary file next to filename and then moved in place
+    """
+    buffers = []
+    entries = {}
+    for name, obj in output.items():
+        if isinstance(obj, hist.Hist):
+            entries[name] = _histEntry(obj, buffers)
+        else:
+            entries[name] = {'t': 'pickle', 'buffer': _pickled(obj, buffers)}
+
+    layout = []
+    offset = 0
+    for b in buffers:
+        layout.append([offset, b.nbytes, b.dtype.str, list(b.shape)])
+        offset = _aligned(offset + b.nbytes)
+
+    header = json.dumps({'version': INDEXED_VERSION, 'layout': layout, 'entries': entries}).encode()
+    dataStart = _aligned(len(INDEXED_MAGIC) + 8 + len(header))
+
+    tmpName = f'{filename}.tmp{os.getpid()}'
+    try:
+        with open(tmpName, 'wb') as f:
+            f.write(INDEXED_MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for b, (offset, *_) in zip(buffers, layout):
+                f.seek(dataStart + offset)
+                f.write(b.tobytes())
+        os.replace(tmpName, filename)
+    finally:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+
+
+class _IndexedFile:
+    #table of contents and memory map of a single indexed file
+    def __init__(self, filename):
+        #copy-on-write mapping: the arrays can be modified in place (e.g. by Hist.add or scale)
+        #without changing the file
+        self._data = np.memmap(filename, dtype=np.uint8, mode='c')
+        if bytes(self._data[:len(INDEXED_MAGIC)]) != INDEXED_MAGIC:
+            raise ValueError(f"{filename} is not an indexed output file")
+        headerStart = len(INDEXED_MAGIC) + 8
+        headerLength = int(self._data[len(INDEXED_MAGIC):headerStart].view(np.uint64)[0])
+        header = json.loads(bytes(self._data[headerStart:headerStart+headerLength]))
+        if header['version'] != INDEXED_VERSION:
+            raise ValueError(f"{filename} was written by an unsupported version ({header['version']}) of the indexed format")
+        self._dataStart = _aligned(headerStart + headerLength)
+        self._layout = header['layout']
+        self.entries = header['entries']
+
+    def _buffer(self, i):
+        offset, nbytes, dtype, shape = self._layout[i]
+        start = self._dataStart + offset
+        return np.asarray(self._data[start:start+nbytes]).view(np.dtype(dtype)).reshape(shape)
+
+    def load(self, name, selection):
+        entry = self.entries[name]
+        if entry['t'] == 'pickle':
+            return pickle.loads(self._buffer(entry['buffer']).tobytes())
+
+        h = pickle.loads(self._buffer(entry['skeleton']).tobytes())
+        sparseAxes = [h.axis(axName) for axName in entry['sparse']]
+        #selected identifiers of each sparse axis, by their position in the table of contents
+        selected = []
+        for ax in sparseAxes:
+            identifiers = entry['identifiers'][ax.name]
+            keep = selection.get(ax.name)
+            selected.append({n: ax.index(hist.StringBin(name, label)) for n, (name, label) in enumerate(identifiers)
+                             if keep is None or name in keep})
+
+        if entry['sumw2']:
+            h._init_sumw2()
+        for key, sumw, sumw2 in entry['bins']:
+            if not all(n in sel for n, sel in zip(key, selected)):
+                continue
+            key = tuple(sel[n] for n, sel in zip(key, selected))
+            h._sumw[key] = self._buffer(sumw)
+            if sumw2 is not None:
+                h._sumw2[key] = self._buffer(sumw2)
+        return h
+
+
+class _LoadedFile:
+    #a whole .coffea output, with the interface of _IndexedFile
+    def __init__(self, filename):
+        self._output = util.load(filename)
+        self.entries = {name: {'identifiers': {ax.name: [(str(i), i.label) for i in obj.identifiers(ax)] for ax in obj.sparse_axes()}}
+                        if isinstance(obj, hist.Hist) else {} for name, obj in self._output.items()}
+
+    def load(self, name, selection):
+        #a copy, since IndexedOutput adds the other files into it
+        obj = self._output[name]
+        if not isinstance(obj, hist.Hist):
+            return pickle.loads(pickle.dumps(obj))
+        h = obj.copy()
+        sparse = [ax.name for ax in h.sparse_axes()]
+        for key in list(h._sumw):
+            if any(axName in selection and str(identifier) not in selection[axName] for axName, identifier in zip(sparse, key)):
+                del h._sumw[key]
+                if h._sumw2 is not None:
+                    del h._sumw2[key]
+        return h
+
+
+def _openFile(filename):
+    coffeaName = os.path.splitext(filename)[0] + '.coffea'
+    if not filename.endswith(indexedSuffix) or (not os.path.exists(filename) and os.path.exists(coffeaName)):
+        return _LoadedFile(coffeaName if filename.endswith(indexedSuffix) else filename)
+    return _IndexedFile(filename)
+
+
+class IndexedOutput(Mapping):
+    """Read-on-access view of one or more indexed output files
+
+    Indexing by name reads that histogram (or other accumulator) from every file and returns their sum.
+    Keyword arguments select identifiers of sparse axes, e.g. dataset=[...] or systematic=['nominal']:
+    only these bins are read. Histograms already read are kept, so they are only read once.
+    A .coffea file can be given instead of an indexed file, and is used in place of a missing .hists file.
+    """
+    def __init__(self, filenames, **selection):
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        self._files = [_openFile(f) for f in filenames]
+        self._selection = {axis: set([ids] if isinstance(ids, str) else ids) for axis, ids in selection.items()}
+        self._cache = {}
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            output = None
+            for f in self._files:
+                if name not in f.entries:
+                    continue
+                part = f.load(name, self._selection)
+                if output is None:
+                    output = part
+                else:
+                    #as in dict_accumulator.add, accumulators are added in place
+                    output += part
+            if output is None:
+                raise KeyError(name)
+            self._cache[name] = output
+        return self._cache[name]
+
+    def __iter__(self):
+        names = {}
+        for f in self._files:
+            names.update(dict.fromkeys(f.entries))
+        return iter(names)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def identifiers(self, name, axis):
+        """Names of the identifiers of a sparse axis of a histogram, from the tables of contents (no array is read)"""
+        names = {}
+        for f in self._files:
+            if name in f.entries:
+                names.update(dict.fromkeys(n for n, _ in f.entries[name]['identifiers'][axis]))
+        return list(names)
+
+    def load(self, names=None):
+        """Read the given names (default: everything) into a dict_accumulator"""
+        return processor.dict_accumulator({name: self[name] for name in (names if names is not None else self)})
+
+
+def loadOutput(filename):
+    """Load a whole output file, in the indexed or in the .coffea format"""
+    if filename.endswith(indexedSuffix):
+        return IndexedOutput(filename).load()
+    return util.load(filename)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=f"Convert .coffea output files to the indexed format (written next to them, with suffix {indexedSuffix})")
+    parser.add_argument("input_files", type=str, nargs="+", help="Input files")
+    args = parser.parse_args()
+
+    for filename in args.input_files:
+        indexedName = os.path.splitext(filename)[0] + indexedSuffix
+        saveIndexed(util.load(filename), indexedName)
+        print(f"{filename} -> {indexedName} ({os.path.getsize(indexedName)/1e6:.1f} MB)")
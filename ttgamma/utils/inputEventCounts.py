@@ -0,0 +1,76 @@
+#Number of generated events of each dataset, used for the luminosity normalization of MC
+#
+#The count of every file is read from its hEvents histogram, with all files read concurrently in a
+#thread pool (the time is spent waiting on the network, not in python). The counts are cached by
+#file UUID (along with the filename) in a JSON file: on a rerun the files already in the cache under their
+#filename are not opened at all. The others are opened for their UUID, so a copy of a cached file at another
+#path is not counted again, and only the histograms of new files are read. A file replaced at the same path
+#keeps its cached count: remove its entry (or the cache) to count it again.
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import uproot
+from coffea import processor
+
+
+def readInputEventCount(fhandle):
+    #hEvents bin 2 counts events with positive, bin 0 with negative generator weight
+    values = fhandle["hEvents"].values()
+    return float(values[2] - values[0])
+
+
+def _fileCount(filename, cache, byFilename):
+    #UUID and count of a file, the count taken from the cache if the filename or the UUID is in it
+    if filename in byFilename:
+        return byFilename[filename], cache[byFilename[filename]]['count']
+    with uproot.open(filename) as fhandle:
+        uuid = str(fhandle.file.uuid)
+        if uuid in cache:
+            return uuid, cache[uuid]['count']
+        return uuid, readInputEventCount(fhandle)
+
+
+def loadCountCache(cachePath):
+    if cachePath is None or not os.path.exists(cachePath):
+        return {}
+    with open(cachePath) as f:
+        return json.load(f)
+
+
+def saveCountCache(cache, cachePath):
+    #merged with the current content of the file (another job may have written it meanwhile), then written atomically
+    current = loadCountCache(cachePath)
+    current.update(cache)
+    tmpName = f'{cachePath}.tmp{os.getpid()}'
+    with open(tmpName, 'w') as f:
+        json.dump(current, f, indent=1, sort_keys=True)
+    os.replace(tmpName, cachePath)
+
+
+def inputEventCounts(fileset, workers=16, cachePath=None):
+    """Sum of the hEvents counts of the files of each dataset, as a defaultdict_accumulator
+
+    The files are opened in a pool of workers threads. With cachePath, the count of every file is stored
+    there under its UUID (along with its filename): the files whose filename is in the cache are not opened,
+    and the histogram of the files whose UUID is in it is not read.
+    """
+    cache = loadCountCache(cachePath)
+    byFilename = {entry['filename']: uuid for uuid, entry in cache.items()}
+    filenames = sorted(set(f for files in fileset.values() for f in files))
+    fileCounts = {}
+    new = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for filename, (uuid, count) in zip(filenames, pool.map(lambda f: _fileCount(f, cache, byFilename), filenames)):
+            fileCounts[filename] = count
+            if uuid not in cache:
+                new[uuid] = {'filename': filename, 'count': count}
+    if cachePath is not None and len(new) > 0:
+        saveCountCache(new, cachePath)
+
+    counts = processor.defaultdict_accumulator(int)
+    for dataset, files in fileset.items():
+        for filename in files:
+            counts[dataset] += fileCounts[filename]
+    return counts
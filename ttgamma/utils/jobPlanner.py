@@ -0,0 +1,314 @@
+#Planning of balanced batch jobs (work units)
+#
+#Instead of one job per group of datasets (whose wall time is set by the largest group), the whole fileset is
+#split into N work units of about the same cost. The cost of a dataset is its number of entries times its time
+#per event, taken from the models measured by earlier runs with --memoryBudget (see chunkSizing.py), or from
+#defaultEventTime for the datasets without a model. The files of each kind (data and MC, which are processed
+#with different processors) are laid out one after the other and cut into consecutive pieces of the target cost,
+#splitting files by entry range where needed, so that every unit covers a few contiguous entry ranges.
+#
+#The plan (workUnits.json) lists the pieces of every unit, and a merge plan: the outputs of the units, which
+#runFullDataset.py --workUnit writes per dataset group, are summed into the usual output of each group.
+#
+#    python -m ttgamma.utils.jobPlanner plan 40 --jetSyst all
+#    python -m ttgamma.utils.jobPlanner merge workUnits.json
+
+import os
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import uproot
+from coffea import hist, processor
+
+from .chunkRunner import Chunk, fileChunkRanges, fileInfos
+from .datasetMetadata import filesetFiles, filesetMetadata
+
+#rough time per event (seconds) of the datasets without a measured model, from benchmarks/processThroughput.py
+defaultEventTime = {'data': 1e-4, 'mc': 3e-4}
+
+
+def datasetGroups(fileset):
+    """Group of each dataset of the fileset, as used for the outputs of runFullDataset.py (Data, MCTTGamma, ...)"""
+    mc_group_mapping = {
+        "MCTTGamma": [key for key in fileset if "TTGamma" in key],
+        "MCTTbar1l": ["TTbarPowheg_Semilept", "TTbarPowheg_Hadronic"],
+        "MCTTbar2l": ["TTbarPowheg_Dilepton"],
+        "MCSingleTop": [key for key in fileset if "ST" in key],
+        "MCZJets": [key for key in fileset if "DY" in key],
+        "MCWJets": [key for key in fileset if "W1" in key or "W2" in key or "W3" in key or "W4" in key],
+    }
+    mc_nonother = []
+    for mcType, sampleList in mc_group_mapping.items():
+        mc_nonother.extend(sampleList)
+    mc_group_mapping["MCOther"] = [key for key in fileset if (not key in mc_nonother) and (not "Data" in key)]
+    mc_group_mapping = {group: [key for key in datasets if key in fileset] for group, datasets in mc_group_mapping.items()}
+    return OrderedDict([("Data", [key for key in fileset if "Data" in key])] + list(mc_group_mapping.items()))
+
+
+def outputName(group, unitID=None):
+    #name (without extension) of the output of a group, or of the part of it processed by a work unit
+    name = f"output{group}_ttgamma_condorFull_4jet"
+    return name if unitID is None else f"{name}_unit{unitID}"
+
+
+def _fileEntries(filename):
+    with uproot.open(filename) as fhandle:
+        return fhandle['Events'].num_entries
+
+
+def fileEntries(filenames, workers=16, cachePath=None):
+    """Number of entries of every file, read in a pool of threads and cached by filename in cachePath"""
+    cache = {}
+    if cachePath is not None and os.path.exists(cachePath):
+        with open(cachePath) as f:
+            cache = json.load(f)
+    toRead = sorted(set(f for f in filenames if f not in cache))
+    if len(toRead) > 0:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            cache.update(zip(toRead, pool.map(_fileEntries, toRead)))
+        if cachePath is not None:
+            tmpName = f'{cachePath}.tmp{os.getpid()}'
+            with open(tmpName, 'w') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+            os.replace(tmpName, cachePath)
+    return {f: cache[f] for f in filenames}
+
+
+def datasetEventTimes(datasets, models, configs):
+    """Time per event of each dataset, from the chunk size models (for the processor configuration of its kind)"""
+    eventTimes = {}
+    for dataset in datasets:
+        kind = 'data' if 'Data' in dataset else 'mc'
+        model = models.get(f"{dataset}|{configs[kind]}")
+        eventTimes[dataset] = model['eventTime'] if model is not None and model['eventTime'] > 0 else defaultEventTime[kind]
+    return eventTimes
+
+
+def _splitKind(items, nUnits, chunksize=None):
+    #cut the (group, dataset, filename, entries, eventTime) items into nUnits lists of consecutive pieces of equal cost,
+    #with chunksize only at the chunk boundaries of the files, so that the units run the same chunks as a whole file
+    totalCost = sum(entries*eventTime for _, _, _, entries, eventTime in items)
+    target = totalCost/nUnits
+    units = [[]]
+    unitCost = 0.
+    for group, dataset, filename, entries, eventTime in items:
+        start = 0
+        while start < entries:
+            if len(units) < nUnits:
+                #the number of entries that brings the unit to the target cost
+                stop = min(entries, start + max(int(round((target - unitCost)/eventTime)), 1))
+                if chunksize is not None:
+                    datasetChunksize = chunksize[dataset] if isinstance(chunksize, dict) else chunksize
+                    boundaries = [chunkStop for _, chunkStop in fileChunkRanges(entries, datasetChunksize) if chunkStop > start]
+                    stop = min(boundaries, key=lambda boundary: abs(boundary - stop))
+            else:
+                stop = entries
+            units[-1].append({'group': group, 'dataset': dataset, 'filename': filename, 'entrystart': start, 'entrystop': stop})
+            unitCost += (stop - start)*eventTime
+            start = stop
+            #a file is only cut where the unit is full (the cut is moved to a chunk boundary with chunksize)
+            if (unitCost >= target*(1 - 1e-9) or stop < entries) and len(units) < nUnits:
+                units.append([])
+                unitCost = 0.
+    return [unit for unit in units if len(unit) > 0]
+
+
+def planWorkUnits(fileset, nUnits, eventTimes, entries, chunksize=None):
+    """Split the fileset into about nUnits work units of equal cost
+
+    eventTimes is the time per event of each dataset, entries the number of entries of each file. The units are
+    shared between data and MC in proportion to their cost (at least one each, if present). With chunksize (or
+    chunksize[dataset]), files are only split at the boundaries of their chunks (see fileChunkRanges), and the
+    --workUnit runs use these chunk sizes.
+    The fileset can have metadata (see datasetMetadata.py), which is kept in the plan for the --workUnit runs.
+    Returns the plan, see writePlan
+    """
+    metadata = filesetMetadata(fileset)
+    fileset = filesetFiles(fileset)
+    groups = datasetGroups(fileset)
+    items = {'data': [], 'mc': []}
+    for group, datasets in groups.items():
+        for dataset in datasets:
+            for filename in fileset[dataset]:
+                items['data' if group == 'Data' else 'mc'].append((group, dataset, filename, entries[filename], eventTimes[dataset]))
+
+    costs = {kind: sum(e*t for _, _, _, e, t in kindItems) for kind, kindItems in items.items()}
+    kinds = [kind for kind in ['data', 'mc'] if costs[kind] > 0]
+    kindUnits = {kind: max(1, int(round(nUnits*costs[kind]/sum(costs.values())))) for kind in kinds}
+    if len(kinds) == 2 and sum(kindUnits.values()) > nUnits and nUnits >= 2:
+        larger = max(kinds, key=lambda kind: kindUnits[kind])
+        kindUnits[larger] -= sum(kindUnits.values()) - nUnits
+
+    units = []
+    for kind in kinds:
+        for pieces in _splitKind(items[kind], kindUnits[kind], chunksize):
+            units.append({'id': len(units), 'isMC': kind == 'mc', 'pieces': pieces,
+                          'events': sum(p['entrystop'] - p['entrystart'] for p in pieces),
+                          'cost': sum((p['entrystop'] - p['entrystart'])*eventTimes[p['dataset']] for p in pieces)})
+
+    #the number of generated events of a dataset (for the normalization) is added to the output by only one unit,
+    #the first one with a piece of the dataset, so that it is counted once when the outputs are summed
+    counted = set()
+    for unit in units:
+        unit['countDatasets'] = []
+        for piece in unit['pieces']:
+            if unit['isMC'] and piece['dataset'] not in counted:
+                counted.add(piece['dataset'])
+                unit['countDatasets'].append(piece['dataset'])
+
+    merge = OrderedDict()
+    for unit in units:
+        for group in unitGroups(unit):
+            merge.setdefault(outputName(group), []).append(outputName(group, unit['id']))
+
+    datasets = {dataset: {'group': group, 'files': fileset[dataset], 'eventTime': eventTimes[dataset], 'metadata': metadata[dataset]}
+                for group, groupDatasets in groups.items() for dataset in groupDatasets}
+    return {'datasets': datasets, 'chunksize': chunksize, 'units': units, 'merge': merge}
+
+
+def unitGroups(unit):
+    """Pieces of a work unit, by dataset group (in the order of the plan)"""
+    groups = OrderedDict()
+    for piece in unit['pieces']:
+        groups.setdefault(piece['group'], []).append(piece)
+    return groups
+
+
+def pieceChunks(pieces, chunksize, localPaths=None, metadata=None, treename='Events'):
+    """Chunks covering the pieces of a work unit: the chunks of their files in getChunks (for chunksize, or chunksize[dataset]), cut at the piece boundaries
+
+    localPaths can map the filenames of the pieces to the paths to read them from (e.g. copies in a file cache),
+    metadata can give the metadata of each dataset (see datasetMetadata.py)
+    """
+    localName = lambda piece: localPaths[piece['filename']] if localPaths is not None else piece['filename']
+    infos = fileInfos([localName(piece) for piece in pieces], treename)
+    chunks = []
+    for piece in pieces:
+        filename = localName(piece)
+        datasetChunksize = chunksize[piece['dataset']] if isinstance(chunksize, dict) else chunksize
+        nEntries, fileuuid = infos[filename]
+        for entrystart, entrystop in fileChunkRanges(nEntries, datasetChunksize):
+            entrystart, entrystop = max(entrystart, piece['entrystart']), min(entrystop, piece['entrystop'])
+            if entrystart < entrystop:
+                chunks.append(Chunk(piece['dataset'], filename, treename, fileuuid, entrystart, entrystop,
+                                    metadata.get(piece['dataset']) if metadata is not None else None))
+    return chunks
+
+
+def longestFirst(chunks, eventTimes):
+    """The chunks sorted by decreasing estimated time (entries times the time per event of their dataset)
+
+    Started first, the longest chunks do not end up at the tail of a run, when the other workers are already idle
+    """
+    return sorted(chunks, key=lambda chunk: -(chunk.entrystop - chunk.entrystart)*eventTimes[chunk.dataset])
+
+
+def splitByGroup(output, groups, chunks):
+    """Split the output of a run over the datasets of several groups into the output of each group
+
+    The histograms are split along their dataset axis, and InputEventCount by dataset. EventCount, which is not
+    kept by dataset, is recomputed from the chunks of the datasets of the group. Other entries (StageTimes) are dropped.
+    Returns a dict from group to output, for the groups with datasets in the chunks
+    """
+    groupOutputs = OrderedDict()
+    for group, datasets in groups.items():
+        groupChunks = [chunk for chunk in chunks if chunk.dataset in datasets]
+        if len(groupChunks) == 0:
+            continue
+        groupOutput = processor.dict_accumulator({})
+        for key, obj in output.items():
+            if isinstance(obj, hist.Hist):
+                datasetAxis = obj.axis('dataset')
+                groupOutput[key] = obj.group(datasetAxis, hist.Cat(datasetAxis.name, datasetAxis.label), {dataset: [dataset] for dataset in datasets})
+        groupOutput['EventCount'] = processor.value_accumulator(int, sum(chunk.entrystop - chunk.entrystart for chunk in groupChunks))
+        if 'InputEventCount' in output and any(dataset in output['InputEventCount'] for dataset in datasets):
+            groupOutput['InputEventCount'] = processor.defaultdict_accumulator(int)
+            for dataset in datasets:
+                if dataset in output['InputEventCount']:
+                    groupOutput['InputEventCount'][dataset] = output['InputEventCount'][dataset]
+        groupOutputs[group] = groupOutput
+    return groupOutputs
+
+
+def writePlan(plan, planPath):
+    """Write the plan to planPath, and the list of unit IDs (for condor's queue ... from) next to it, with a .txt suffix"""
+    with open(planPath, 'w') as f:
+        json.dump(plan, f, indent=1)
+    with open(os.path.splitext(planPath)[0] + '.txt', 'w') as f:
+        f.write(''.join(f"{unit['id']}\n" for unit in plan['units']))
+
+
+def loadPlan(planPath):
+    with open(planPath) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def printPlan(plan):
+    costs = [unit['cost'] for unit in plan['units']]
+    print(f"{'unit':>4} {'kind':>4} {'events':>11} {'cost [s]':>9} {'pieces':>6}  groups")
+    for unit in plan['units']:
+        print(f"{unit['id']:>4} {'MC' if unit['isMC'] else 'data':>4} {unit['events']:>11} {unit['cost']:>9.0f} "
+              f"{len(unit['pieces']):>6}  {', '.join(unitGroups(unit))}")
+    print(f"{len(costs)} units, total cost {sum(costs):.0f} s, largest unit {max(costs):.0f} s (ideal {sum(costs)/len(costs):.0f} s)")
+
+
+if __name__ == "__main__":
+    import argparse
+    from .mergeOutputs import mergeOutputs
+
+    parser = argparse.ArgumentParser(description="Plan balanced work units for runFullDataset.py --workUnit, and merge their outputs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    planParser = subparsers.add_parser("plan", help="Split the fileset into work units")
+    planParser.add_argument("nUnits", type=int, help="Number of work units")
+    planParser.add_argument("--output", type=str, default="workUnits.json", help="Plan file (the list of unit IDs is written next to it, with a .txt suffix)")
+    planParser.add_argument("--fileset", type=str, default=None, help="JSON file with the fileset, instead of ttgamma/utils/fileset2021.py")
+    planParser.add_argument("--jetSyst", type=str, default="nominal", help="Jet systematics of the MC jobs (as in runFullDataset.py), to find the matching models")
+    planParser.add_argument("--chunkModels", type=str, default="chunkSizes.json", help="Models measured by runFullDataset.py --memoryBudget, with the time per event of each dataset")
+    planParser.add_argument("--chunksize", type=int, default=100000, help="Chunk size of the --workUnit runs: files are only split between units at the boundaries of their chunks, use 0 to split anywhere (the runs then use their own --chunksize)")
+    planParser.add_argument("--memoryBudget", type=float, default=None, help="Memory budget (GB) of each worker: the chunk size of each dataset is chosen from probes run here, as by runFullDataset.py --memoryBudget, and used by every --workUnit run (replaces --chunksize)")
+    planParser.add_argument("--maxChunksize", type=int, default=1000000, help="Largest chunk size chosen with --memoryBudget")
+    planParser.add_argument("--entryCache", type=str, default="fileEntries.json", help="JSON file caching the number of entries of each file, use '' to disable")
+    mergeParser = subparsers.add_parser("merge", help="Sum the outputs of the work units into the output of each group")
+    mergeParser.add_argument("plan", type=str, help="Plan file")
+    mergeParser.add_argument("--inputDir", type=str, default=".", help="Directory of the outputs of the work units")
+    mergeParser.add_argument("--outputDir", type=str, default=".", help="Directory of the merged outputs")
+    mergeParser.add_argument("--indexed", action="store_true", help="Also write the merged outputs in the indexed format (.hists)")
+    mergeParser.add_argument("-j", "--workers", type=int, default=1, help="Number of merges to run in parallel")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        from ttgamma import TTGammaProcessor
+        from .chunkSizing import loadModels, processorConfig, chooseChunkSizes
+
+        if args.fileset:
+            with open(args.fileset) as f:
+                fileset = json.load(f)
+        else:
+            from .fileset2021 import fileset
+        jetSyst = args.jetSyst if args.jetSyst == "all" else args.jetSyst.split(",")
+        processors = {'data': TTGammaProcessor(isMC=False), 'mc': TTGammaProcessor(isMC=True, jetSyst=jetSyst)}
+        configs = {kind: processorConfig(processor_instance) for kind, processor_instance in processors.items()}
+        chunksize = args.chunksize if args.chunksize > 0 else None
+        if args.memoryBudget is not None:
+            #the chunk sizes are fixed here, once, so the jobs do not probe on the worker nodes and get the same chunks
+            #(and the same jet smearing in MC) whichever node runs them
+            chunksize = {}
+            for kind, processor_instance in processors.items():
+                kindFileset = {dataset: files for dataset, files in filesetFiles(fileset).items() if ('Data' in dataset) == (kind == 'data')}
+                chunksize.update(chooseChunkSizes(kindFileset, processor_instance, args.memoryBudget*1e9,
+                                                  cachePath=args.chunkModels if args.chunkModels else None, maxChunksize=args.maxChunksize))
+        eventTimes = datasetEventTimes(fileset, loadModels(args.chunkModels if args.chunkModels else None), configs)
+        entries = fileEntries([f for files in filesetFiles(fileset).values() for f in files], cachePath=args.entryCache if args.entryCache else None)
+        plan = planWorkUnits(fileset, args.nUnits, eventTimes, entries, chunksize)
+        writePlan(plan, args.output)
+        printPlan(plan)
+
+    if args.command == "merge":
+        plan = loadPlan(args.plan)
+        os.makedirs(args.outputDir, exist_ok=True)
+        for output, inputs in plan['merge'].items():
+            inputs = [os.path.join(args.inputDir, f"{name}.coffea") for name in inputs]
+            mergeOutputs(inputs, os.path.join(args.outputDir, f"{output}.coffea"), workers=args.workers)
+            if args.indexed:
+                mergeOutputs([os.path.join(args.outputDir, f"{output}.coffea")], os.path.join(args.outputDir, f"{output}.hists"))
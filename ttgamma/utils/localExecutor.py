@@ -0,0 +1,81 @@
+#Local executors for the chunk runner and coffea's run_uproot_job
+#
+#The same processor can be run over the chunks
+#  - iterative: one after the other in this process (for profiling, or debugging with pdb)
+#  - futures: in a pool of workers processes, which take the chunks in the order of the list
+#  - dask: on a dask distributed cluster started on this node (workers processes with one thread each, and a
+#    scheduler in this process, no outside services), whose scheduler moves queued chunks from busy workers to
+#    idle ones (work stealing), so a few slow chunks (TTbar, DY) do not leave the other workers idle at the end.
+#    Each worker can be given a memory limit, above which dask pauses it, and restarts it if it keeps growing.
+#
+#The results are returned in the order of the chunks with every executor, so the summed outputs are identical.
+#
+#    with LocalExecutor('dask', workers=8, memoryLimit=4e9) as executor:
+#        output, _ = runChunks(chunks, processor_instance, executor=executor)
+
+from concurrent.futures import ProcessPoolExecutor
+
+from coffea import processor
+
+executorNames = ('iterative', 'futures', 'dask')
+
+
+class LocalExecutor:
+    """Workers of the given kind (see executorNames), started when it is created and stopped by close()"""
+
+    def __init__(self, name, workers=1, memoryLimit=None):
+        if name not in executorNames:
+            raise ValueError(f"Unknown executor {name}, should be one of {', '.join(executorNames)}")
+        self.name = name
+        self.workers = 1 if name == 'iterative' else workers
+        self.pool = None
+        self.cluster = None
+        self.client = None
+        if name == 'futures' and workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        elif name == 'dask':
+            import dask
+            from dask.distributed import LocalCluster, Client
+
+            #the workers are forked, as the processes of the futures pool: spawned workers would run the
+            #calling script again (runFullDataset.py has no __main__ guard)
+            dask.config.set({'distributed.worker.multiprocessing-method': 'fork'})
+            self.cluster = LocalCluster(n_workers=workers, threads_per_worker=1, processes=True,
+                                        memory_limit=memoryLimit if memoryLimit is not None else 'auto',
+                                        dashboard_address=None)
+            self.client = Client(self.cluster)
+
+    def map(self, function, items):
+        """Iterate over the results of function for each of items, in the order of items"""
+        if self.client is not None:
+            futures = self.client.map(function, items, pure=False)
+            for future in futures:
+                yield future.result()
+                #the result is not kept on the worker once it is summed
+                future.release()
+        elif self.pool is not None:
+            yield from self.pool.map(function, items)
+        else:
+            yield from map(function, items)
+
+    def coffeaExecutor(self, status=True):
+        """coffea executor and executor_args for run_uproot_job running on these workers"""
+        if self.name == 'dask':
+            return processor.dask_executor, {'client': self.client, 'status': status}
+        if self.name == 'futures':
+            return processor.futures_executor, {'workers': self.workers, 'status': status}
+        return processor.iterative_executor, {'status': status}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.client is not None:
+            self.client.close()
+            self.cluster.close()
+        self.pool = self.client = self.cluster = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,167 @@
+#Parallel merging of processor output files
+#
+#The inputs are summed with a tree reduction: each step merges groups of fanIn files in a pool of
+#worker processes, writing every partial sum to an intermediate file, until a single file is left.
+#By default, the files of each step are shared evenly between the workers, and once there are no more files
+#than workers they are summed by a single merge: a serial merge is a single pass, with no intermediate files.
+#Each merge loads its inputs one at a time and adds them into the first one, so a worker holds at
+#most two accumulators at once, and no copy of them is made.
+#Inputs and output can be .coffea files or indexed output files (see indexedOutput.py).
+
+import os
+import math
+import time
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import lz4.frame
+import psutil
+
+from coffea import util
+
+from .indexedOutput import saveIndexed, loadOutput, indexedSuffix
+
+
+def saveAtomic(output, filename):
+    """util.save to a temporary file next to filename, then move it in place
+
+    filename never holds a partially written output, even if the job is killed while saving.
+    Files with the indexed output suffix are written in the indexed format.
+    """
+    if filename.endswith(indexedSuffix):
+        saveIndexed(output, filename)
+        return
+    tmpName = f'{filename}.tmp{os.getpid()}'
+    try:
+        util.save(output, tmpName)
+        os.replace(tmpName, filename)
+    finally:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+
+
+def uncompressedSize(filename, blockSize=1 << 24):
+    #size of the pickle stored in a .coffea file, a proxy for the memory needed to load it
+    if filename.endswith(indexedSuffix):
+        return os.path.getsize(filename)
+    size = 0
+    with lz4.frame.open(filename) as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                return size
+            size += len(block)
+
+
+def mergeFiles(inputs, output):
+    """Sum the accumulators in the input files and save the result to output
+
+    Returns the time taken, the total (compressed) size of the inputs and the peak RSS of the process during the merge
+    """
+    start = time.perf_counter()
+    process = psutil.Process()
+    merged = loadOutput(inputs[0])
+    peakRSS = process.memory_info().rss
+    for filename in inputs[1:]:
+        part = loadOutput(filename)
+        peakRSS = max(peakRSS, process.memory_info().rss)
+        merged.add(part)
+        del part
+    saveAtomic(merged, output)
+    peakRSS = max(peakRSS, process.memory_info().rss)
+    return time.perf_counter() - start, sum(os.path.getsize(f) for f in inputs), peakRSS
+
+
+def _mergeFiles(args):
+    return mergeFiles(*args)
+
+
+def mergeOutputs(inputs, output, workers=1, fanIn=None, maxMemory=None, status=True):
+    """Sum the accumulators of many .coffea files into a single output file, with a tree reduction
+
+    workers is the number of merges run in parallel, fanIn the number of files summed by each merge
+    (by default, the inputs are shared evenly between the workers). With maxMemory (in bytes), fewer merges are run
+    at once in a step if the estimated memory of a merge (three times the largest uncompressed input:
+    two accumulators and the pickle written at the end) times the number of merges would exceed it.
+    The intermediate files are written to a temporary directory next to output and removed at the end.
+    """
+    if len(inputs) == 0:
+        raise ValueError("No input files to merge")
+    if fanIn is not None and fanIn < 2:
+        raise ValueError("fanIn must be at least 2")
+
+    outputDir = os.path.dirname(os.path.abspath(output))
+    if len(inputs) == 1:
+        if inputs[0].endswith(indexedSuffix) != output.endswith(indexedSuffix):
+            saveAtomic(loadOutput(inputs[0]), output)
+            return
+        tmpName = f'{output}.tmp{os.getpid()}'
+        shutil.copyfile(inputs[0], tmpName)
+        os.replace(tmpName, output)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    tmpDir = tempfile.mkdtemp(prefix='merge_', dir=outputDir)
+    try:
+        level = inputs
+        step = 0
+        while len(level) > 1:
+            step += 1
+            stepFanIn = fanIn
+            if stepFanIn is None:
+                stepFanIn = max(2, math.ceil(len(level)/workers)) if len(level) > workers else len(level)
+            groups = [level[i:i+stepFanIn] for i in range(0, len(level), stepFanIn)]
+            #a group with a single file is passed on to the next step as it is
+            merges = [(group, output if len(groups) == 1 else os.path.join(tmpDir, f'step{step}_{i}.coffea'))
+                      for i, group in enumerate(groups) if len(group) > 1]
+
+            maxInFlight = workers
+            if maxMemory is not None:
+                mergeMemory = 3*max(uncompressedSize(f) for group, _ in merges for f in group)
+                maxInFlight = max(1, min(workers, int(maxMemory // mergeMemory)))
+                if status and maxInFlight < workers:
+                    print(f"[merge] step {step}: running {maxInFlight} merges at once to stay below {maxMemory/1e9:.2f} GB "
+                          f"(about {mergeMemory/1e9:.2f} GB per merge)")
+
+            start = time.perf_counter()
+            results = _runMerges(merges, pool, maxInFlight)
+            elapsed = time.perf_counter() - start
+
+            #intermediate files of the previous step are not needed any more
+            for group, _ in merges:
+                for f in group:
+                    if os.path.dirname(f) == tmpDir:
+                        os.remove(f)
+
+            if status:
+                inputBytes = sum(r[1] for r in results)
+                peakRSS = max(r[2] for r in results)
+                print(f"[merge] step {step}: {len(level)} -> {len(groups)} files, {len(merges)} merges, "
+                      f"{inputBytes/1e6:.1f} MB in {elapsed:.1f} s ({inputBytes/1e6/max(elapsed, 1e-9):.1f} MB/s), "
+                      f"peak worker RSS {peakRSS/1e9:.2f} GB")
+
+            merged = iter(out for _, out in merges)
+            level = [next(merged) if len(group) > 1 else group[0] for group in groups]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+def _runMerges(merges, pool, maxInFlight):
+    #run the merges of one step, with at most maxInFlight of them at once
+    if pool is None:
+        return [mergeFiles(*merge) for merge in merges]
+
+    results = [None]*len(merges)
+    running = {}
+    todo = list(enumerate(merges))
+    while todo or running:
+        while todo and len(running) < maxInFlight:
+            i, merge = todo.pop(0)
+            running[pool.submit(_mergeFiles, merge)] = i
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[running.pop(future)] = future.result()
+    return results
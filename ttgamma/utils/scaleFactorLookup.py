@@ -0,0 +1,70 @@
+import numpy as np
+import awkward as ak
+
+
+class MultiLookup:
+    """Lookup table with several outputs (scale factor, error, ...) sharing the same binning
+
+    The values of all outputs are stacked in a single array, so evaluating the lookup does a
+    single bin search per object and returns all outputs at once, as a dict of arrays with
+    the same (jagged) structure as the inputs. Out of range values are clipped to the first
+    or last bin, as in coffea's dense_lookup.
+    """
+    def __init__(self, values, edges):
+        self._names = list(values.keys())
+        self._edges = [np.asarray(e) for e in edges]
+        self._values = np.stack([np.asarray(values[name]) for name in self._names], axis=-1)
+        #the outputs are returned with their original dtype, even if the stacked array is promoted
+        self._dtypes = [np.asarray(values[name]).dtype for name in self._names]
+
+        shape = tuple(len(e)-1 for e in self._edges)
+        if self._values.shape[:-1] != shape:
+            raise ValueError(f"Values of shape {self._values.shape[:-1]} do not match the binning {shape}")
+
+    @classmethod
+    def fromDenseLookups(cls, **lookups):
+        """Stack dense_lookup objects with identical binning, the keyword names are used as output names"""
+        edges = None
+        for name, lookup in lookups.items():
+            lookupEdges = [lookup._axes] if isinstance(lookup._axes, np.ndarray) else list(lookup._axes)
+            if edges is None:
+                edges = lookupEdges
+            elif len(edges) != len(lookupEdges) or not all(np.array_equal(a, b) for a, b in zip(edges, lookupEdges)):
+                raise ValueError(f"Lookup {name} does not have the same binning as {list(lookups)[0]}")
+        return cls({name: lookup._values for name, lookup in lookups.items()}, edges)
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    def __call__(self, *args):
+        if len(args) != len(self._edges):
+            raise ValueError(f"Expected {len(self._edges)} arguments, got {len(args)}")
+
+        #flatten the (jagged) inputs, the outputs are given the same structure again at the end
+        counts = ak.num(args[0]) if args[0].ndim > 1 else None
+        flatArgs = [ak.to_numpy(ak.flatten(a)) if counts is not None else np.asarray(a) for a in args]
+
+        indices = tuple(np.clip(np.searchsorted(edges, a, side='right') - 1, 0, len(edges)-2)
+                        for edges, a in zip(self._edges, flatArgs))
+        values = self._values[indices]
+
+        outputs = {name: values[:, i].astype(dtype) for i, (name, dtype) in enumerate(zip(self._names, self._dtypes))}
+        if counts is None:
+            return outputs
+        return {name: ak.unflatten(output, counts) for name, output in outputs.items()}
+
+
+def sfUpDown(*sfErrs):
+    """Per event product of the scale factors of all objects, and its up and down variations
+
+    Takes (sf, err) pairs of per object arrays, and returns the event weights
+    prod(sf1*sf2*...), prod((sf1+err1)*(sf2+err2)*...) and prod((sf1-err1)*(sf2-err2)*...)
+    """
+    sf, err = sfErrs[0]
+    nominal, up, down = sf, sf + err, sf - err
+    for sf, err in sfErrs[1:]:
+        nominal = nominal * sf
+        up = up * (sf + err)
+        down = down * (sf - err)
+    return ak.prod(nominal, axis=-1), ak.prod(up, axis=-1), ak.prod(down, axis=-1)
@@ -0,0 +1,132 @@
+#Skims of the events passing the pre-selection
+#
+#Only the events passing TTGammaProcessor.preSelectionMask can enter a histogram, whatever the jet
+#systematic, so rerunning the processor on them gives the same results as on the full files. A skim file
+#holds these events, with only the branches of the processor's branch manifest, in an LZ4 compressed
+#ROOT file with the same branch names as NanoAOD, along with the hEvents histogram of the input file
+#(for the normalization). The skim files are written per input file, and the fileset of the skim can be
+#used in place of the original fileset.
+#
+#Note that the JER smearing of jets without a matched gen jet uses random numbers seeded from the jets
+#of the chunk, so the smeared MC jets of a skim differ (statistically equivalently) from the full files.
+
+import os
+import json
+import fcntl
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import awkward as ak
+import uproot
+
+from .chunkRunner import Chunk, readChunk, preloadedEvents
+
+
+def skimBranches(arrays):
+    """Group flat NanoAOD branches into the structure written by uproot
+
+    Branches of a collection X (with a counter branch nX) are zipped into a record array X, which uproot writes
+    back as nX and X_* branches. The counters themselves are dropped, since uproot writes them.
+    """
+    counters = {b[1:] for b in arrays if b.startswith('n') and any(a == b[1:] or a.startswith(b[1:] + '_') for a in arrays)}
+    data = {}
+    collections = {}
+    for branch, array in arrays.items():
+        collection = branch.split('_')[0]
+        if branch.startswith('n') and branch[1:] in counters:
+            continue
+        if collection in counters and branch != collection:
+            collections.setdefault(collection, {})[branch[len(collection)+1:]] = array
+        else:
+            data[branch] = array
+    for collection, fields in collections.items():
+        data[collection] = ak.zip(fields)
+    return data
+
+
+def skimFile(processor_instance, filename, outputName, dataset, chunksize=100000, treename='Events',
+             compression=uproot.LZ4(4), flushEvents=100000):
+    """Write the events of filename passing the pre-selection to outputName
+
+    The events are selected with processor_instance.preSelectionMask, so processor_instance should apply all
+    pre-selection stages (the default). The input is read in chunks of chunksize events, and the selected events
+    are written in baskets of about flushEvents events. Returns the number of events read and written.
+    """
+    tmpName = f'{outputName}.tmp{os.getpid()}'
+    nIn, nOut = 0, 0
+    try:
+        with uproot.open(filename) as fhandle, uproot.recreate(tmpName, compression=compression) as fout:
+            tree = fhandle[treename]
+            fileuuid = str(fhandle.file.uuid)
+            pending = []
+            for entrystart in range(0, max(tree.num_entries, 1), chunksize):
+                chunk = Chunk(dataset, filename, treename, fileuuid, entrystart, min(entrystart + chunksize, tree.num_entries))
+                arrays = readChunk(tree, chunk, processor_instance.branches)
+                mask = processor_instance.preSelectionMask(preloadedEvents(arrays, chunk))
+                pending.append({branch: array[mask] for branch, array in arrays.items()})
+                nIn += len(mask)
+
+                last = chunk.entrystop >= tree.num_entries
+                if last or sum(len(next(iter(p.values()))) for p in pending) >= flushEvents:
+                    batch = skimBranches({branch: ak.concatenate([p[branch] for p in pending]) for branch in pending[0]})
+                    if treename not in fout:
+                        fout.mktree(treename, {branch: array.type for branch, array in batch.items()})
+                    if len(next(iter(batch.values()))) > 0:
+                        fout[treename].extend(batch)
+                        nOut += len(next(iter(batch.values())))
+                    pending = []
+            if 'hEvents' in fhandle:
+                fout['hEvents'] = fhandle['hEvents']
+        os.replace(tmpName, outputName)
+    finally:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+    return nIn, nOut
+
+
+def _skimFile(args):
+    return skimFile(*args)
+
+
+def skimFileset(fileset, processor_instance, outputDir, chunksize=100000, workers=1, status=True):
+    """Skim every file of the fileset into outputDir, in a pool of worker processes if workers > 1
+
+    The skim of each file is written to outputDir/<dataset>/<hash of the input name>.root (files already
+    there are not skimmed again), and the datasets are added to the fileset of the skims in outputDir/fileset.json.
+    Returns the fileset of the skims of this fileset.
+    """
+    skimFiles = {}
+    todo = []
+    for dataset, files in fileset.items():
+        os.makedirs(os.path.join(outputDir, dataset), exist_ok=True)
+        skimFiles[dataset] = []
+        for filename in files:
+            outputName = os.path.join(outputDir, dataset, f'{hashlib.sha1(filename.encode()).hexdigest()}.root')
+            skimFiles[dataset].append(os.path.abspath(outputName))
+            if not os.path.exists(outputName):
+                todo.append((processor_instance, filename, outputName, dataset, chunksize))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_skimFile, todo))
+    else:
+        results = [_skimFile(args) for args in todo]
+
+    if status:
+        for args, (nIn, nOut) in zip(todo, results):
+            print(f"Skimmed {args[1]}: {nOut}/{nIn} events ({nOut/max(nIn, 1):.1%})")
+
+    #several jobs (e.g. the mcGroups of runFullDataset.py) can skim their datasets into the same directory,
+    #the fileset is locked while it is updated so that none of their datasets is lost
+    filesetName = os.path.join(outputDir, 'fileset.json')
+    with open(os.path.join(outputDir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        allSkimFiles = {}
+        if os.path.exists(filesetName):
+            with open(filesetName) as f:
+                allSkimFiles = json.load(f)
+        allSkimFiles.update(skimFiles)
+        with open(f'{filesetName}.tmp{os.getpid()}', 'w') as f:
+            json.dump(allSkimFiles, f, indent=1)
+        os.replace(f'{filesetName}.tmp{os.getpid()}', filesetName)
+    return skimFiles
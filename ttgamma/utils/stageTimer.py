@@ -0,0 +1,83 @@
+#Per-stage timing of TTGammaProcessor.process
+#
+#process() marks the beginning of each of its stages with timer.start(name). With timing enabled, the wall
+#time, CPU time and increase of the peak RSS of the process during each stage are added to a StageTimes
+#accumulator in the output, which sums over chunks and workers like the histograms. With timing disabled,
+#NullStageTimer does nothing, so the only cost is one empty method call per stage.
+#
+#The jets with the jet energy corrections are built lazily, so their computation is included in the stages
+#of the jet systematic loop which first use them (jetSelection), not in jetCorrections.
+
+import time
+import resource
+
+from coffea.processor import AccumulatorABC
+
+
+def peakRSS():
+    #peak resident set size of this process, in bytes (ru_maxrss is in kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageTimes(AccumulatorABC):
+    """Wall time, CPU time, peak RSS increase (bytes) and number of calls of each stage, summed over chunks
+
+    The stages are kept in the order they were first seen, which is the order of process()
+    """
+    def __init__(self, stages=None):
+        self.stages = {} if stages is None else stages
+
+    def identity(self):
+        return StageTimes()
+
+    def add(self, other):
+        for name, values in other.stages.items():
+            current = self.stages.setdefault(name, [0., 0., 0, 0])
+            for i, value in enumerate(values):
+                current[i] += value
+
+    def record(self, name, wall, cpu, rss):
+        self.add(StageTimes({name: [wall, cpu, rss, 1]}))
+
+    def table(self):
+        """Summary table of the stages, with the fraction of the total wall time spent in each"""
+        totalWall = sum(values[0] for values in self.stages.values())
+        lines = [f"{'stage':<20} {'calls':>7} {'wall [s]':>10} {'cpu [s]':>10} {'wall %':>7} {'peak RSS +[MB]':>15}"]
+        for name, (wall, cpu, rss, calls) in self.stages.items():
+            lines.append(f"{name:<20} {calls:>7} {wall:>10.2f} {cpu:>10.2f} {100*wall/max(totalWall, 1e-12):>7.1f} {rss/1e6:>15.1f}")
+        lines.append(f"{'total':<20} {'':>7} {totalWall:>10.2f} {sum(v[1] for v in self.stages.values()):>10.2f} {100.:>7.1f} "
+                     f"{sum(v[2] for v in self.stages.values())/1e6:>15.1f}")
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return f"StageTimes({self.stages!r})"
+
+
+class StageTimer:
+    """Records the stages of one call of process() into a StageTimes accumulator
+
+    start(name) ends the current stage (if any) and starts the next one, stop() ends the current stage
+    """
+    def __init__(self, stageTimes):
+        self.stageTimes = stageTimes
+        self._current = None
+
+    def start(self, name):
+        self.stop()
+        self._current = (name, time.perf_counter(), time.process_time(), peakRSS())
+
+    def stop(self):
+        if self._current is None:
+            return
+        name, wall, cpu, rss = self._current
+        self.stageTimes.record(name, time.perf_counter() - wall, time.process_time() - cpu, peakRSS() - rss)
+        self._current = None
+
+
+class NullStageTimer:
+    """StageTimer used when timing is disabled"""
+    def start(self, name):
+        pass
+
+    def stop(self):
+        pass
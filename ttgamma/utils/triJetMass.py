@@ -0,0 +1,57 @@
+import numpy as np
+import numba
+import awkward as ak
+
+@numba.njit(parallel=True)
+def bestTriJetMassKernel(x, y, z, t, offsets, default):
+    m3 = np.full(len(offsets)-1, default, x.dtype)
+
+    #i is the event number
+    for i in numba.prange(len(offsets)-1):
+        bestPt = -1.
+        #loop over all unique triplets j < k < l, in the same order as ak.combinations,
+        #only keeping the running best pt and its mass (the first triplet is kept in case of ties, as in ak.argmax)
+        for j in range(offsets[i], offsets[i+1]):
+            for k in range(j+1, offsets[i+1]):
+                #partial sums are done in the same order as (first + second) + third
+                x2 = x[j] + x[k]
+                y2 = y[j] + y[k]
+                z2 = z[j] + z[k]
+                t2 = t[j] + t[k]
+                for l in range(k+1, offsets[i+1]):
+                    x3 = x2 + x[l]
+                    y3 = y2 + y[l]
+                    z3 = z2 + z[l]
+                    t3 = t2 + t[l]
+                    pt = np.sqrt(x3*x3 + y3*y3)
+                    if pt > bestPt:
+                        bestPt = pt
+                        m3[i] = np.sqrt(t3*t3 - x3*x3 - y3*y3 - z3*z3)
+
+    return m3
+
+
+def bestTriJetMass(jets, default=-1):
+    """M3, the mass of the combination of 3 jets with the highest pt, for every event
+
+    Gives the same values as triJetMass[ak.argmax(triJetPt,axis=-1,keepdims=True)] from
+    ak.combinations(jets,3), but only keeps the best triplet while looping over the combinations
+    instead of building all of them. Returns a flat numpy array with one entry per event,
+    set to default for events with fewer than 3 jets.
+    """
+    counts = ak.to_numpy(ak.num(jets))
+    offsets = np.zeros(len(counts)+1, np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    #the cartesian components are computed with numpy, exactly as for the coffea Lorentz vectors
+    pt = ak.to_numpy(ak.flatten(jets.pt))
+    eta = ak.to_numpy(ak.flatten(jets.eta))
+    phi = ak.to_numpy(ak.flatten(jets.phi))
+    mass = ak.to_numpy(ak.flatten(jets.mass))
+    x = pt * np.cos(phi)
+    y = pt * np.sin(phi)
+    z = pt * np.sinh(eta)
+    t = np.hypot(pt * np.cosh(eta), mass)
+
+    dtype = np.result_type(x, y, z, t)
+    return bestTriJetMassKernel(x.astype(dtype), y.astype(dtype), z.astype(dtype), t.astype(dtype), offsets, default)